@@ -1,35 +1,89 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
+import time
+_process_start = time.perf_counter()
+
 import os
-import psycopg2
-from dotenv import dotenv_values
-from openai import AzureOpenAI
+import sys
 import json
-import time
+import io
 import uuid
 import re
 import csv
+import math
+import heapq
+import random
+import hashlib
 import string
+import threading
+import itertools
+import logging
+from collections import OrderedDict, deque
+from contextlib import contextmanager, ExitStack
+import click
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, Response, stream_with_context
+import psycopg2
+from dotenv import dotenv_values
 from werkzeug.utils import secure_filename
-from dotenv import load_dotenv
-from openai import AzureOpenAI
-from tenacity import retry, wait_random_exponential, stop_after_attempt
-from langchain_community.document_loaders import PyPDFLoader
-from langchain_community.document_loaders import UnstructuredWordDocumentLoader
-from langchain_community.document_loaders import UnstructuredPowerPointLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from tempfile import NamedTemporaryFile
-from langchain_openai.embeddings import OpenAIEmbeddings
-from langchain_community.document_loaders import UnstructuredExcelLoader
-from azure.cosmos import CosmosClient, PartitionKey
-import pandas as pd
+
+# Heavy dependencies (LangChain loaders, Azure Cosmos, OpenAI, sentence-transformers)
+# are imported inside the feature that needs them, see import_timer
+
+# Import cost per subsystem in seconds, reported by /startup-report
+IMPORT_TIMINGS = {'core': time.perf_counter() - _process_start}
+
+# Time the imports done inside the block and charge them to a subsystem
+@contextmanager
+def import_timer(subsystem):
+    """Record how long the first import of a subsystem's dependencies takes.
+
+    Later entries into the block find the modules in sys.modules and add
+    nothing, so the report shows the cold-start cost each feature pays once.
+    """
+    loaded = len(sys.modules)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if len(sys.modules) != loaded:
+            IMPORT_TIMINGS[subsystem] = IMPORT_TIMINGS.get(subsystem, 0.0) + time.perf_counter() - start
 
 env_name = "example.env"  # following example.env template change to your own .env file name
 config = dotenv_values(env_name)
 
+# Logging: LOG_LEVEL (DEBUG, INFO, WARNING...) and LOG_FORMAT (json or text) from the .env file
+LOG_LEVEL = str(config.get('LOG_LEVEL', 'INFO')).upper()
+LOG_FORMAT = config.get('LOG_FORMAT', 'json')
+
+# One JSON object per line, with the event's fields next to the message
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'ts': self.formatTime(record), 'level': record.levelname, 'logger': record.name, 'message': record.getMessage()}
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+# The message followed by key=value fields
+class TextLogFormatter(logging.Formatter):
+    def format(self, record):
+        fields = ' '.join(f'{key}={value!r}' for key, value in getattr(record, 'fields', {}).items())
+        return f'{self.formatTime(record)} {record.levelname} {record.getMessage()} {fields}'.rstrip()
+
+logger = logging.getLogger('pgtest')
+logger.setLevel(LOG_LEVEL)
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(JsonLogFormatter() if LOG_FORMAT == 'json' else TextLogFormatter())
+logger.addHandler(_log_handler)
+logger.propagate = False
+
+# Log an event with structured fields; below LOG_LEVEL nothing is formatted
+def log_event(level, message, **fields):
+    if logger.isEnabledFor(level):
+        logger.log(level, message, extra={'fields': fields}, stacklevel=2)
+
 app = Flask(__name__)
 app.secret_key = os.environ.get('FLASK_SECRET_KEY', 'your_secret_key_change_this_in_production')
 app.config['UPLOAD_FOLDER'] = 'uploads'
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max request size, larger files use the resumable upload (/uploads)
 
 # Create upload folder if it doesn't exist
 if not os.path.exists(app.config['UPLOAD_FOLDER']):
@@ -42,25 +96,731 @@ You are friendly, helpful, and informative and can be lighthearted. Be concise i
 - start with the hello {username} - Only answer questions related to the information provided below.
 '''
 
-# Clear the cache table in the database
-def clearcache(dbname, user, password, host, port):
+# Tenant used when a user has not been assigned one
+DEFAULT_TENANT = 'default'
+
+# Text search configuration used when a document or a query does not specify one
+DEFAULT_LANGUAGE = 'english'
+
+# PostgreSQL text search configurations accepted for documents and queries
+SUPPORTED_LANGUAGES = ['simple', 'english', 'french', 'german', 'spanish', 'italian',
+                       'portuguese', 'dutch', 'danish', 'finnish', 'norwegian', 'swedish', 'russian']
+
+# Cosine distance under which a cached completion is reused, unless the user sets their own
+DEFAULT_CACHE_THRESHOLD = 0.07
+
+# Embeddings deployment used by the chat session and the command-line tools alike
+DEFAULT_EMBEDDINGS_MODEL = config.get('openai_embeddings_deployment') or 'text-embedding-ada-002'
+
+# Server-side tenant assignments: JSON object mapping a username to its tenant name
+TENANT_ASSIGNMENTS = json.loads(config.get('TENANT_ASSIGNMENTS') or '{}')
+
+# Users allowed to run database-wide operations such as changing the embedding model, comma separated
+ADMIN_USERS = {name.strip() for name in (config.get('ADMIN_USERS') or '').split(',') if name.strip()}
+
+# Partitions already created by this process, to skip the DDL round trip
+_ready_tenants = set()
+
+# Tenant names that are already short lowercase identifiers are their own key
+_PLAIN_TENANT_KEY = re.compile(r'[a-z][a-z0-9_]{0,31}')
+
+# Map a tenant name to the key used as a partition name suffix
+def tenant_key(name):
+    """Return the partition key of a tenant name.
+
+    Lowercase identifiers of up to 32 characters, and so every key returned
+    here, map to themselves. Any other name gets a short slug followed by a
+    hash of the exact name, so names that differ only in case, punctuation,
+    non-ASCII characters or past the slug length get different keys. The
+    32 characters keep every partition and index name under PostgreSQL's
+    63 character limit.
+    """
+    name = str(name or DEFAULT_TENANT)
+    if _PLAIN_TENANT_KEY.fullmatch(name):
+        return name
+    slug = re.sub(r'[^a-z0-9]+', '_', name.lower()).strip('_')
+    if not slug[:1].isalpha():
+        slug = ('t_' + slug).rstrip('_')
+    return slug[:19].rstrip('_') + '_' + hashlib.sha256(name.encode('utf-8')).hexdigest()[:12]
+
+# Record which tenant name owns a partition key, rejecting names whose key is taken
+def register_tenant(cur, name):
+    tenant = tenant_key(name)
+    cur.execute('''INSERT INTO tenants (tenant, name) VALUES (%s, %s)
+                   ON CONFLICT (tenant) DO UPDATE SET name = EXCLUDED.name WHERE tenants.name IS NULL''',
+                (tenant, str(name or DEFAULT_TENANT)))
+    cur.execute('SELECT name FROM tenants WHERE tenant = %s', (tenant,))
+    owner = cur.fetchone()[0]
+    if owner != str(name or DEFAULT_TENANT):
+        raise ValueError(f"Tenant name {name!r} collides with tenant {owner!r} on key {tenant}")
+    return tenant
+
+# Create the per-tenant partitions of data and tablecahedoc with their own indexes
+def ensure_tenant_partition(tenant, dbname, user, password, host, port):
+    """Create the list partitions for a tenant if they do not exist yet.
+
+    Each tenant gets its own DiskANN and GIN indexes so vector search cost
+    scales with the tenant's corpus and bulk loads only touch its partition.
+    """
+    tenant = tenant_key(tenant)
+    if tenant in _ready_tenants:
+        return tenant
+
     conn = get_db_connection(dbname, user, password, host, port)
     cur = conn.cursor()
-    cur.execute('DELETE FROM tablecahedoc')
+    cur.execute('INSERT INTO tenants (tenant) VALUES (%s) ON CONFLICT (tenant) DO NOTHING', (tenant,))
+    cur.execute('CREATE TABLE IF NOT EXISTS data_t_' + tenant + ' PARTITION OF data FOR VALUES IN (%s)', (tenant,))
+    cur.execute('CREATE INDEX IF NOT EXISTS data_t_' + tenant + '_gin_idx ON data_t_' + tenant + ' USING GIN (tsv)')
+    cur.execute('CREATE TABLE IF NOT EXISTS tablecahedoc_t_' + tenant + ' PARTITION OF tablecahedoc FOR VALUES IN (%s)', (tenant,))
+    for table in VECTOR_INDEX_TABLES:
+        method, build_params, _ = get_vector_index_settings(cur, table, tenant)
+        cur.execute('CREATE INDEX IF NOT EXISTS ' + vector_index_name(table, tenant) + ' ON ' + table + '_t_' + tenant
+                    + vector_index_using(method, build_params, layout=get_vector_layout(cur, table, tenant, method)))
     conn.commit()
     cur.close()
     conn.close()
 
-# Initialize the database with required tables and indexes
-def intialize(dbname, user, password, host, port, embeddingssize, openai_embeddings_model):
-    
-# Connect to PostgreSQL
-    conn = get_db_connection(dbname,user,password,host,port)
+    _ready_tenants.add(tenant)
+    return tenant
+
+# Find the tenant a user belongs to from the server-side assignment, registering new users
+def resolve_tenant(username, email, country, dbname, user, password, host, port):
+    """Return the partition key of the user's tenant.
+
+    TENANT_ASSIGNMENTS wins over the tenant stored in userapp, so moving a
+    user is a configuration change; users with neither belong to
+    DEFAULT_TENANT. Nothing typed at login is used, so a user cannot join
+    another tenant by knowing its name.
+    """
+    conn = get_db_connection(dbname, user, password, host, port)
     cur = conn.cursor()
+    try:
+        cur.execute('SELECT tenant FROM userapp WHERE username = %s ORDER BY id LIMIT 1', (username,))
+        row = cur.fetchone()
+        if username in TENANT_ASSIGNMENTS:
+            tenant = register_tenant(cur, TENANT_ASSIGNMENTS[username])
+        elif row and row[0]:
+            tenant = row[0]
+        else:
+            tenant = register_tenant(cur, DEFAULT_TENANT)
+        if row is None:
+            cur.execute('INSERT INTO userapp (username, email, country, tenant) VALUES (%s, %s, %s, %s)',
+                        (username, email, country, tenant))
+        elif row[0] != tenant:
+            cur.execute('UPDATE userapp SET tenant = %s WHERE username = %s', (tenant, username))
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+    return tenant
 
-    # Execute a command: this creates a new table
+# Clear the cache table in the database (only the given tenant's partition when set)
+def clearcache(dbname, user, password, host, port, tenant=None):
+    conn = get_db_connection(dbname, user, password, host, port)
+    cur = conn.cursor()
+    if tenant:
+        cur.execute('DELETE FROM tablecahedoc WHERE tenant = %s', (tenant_key(tenant),))
+    else:
+        cur.execute('DELETE FROM tablecahedoc')
+    conn.commit()
+    cur.close()
+    conn.close()
+    retrieval_cache.clear(tenant)
+    if tenant and CACHE_WARM_ENABLED:
+        schedule_cache_warm(tenant, dbname, user, password, host, port)
+
+# Bump a tenant's corpus version in the cursor's transaction; cached completions of older versions stop matching
+def bump_corpus_version(cur, tenant):
+    cur.execute('''UPDATE tenants SET corpus_version = corpus_version + 1
+                   WHERE tenant = %s RETURNING corpus_version''', (tenant,))
+    row = cur.fetchone()
+    return row[0] if row else 0
+
+# Invalidate the cached completions built from files that were just (re)ingested
+def invalidate_cache_for_files(tenant, filenames, dbname, user, password, host, port):
+    """Bump the tenant's corpus version after an ingestion.
+
+    The corpus version is part of the cache scope, so every cached completion
+    of the tenant stops matching without rewriting its rows; clearcache
+    removes them. Retrieval results of this process that did not use the
+    ingested files are carried over to the new version. Returns the version.
+    """
+    tenant = tenant_key(tenant)
+    conn = get_db_connection(dbname, user, password, host, port)
+    cur = conn.cursor()
+    version = bump_corpus_version(cur, tenant)
+    conn.commit()
+    cur.close()
+    conn.close()
+    invalidate_local_caches(tenant, filenames, version, dbname, user, password, host, port)
+    return version
+
+# Drop this process's retrieval results and chunks for files whose corpus version was just bumped
+def invalidate_local_caches(tenant, filenames, version, dbname, user, password, host, port):
+    retrieval_cache.invalidate(tenant, filenames, version)
+    chunk_cache.clear(tenant)
+    if CACHE_WARM_ENABLED:
+        schedule_cache_warm(tenant, dbname, user, password, host, port)
+
+# Tables that carry a per-tenant vector index on dvector
+VECTOR_INDEX_TABLES = ['data', 'tablecahedoc']
+
+# Supported vector index methods with their default build and search parameters
+VECTOR_INDEX_METHODS = {
+    'diskann': {'ops': 'vector_cosine_ops',
+                'build': {'max_neighbors': 32, 'l_value_ib': 100},
+                'search': {'diskann.l_value_is': 100}},
+    'hnsw': {'ops': 'vector_cosine_ops',
+             'build': {'m': 16, 'ef_construction': 64},
+             'search': {'hnsw.ef_search': 40}},
+    'ivfflat': {'ops': 'vector_cosine_ops',
+                'build': {'lists': 100},
+                'search': {'ivfflat.probes': 10}},
+}
+
+# Index method used for new partitions unless one was chosen for the tenant
+DEFAULT_VECTOR_INDEX_METHOD = config.get('VECTOR_INDEX_METHOD', 'diskann')
+
+# Compact storage of the indexed vectors: type, operator class, distance operator and index methods
+VECTOR_QUANTIZATIONS = {
+    'none': {'type': 'vector', 'ops': 'vector_cosine_ops', 'op': '<=>', 'methods': ['diskann', 'hnsw', 'ivfflat']},
+    'halfvec': {'type': 'halfvec', 'ops': 'halfvec_cosine_ops', 'op': '<=>', 'methods': ['hnsw', 'ivfflat']},
+    'binary': {'type': 'bit', 'ops': 'bit_hamming_ops', 'op': '<~>', 'methods': ['hnsw', 'ivfflat']},
+}
+
+# Index layout for new partitions: quantization and optional reduced dimensions
+DEFAULT_VECTOR_QUANTIZATION = config.get('VECTOR_QUANTIZATION', 'none')
+DEFAULT_VECTOR_INDEX_DIMS = int(config.get('VECTOR_INDEX_DIMS') or 0) or None
+
+# Candidates read from a compact index before rescoring with the full-precision vectors
+VECTOR_RESCORE_CANDIDATES = int(config.get('VECTOR_RESCORE_CANDIDATES', 40))
+
+# Loads with at least this many chunks, and this share of the partition's rows, drop the vector index and rebuild it afterwards
+BULK_LOAD_THRESHOLD = int(config.get('BULK_LOAD_THRESHOLD', 500))
+BULK_LOAD_RATIO = float(config.get('BULK_LOAD_RATIO', 0.5))
+
+# Search parameters per (table, tenant), so retrieval does not read them on every query;
+# kept INDEX_SETTINGS_TTL seconds so a rebuild by another worker is picked up
+_search_params_cache = {}
+INDEX_SETTINGS_TTL = float(config.get('INDEX_SETTINGS_TTL', 10))
+
+# Name of the vector index of a tenant partition
+def vector_index_name(table, tenant):
+    return table + '_t_' + tenant_key(tenant) + '_vector_idx'
+
+# Keep only the known integer parameters of an index method
+def clean_index_params(method, params, kind):
+    allowed = VECTOR_INDEX_METHODS[method][kind]
+    cleaned = dict(allowed)
+    for key, value in (params or {}).items():
+        if key in allowed:
+            cleaned[key] = int(value)
+    return cleaned
+
+# True when the index stores something else than the full-precision vectors
+def is_compact_layout(layout):
+    return bool(layout) and (layout['quantization'] != 'none' or layout['dims'] < layout['full_dims'])
+
+# Expression turning a full-precision vector into the indexed representation
+def vector_layout_sql(layout, expr):
+    """Truncate (Matryoshka-style, renormalized) and/or quantize a vector expression.
+
+    Used both for the index expression over dvector and for the query vector,
+    so the planner matches the ORDER BY with the index.
+    """
+    dims = layout['dims']
+    if dims < layout['full_dims']:
+        expr = 'l2_normalize(subvector(' + expr + ', 1, ' + str(dims) + '))'
+    if layout['quantization'] == 'binary':
+        return 'binary_quantize(' + expr + ')::bit(' + str(dims) + ')'
+    if layout['quantization'] == 'none' and dims == layout['full_dims']:
+        return expr
+    return '(' + expr + ')::' + VECTOR_QUANTIZATIONS[layout['quantization']]['type'] + '(' + str(dims) + ')'
+
+# USING clause creating a vector index of the given method on dvector
+def vector_index_using(method, build_params, column='dvector', layout=None):
+    options = ', '.join(f'{key} = {int(value)}' for key, value in build_params.items())
+    if is_compact_layout(layout):
+        indexed = '(' + vector_layout_sql(layout, column) + ') ' + VECTOR_QUANTIZATIONS[layout['quantization']]['ops']
+    else:
+        indexed = column + ' ' + VECTOR_INDEX_METHODS[method]['ops']
+    return ' USING ' + method + ' (' + indexed + ')' + (' WITH (' + options + ')' if options else '')
+
+# Get the quantization and dimensions of a tenant's index, falling back to full precision
+def get_vector_layout(cur, table, tenant, method, column='dvector'):
+    cur.execute('''SELECT v.quantization, v.index_dims, m.dims FROM embedding_models m
+                   LEFT JOIN vector_indexes v ON v.table_name = %s AND v.tenant = %s
+                   WHERE m.column_name = %s''', (table, tenant_key(tenant), column))
+    row = cur.fetchone()
+    if row is None:
+        return None
+    quantization = row[0] or DEFAULT_VECTOR_QUANTIZATION
+    if method not in VECTOR_QUANTIZATIONS.get(quantization, {}).get('methods', []):
+        quantization = 'none'
+    dims = row[1] if row[0] else DEFAULT_VECTOR_INDEX_DIMS
+    return {'quantization': quantization, 'dims': min(dims or row[2], row[2]), 'full_dims': row[2]}
+
+# Get the index method and parameters of a tenant partition, or the defaults
+def get_vector_index_settings(cur, table, tenant):
+    cur.execute('''SELECT method, build_params, search_params FROM vector_indexes
+                   WHERE table_name = %s AND tenant = %s''', (table, tenant_key(tenant)))
+    row = cur.fetchone()
+    method = row[0] if row else DEFAULT_VECTOR_INDEX_METHOD
+    return (method,
+            clean_index_params(method, row[1] if row else None, 'build'),
+            clean_index_params(method, row[2] if row else None, 'search'))
+
+# Index method, search parameters and layout of a tenant partition, re-read every INDEX_SETTINGS_TTL seconds
+def cached_index_settings(cur, table, tenant):
+    key = (table, tenant_key(tenant))
+    cached = _search_params_cache.get(key)
+    if cached is None or time.time() - cached[0] >= INDEX_SETTINGS_TTL:
+        method, _, stored = get_vector_index_settings(cur, table, tenant)
+        cached = (time.time(), (method, stored, get_vector_layout(cur, table, tenant, method)))
+        _search_params_cache[key] = cached
+    return cached[1]
+
+# FROM item yielding the rows nearest to a query through a compact index
+def vector_source_sql(cur, table, tenant, query, limit, where='', where_params=(), query_sql='query_embedding(%s)'):
+    """Return (sql, params) to use in place of the table in a vector query.
+
+    With a quantized or reduced index, the subquery reads the closest
+    VECTOR_RESCORE_CANDIDATES rows from it, and the caller's ORDER BY on the
+    full-precision dvector rescores them. Otherwise the table itself is used.
+    query is None when query_sql takes no parameter (see query_embedding_cte).
+    """
+    _, _, layout = cached_index_settings(cur, table, tenant)
+    if not is_compact_layout(layout):
+        return table, []
+    operator = VECTOR_QUANTIZATIONS[layout['quantization']]['op']
+    sql = ('(SELECT * FROM ' + table + ' WHERE tenant = %s' + where
+           + ' ORDER BY ' + vector_layout_sql(layout, 'dvector') + ' ' + operator + ' ' + vector_layout_sql(layout, query_sql)
+           + ' LIMIT %s)')
+    return sql, [tenant] + list(where_params) + ([] if query is None else [query]) + [max(limit, VECTOR_RESCORE_CANDIDATES)]
+
+# Apply the search parameters of a tenant's vector index to the current transaction
+def set_search_params(cur, table, tenant, search_params=None):
+    """SET LOCAL the index search parameters (e.g. hnsw.ef_search) before a vector query.
+
+    search_params overrides the stored ones for this query only.
+    """
+    method, stored, _ = cached_index_settings(cur, table, tenant)
+    params = dict(stored)
+    params.update(clean_index_params(method, search_params, 'search') if search_params else {})
+    for name, value in params.items():
+        cur.execute('SET LOCAL ' + name + ' = ' + str(int(value)))
+
+# Drop the vector index of a tenant partition
+def drop_vector_index(table, tenant, dbname, user, password, host, port, concurrently=False):
+    conn = get_db_connection(dbname, user, password, host, port)
+    conn.autocommit = concurrently
+    cur = conn.cursor()
+    start = time.perf_counter()
+    cur.execute('DROP INDEX ' + ('CONCURRENTLY ' if concurrently else '') + 'IF EXISTS ' + vector_index_name(table, tenant))
+    if not concurrently:
+        conn.commit()
+    cur.close()
+    conn.close()
+    _search_params_cache.pop((table, tenant_key(tenant)), None)
+    return {'action': 'drop', 'table': table, 'tenant': tenant_key(tenant),
+            'seconds': round(time.perf_counter() - start, 3)}
+
+# (Re)build the vector index of a tenant partition, optionally without blocking writes
+def build_vector_index(table, tenant, dbname, user, password, host, port,
+                       method=None, build_params=None, search_params=None, concurrently=False,
+                       quantization=None, index_dims=None, measure_recall=True):
+    """Build the vector index of one partition and record its settings.
+
+    A concurrent rebuild creates the new index next to the old one and swaps
+    them, so queries keep using an index while it builds. quantization
+    ('none', 'halfvec' or 'binary') and index_dims choose a compact layout;
+    the table keeps the full-precision vectors used for rescoring.
+    measure_recall=False skips the recall measurement (exact scans).
+    """
+    if table not in VECTOR_INDEX_TABLES:
+        raise ValueError(f"Unknown table: {table}")
+    tenant = tenant_key(tenant)
+    partition = table + '_t_' + tenant
+    name = vector_index_name(table, tenant)
+
+    conn = get_db_connection(dbname, user, password, host, port)
+    conn.autocommit = True
+    cur = conn.cursor()
+    stored_method, stored_build, stored_search = get_vector_index_settings(cur, table, tenant)
+    method = method or stored_method
+    if method not in VECTOR_INDEX_METHODS:
+        raise ValueError(f"Unknown index method: {method}")
+    if method != stored_method:
+        stored_build, stored_search = None, None
+    build_params = clean_index_params(method, build_params or stored_build, 'build')
+    search_params = clean_index_params(method, search_params or stored_search, 'search')
+
+    layout = get_vector_layout(cur, table, tenant, method)
+    if quantization is not None or index_dims is not None:
+        quantization = quantization or layout['quantization']
+        if method not in VECTOR_QUANTIZATIONS.get(quantization, {}).get('methods', []):
+            raise ValueError(f"Quantization {quantization} is not supported by {method}")
+        dims = int(index_dims) if index_dims else layout['full_dims']
+        if not 0 < dims <= layout['full_dims']:
+            raise ValueError(f"index_dims must be between 1 and {layout['full_dims']}")
+        layout = {'quantization': quantization, 'dims': dims, 'full_dims': layout['full_dims']}
 
-    cur.execute('CREATE TABLE tablecahedoc (id serial PRIMARY KEY,'
+    start = time.perf_counter()
+    if concurrently:
+        cur.execute('DROP INDEX CONCURRENTLY IF EXISTS ' + name + '_new')
+        cur.execute('CREATE INDEX CONCURRENTLY ' + name + '_new ON ' + partition + vector_index_using(method, build_params, layout=layout))
+        cur.execute('DROP INDEX CONCURRENTLY IF EXISTS ' + name)
+        cur.execute('ALTER INDEX ' + name + '_new RENAME TO ' + name)
+    else:
+        cur.execute('DROP INDEX IF EXISTS ' + name)
+        cur.execute('CREATE INDEX ' + name + ' ON ' + partition + vector_index_using(method, build_params, layout=layout))
+    seconds = time.perf_counter() - start
+
+    cur.execute('''INSERT INTO vector_indexes (table_name, tenant, method, build_params, search_params, built_at, quantization, index_dims)
+                   VALUES (%s, %s, %s, %s, %s, CURRENT_TIMESTAMP, %s, %s)
+                   ON CONFLICT (table_name, tenant) DO UPDATE
+                   SET method = EXCLUDED.method, build_params = EXCLUDED.build_params,
+                       search_params = EXCLUDED.search_params, built_at = EXCLUDED.built_at,
+                       quantization = EXCLUDED.quantization, index_dims = EXCLUDED.index_dims''',
+                (table, tenant, method, json.dumps(build_params), json.dumps(search_params),
+                 layout['quantization'], layout['dims'] if layout['dims'] < layout['full_dims'] else None))
+    cur.execute('SELECT pg_relation_size(%s::regclass), pg_relation_size(%s::regclass)', (name, partition))
+    index_bytes, table_bytes = cur.fetchone()
+    cur.close()
+    conn.close()
+    _search_params_cache.pop((table, tenant), None)
+
+    report = {'action': 'build', 'table': table, 'tenant': tenant, 'method': method,
+              'build_params': build_params, 'search_params': search_params,
+              'quantization': layout['quantization'], 'index_dims': layout['dims'],
+              'index_bytes': index_bytes, 'table_bytes': table_bytes,
+              'concurrently': concurrently, 'seconds': round(seconds, 3)}
+    if measure_recall:
+        report.update(measure_index_recall(table, tenant, dbname, user, password, host, port))
+    return report
+
+# Compare the index answer with an exact scan on a sample of stored vectors
+def measure_index_recall(table, tenant, dbname, user, password, host, port, sample_size=20, k=10, search_params=None):
+    """Return recall@k of the vector index and the average latency of both plans.
+
+    The sample queries are vectors already stored in the partition, so no
+    embedding call is made. With a compact layout the index answer is the
+    full-precision rescoring of its candidates, as in retrieval.
+    """
+    tenant = tenant_key(tenant)
+    partition = table + '_t_' + tenant
+    conn = get_db_connection(dbname, user, password, host, port)
+    cur = conn.cursor()
+    cur.execute('SELECT dvector::text FROM ' + partition + ' WHERE dvector IS NOT NULL ORDER BY random() LIMIT %s', (sample_size,))
+    samples = [row[0] for row in cur.fetchall()]
+    conn.commit()
+
+    query = 'SELECT id FROM ' + partition + ' ORDER BY dvector <=> %s::vector LIMIT %s'
+    hits, total, index_ms, exact_ms = 0, 0, 0.0, 0.0
+    for vector in samples:
+        set_search_params(cur, table, tenant, search_params)
+        cur.execute('SET LOCAL enable_seqscan = off')
+        source, source_params = vector_source_sql(cur, table, tenant, vector, k, query_sql='%s::vector')
+        start = time.perf_counter()
+        cur.execute('SELECT e.id FROM ' + (partition if source == table else source) + ' e ORDER BY e.dvector <=> %s::vector LIMIT %s',
+                    source_params + [vector, k])
+        approx = {row[0] for row in cur.fetchall()}
+        index_ms += (time.perf_counter() - start) * 1000
+        conn.commit()
+
+        cur.execute('SET LOCAL enable_indexscan = off')
+        cur.execute('SET LOCAL enable_bitmapscan = off')
+        start = time.perf_counter()
+        cur.execute(query, (vector, k))
+        exact = {row[0] for row in cur.fetchall()}
+        exact_ms += (time.perf_counter() - start) * 1000
+        conn.commit()
+
+        hits += len(approx & exact)
+        total += len(exact)
+    _, _, layout = cached_index_settings(cur, table, tenant)
+    cur.close()
+    conn.close()
+
+    return {'recall_at_k': round(hits / total, 4) if total else None, 'k': k, 'sample_size': len(samples),
+            'layout': layout,
+            'index_avg_ms': round(index_ms / len(samples), 2) if samples else None,
+            'exact_avg_ms': round(exact_ms / len(samples), 2) if samples else None}
+
+# Build each candidate layout in turn and report its size, recall and latency
+def compare_vector_layouts(table, tenant, dbname, user, password, host, port, layouts, sample_size=20, k=10):
+    """Compare index layouts against the current one on the same partition.
+
+    layouts is a list of {'method', 'quantization', 'index_dims'} dicts. Each
+    is built concurrently, measured, and the current layout is restored at the end.
+    """
+    tenant = tenant_key(tenant)
+    conn = get_db_connection(dbname, user, password, host, port)
+    cur = conn.cursor()
+    method, build_params, search_params = get_vector_index_settings(cur, table, tenant)
+    current = get_vector_layout(cur, table, tenant, method)
+    cur.close()
+    conn.close()
+
+    current_layout = {'method': method, 'quantization': current['quantization'], 'index_dims': current['dims']}
+    reports = []
+    try:
+        for layout in [current_layout] + list(layouts):
+            report = build_vector_index(table, tenant, dbname, user, password, host, port,
+                                        layout.get('method', method), None, None, True,
+                                        layout.get('quantization', 'none'), layout.get('index_dims'))
+            report.update(measure_index_recall(table, tenant, dbname, user, password, host, port, sample_size, k))
+            reports.append(report)
+    finally:
+        build_vector_index(table, tenant, dbname, user, password, host, port,
+                           method, build_params, search_params, True, current['quantization'], current['dims'])
+    return reports
+
+# Drop a tenant's chunk vector index around a large load and rebuild it afterwards
+@contextmanager
+def bulk_load(tenant, chunk_count, dbname, user, password, host, port):
+    """Skip incremental index maintenance for loads that are large next to the partition.
+
+    A load of BULK_LOAD_THRESHOLD chunks or more that also adds at least
+    BULK_LOAD_RATIO of the rows already in the tenant's partition drops its
+    index and rebuilds it at the end, both CONCURRENTLY, so searches are never
+    blocked (they scan the partition in between). One bulk load runs per
+    tenant at a time, under an advisory lock held by this connection; a
+    concurrent load keeps the index maintained row by row.
+    """
+    if chunk_count < BULK_LOAD_THRESHOLD:
+        yield
+        return
+    tenant = tenant_key(tenant)
+    conn = get_db_connection(dbname, user, password, host, port)
+    conn.autocommit = True
+    cur = conn.cursor()
+    try:
+        cur.execute('SELECT pg_try_advisory_lock(hashtext(%s), hashtext(%s))', ('bulk_load', tenant))
+        rows = None
+        if cur.fetchone()[0]:
+            cur.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(%s)', ('data_t_' + tenant,))
+            row = cur.fetchone()
+            rows = row[0] if row else 0
+            if rows < 0:
+                # Never analyzed: count the rows once
+                cur.execute('SELECT count(*) FROM data_t_' + tenant)
+                rows = cur.fetchone()[0]
+        if rows is None or chunk_count < BULK_LOAD_RATIO * rows:
+            yield
+            return
+        log_event(logging.INFO, 'bulk load: dropping vector index', tenant=tenant, chunks=chunk_count, rows=rows)
+        drop_vector_index('data', tenant, dbname, user, password, host, port, concurrently=True)
+        try:
+            yield
+        finally:
+            report = build_vector_index('data', tenant, dbname, user, password, host, port,
+                                        concurrently=True, measure_recall=False)
+            log_event(logging.INFO, 'vector index rebuilt', tenant=tenant, seconds=report['seconds'])
+    finally:
+        # Closing the connection releases the advisory lock
+        cur.close()
+        conn.close()
+
+# Tables with embedding columns and the text column they embed
+EMBEDDED_TABLES = {'data': 'chuncks', 'tablecahedoc': 'prompt'}
+
+# Chunks embedded per transaction when backfilling a new embedding column
+EMBEDDING_BACKFILL_BATCH = int(config.get('EMBEDDING_BACKFILL_BATCH', 100))
+
+# Background backfill threads by embedding column
+_embedding_jobs = {}
+
+# Regenerate the triggers that fill every live embedding column on insert
+def refresh_embedding_triggers(cur):
+    """(Re)create one BEFORE INSERT OR UPDATE OF <source text> trigger per embedded table.
+
+    Each live column of embedding_models (the active one and any being
+    backfilled) is computed when it is NULL or when the source text changed;
+    a 'failed' column is left out, so a broken model does not block writes.
+    Updates of other columns (corpus_version, citations...) never embed.
+    """
+    cur.execute("""SELECT column_name, model FROM embedding_models
+                   WHERE status IN ('active', 'backfilling', 'ready') ORDER BY column_name""")
+    models = cur.fetchall()
+    for table, source in EMBEDDED_TABLES.items():
+        statements = ''
+        for column, model in models:
+            statements += ('IF NEW.' + column + ' IS NULL OR (TG_OP = \'UPDATE\' AND NEW.' + source + ' IS DISTINCT FROM OLD.' + source + ') THEN '
+                           + 'NEW.' + column + ' := azure_openai.create_embeddings(' + cur.mogrify('%s', (model,)).decode() + ', NEW.' + source + ')::vector; '
+                           + 'END IF; ')
+        cur.execute('CREATE OR REPLACE FUNCTION embed_' + table + '() RETURNS trigger LANGUAGE plpgsql AS $$ BEGIN '
+                    + statements + 'RETURN NEW; END $$')
+        cur.execute('DROP TRIGGER IF EXISTS embed_' + table + ' ON ' + table)
+        cur.execute('CREATE TRIGGER embed_' + table + ' BEFORE INSERT OR UPDATE OF ' + source + ' ON ' + table
+                    + ' FOR EACH ROW EXECUTE FUNCTION embed_' + table + '()')
+
+# Start moving to a new embedding model without downtime
+def start_embedding_migration(model, dims, dbname, user, password, host, port, auto_switch=True):
+    """Add an embedding column for the model and backfill it in the background.
+
+    New rows get both embeddings from the trigger while the backfill runs.
+    Once every chunk has one, the readers are switched with switch_embedding_model.
+    The model is called once first: a ValueError is raised, and nothing is
+    changed, when it cannot embed or returns another size than dims.
+    A 'failed' migration is started again.
+    """
+    column = 'dvector_' + re.sub(r'[^a-z0-9]', '_', str(model).lower()) + '_' + str(int(dims))
+
+    def probe():
+        conn = get_db_connection(dbname, user, password, host, port)
+        cur = conn.cursor()
+        try:
+            cur.execute("SELECT vector_dims(azure_openai.create_embeddings(%s, 'embedding model check')::vector)", (model,))
+            return cur.fetchone()[0]
+        finally:
+            cur.close()
+            conn.close()
+
+    try:
+        probed = openai_scheduler.submit(probe, PRIORITY_INTERACTIVE, 10)
+    except psycopg2.Error as e:
+        raise ValueError(f"Embedding model {model} is not usable: {str(e).strip()}")
+    if probed != int(dims):
+        raise ValueError(f"Embedding model {model} returns {probed} dimensions, not {int(dims)}")
+
+    conn = get_db_connection(dbname, user, password, host, port)
+    cur = conn.cursor()
+    cur.execute('SELECT status FROM embedding_models WHERE column_name = %s', (column,))
+    row = cur.fetchone()
+    if row is None:
+        for table in EMBEDDED_TABLES:
+            cur.execute('ALTER TABLE ' + table + ' ADD COLUMN IF NOT EXISTS ' + column + ' vector(' + str(int(dims)) + ')')
+        cur.execute("""INSERT INTO embedding_models (column_name, model, dims, status)
+                       VALUES (%s, %s, %s, 'backfilling')""", (column, model, int(dims)))
+        refresh_embedding_triggers(cur)
+    elif row[0] == 'failed':
+        cur.execute("UPDATE embedding_models SET status = 'backfilling' WHERE column_name = %s", (column,))
+        refresh_embedding_triggers(cur)
+    conn.commit()
+    cur.close()
+    conn.close()
+
+    job = _embedding_jobs.get(column)
+    if job is None or not job.is_alive():
+        job = threading.Thread(target=backfill_embedding_column, daemon=True,
+                               args=(column, model, dbname, user, password, host, port, auto_switch))
+        _embedding_jobs[column] = job
+        job.start()
+    return column
+
+# Fill a new embedding column in small batches, at ingestion priority
+def backfill_embedding_column(column, model, dbname, user, password, host, port, auto_switch=True):
+    def batch():
+        conn = get_db_connection(dbname, user, password, host, port)
+        cur = conn.cursor()
+        cur.execute('UPDATE data d SET ' + column + ' = azure_openai.create_embeddings(%s, d.chuncks)::vector '
+                    'FROM (SELECT tenant, id FROM data WHERE ' + column + ' IS NULL AND chuncks IS NOT NULL '
+                    'LIMIT %s FOR UPDATE SKIP LOCKED) b '
+                    'WHERE d.tenant = b.tenant AND d.id = b.id', (model, EMBEDDING_BACKFILL_BATCH))
+        updated = cur.rowcount
+        cur.execute('UPDATE embedding_models SET backfilled = backfilled + %s WHERE column_name = %s', (updated, column))
+        conn.commit()
+        cur.close()
+        conn.close()
+        return updated
+
+    try:
+        while openai_scheduler.submit(batch, PRIORITY_BULK, EMBEDDING_BACKFILL_BATCH * 250) > 0:
+            pass
+        conn = get_db_connection(dbname, user, password, host, port)
+        cur = conn.cursor()
+        cur.execute("UPDATE embedding_models SET status = 'ready' WHERE column_name = %s", (column,))
+        conn.commit()
+        cur.close()
+        conn.close()
+        log_event(logging.INFO, 'embedding backfill complete', column=column, model=model)
+        if auto_switch:
+            switch_embedding_model(column, dbname, user, password, host, port)
+    except Exception as e:
+        log_event(logging.ERROR, 'embedding backfill failed', column=column, model=model, error=str(e))
+        # Stop embedding new rows with this model; the column is kept for a retry or a cancel
+        conn = get_db_connection(dbname, user, password, host, port)
+        cur = conn.cursor()
+        cur.execute("UPDATE embedding_models SET status = 'failed' WHERE column_name = %s AND status <> 'active'", (column,))
+        refresh_embedding_triggers(cur)
+        conn.commit()
+        cur.close()
+        conn.close()
+
+# Abandon an embedding migration: drop its column and stop the triggers from filling it
+def cancel_embedding_migration(column, dbname, user, password, host, port):
+    conn = get_db_connection(dbname, user, password, host, port)
+    cur = conn.cursor()
+    try:
+        cur.execute('SELECT status FROM embedding_models WHERE column_name = %s', (column,))
+        row = cur.fetchone()
+        if row is None:
+            raise ValueError(f"Unknown embedding column: {column}")
+        if row[0] == 'active':
+            raise ValueError('The active embedding column cannot be cancelled')
+        cur.execute('DELETE FROM embedding_models WHERE column_name = %s', (column,))
+        refresh_embedding_triggers(cur)
+        for table in EMBEDDED_TABLES:
+            cur.execute('ALTER TABLE ' + table + ' DROP COLUMN IF EXISTS ' + column)
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+    log_event(logging.INFO, 'embedding migration cancelled', column=column)
+
+# Make a backfilled embedding column the one every query reads, in one transaction
+def switch_embedding_model(column, dbname, user, password, host, port):
+    conn = get_db_connection(dbname, user, password, host, port)
+    conn.autocommit = True
+    cur = conn.cursor()
+    cur.execute('SELECT tenant FROM tenants')
+    tenants = [row[0] for row in cur.fetchall()]
+
+    # Build the per-tenant indexes first so readers keep an index across the switch
+    for tenant in tenants:
+        for table in VECTOR_INDEX_TABLES:
+            method, build_params, _ = get_vector_index_settings(cur, table, tenant)
+            layout = get_vector_layout(cur, table, tenant, method, column)
+            cur.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS ' + vector_index_name(table, tenant) + '_next ON '
+                        + table + '_t_' + tenant + vector_index_using(method, build_params, column, layout))
+
+    conn.autocommit = False
+    try:
+        cur.execute('SELECT model FROM embedding_models WHERE column_name = %s', (column,))
+        if cur.fetchone() is None:
+            raise ValueError(f"Unknown embedding column: {column}")
+        # Cached prompts that were never embedded with the new model cannot be matched any more
+        cur.execute('DELETE FROM tablecahedoc WHERE ' + column + ' IS NULL')
+        for table in EMBEDDED_TABLES:
+            cur.execute('ALTER TABLE ' + table + ' DROP COLUMN dvector')
+            cur.execute('ALTER TABLE ' + table + ' RENAME COLUMN ' + column + ' TO dvector')
+        for tenant in tenants:
+            for table in VECTOR_INDEX_TABLES:
+                cur.execute('ALTER INDEX ' + vector_index_name(table, tenant) + '_next RENAME TO ' + vector_index_name(table, tenant))
+        cur.execute("DELETE FROM embedding_models WHERE column_name = 'dvector'")
+        cur.execute("UPDATE embedding_models SET column_name = 'dvector', status = 'active' WHERE column_name = %s", (column,))
+        refresh_embedding_triggers(cur)
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+    _search_params_cache.clear()
+    retrieval_cache.clear()
+    log_event(logging.INFO, 'embedding model switched', column=column)
+
+# Schema version 1: tables and indexes as created by the original intialize
+def migration_001_base_schema(cur, settings):
+    cur.execute('CREATE TABLE IF NOT EXISTS tablecahedoc (id serial PRIMARY KEY,'
                                  'prompt text  NOT NULL,'
                                  'completion text NOT NULL,'
                                  'completiontokens integer NOT NULL,'
@@ -72,13 +832,13 @@ def intialize(dbname, user, password, host, port, embeddingssize, openai_embeddi
         )
 
 
-    cmd = """ALTER TABLE tablecahedoc  ADD COLUMN dvector vector("""+str(embeddingssize)+""")  GENERATED ALWAYS AS ( azure_openai.create_embeddings('"""+ str(openai_embeddings_model)+"""', prompt)::vector) STORED; """
+    cmd = """ALTER TABLE tablecahedoc  ADD COLUMN IF NOT EXISTS dvector vector("""+str(settings['embeddingssize'])+""")  GENERATED ALWAYS AS ( azure_openai.create_embeddings('"""+ str(settings['openai_embeddings_model'])+"""', prompt)::vector) STORED; """
     cur.execute(cmd)
 
-    cm = """CREATE INDEX tablecahedoc_embedding_diskann_idx ON tablecahedoc USING diskann (dvector vector_cosine_ops)"""
+    cm = """CREATE INDEX IF NOT EXISTS tablecahedoc_embedding_diskann_idx ON tablecahedoc USING diskann (dvector vector_cosine_ops)"""
     cur.execute(cm)
 
-    cur.execute('CREATE TABLE data (id serial PRIMARY KEY,'
+    cur.execute('CREATE TABLE IF NOT EXISTS data (id serial PRIMARY KEY,'
                                  'filename text NOT NULL,'
                                  'typefile text NOT NULL,' 
                                  'chuncks text,'
@@ -87,13 +847,13 @@ def intialize(dbname, user, password, host, port, embeddingssize, openai_embeddi
     
 
     
-    cmd = """ALTER TABLE data  ADD COLUMN dvector vector("""+str(embeddingssize)+""")  GENERATED ALWAYS AS ( azure_openai.create_embeddings('"""+ str(openai_embeddings_model)+"""', chuncks)::vector) STORED; """
+    cmd = """ALTER TABLE data  ADD COLUMN IF NOT EXISTS dvector vector("""+str(settings['embeddingssize'])+""")  GENERATED ALWAYS AS ( azure_openai.create_embeddings('"""+ str(settings['openai_embeddings_model'])+"""', chuncks)::vector) STORED; """
     cur.execute(cmd)
 
-    cmd2 = """CREATE INDEX data_embedding_diskann_idx ON data USING diskann (dvector vector_cosine_ops)"""
+    cmd2 = """CREATE INDEX IF NOT EXISTS data_embedding_diskann_idx ON data USING diskann (dvector vector_cosine_ops)"""
     cur.execute(cmd2)
     
-    cmd3 = """CREATE INDEX data_idx ON data USING GIN (to_tsvector('english', chuncks));"""
+    cmd3 = """CREATE INDEX IF NOT EXISTS data_idx ON data USING GIN (to_tsvector('english', chuncks));"""
     cur.execute(cmd3)
     
     cur.execute('''CREATE TABLE IF NOT EXISTS system_prompts (
@@ -107,12 +867,264 @@ def intialize(dbname, user, password, host, port, embeddingssize, openai_embeddi
     
     cmd3 = """CREATE TABLE IF NOT EXISTS public.userapp(id serial PRIMARY KEY,username text ,email text NOT NULL , country text, date_added date DEFAULT CURRENT_TIMESTAMP);"""    
     cur.execute(cmd3)
-    # Commit the transaction
-    conn.commit()
 
-# Close the cursor and connection
-    cur.close()
-    conn.close()
+# Schema version 2: embeddings maintained by triggers instead of generated columns
+def migration_002_embedding_triggers(cur, settings):
+    """Turn dvector into a plain column filled by a trigger when it is NULL.
+
+    Rows can then carry more than one embedding column during a model change,
+    and restores can supply vectors without calling the embedding model.
+    """
+    cur.execute('''CREATE TABLE IF NOT EXISTS embedding_models (
+                    column_name text PRIMARY KEY,
+                    model text NOT NULL,
+                    dims integer NOT NULL,
+                    status text NOT NULL,
+                    backfilled bigint NOT NULL DEFAULT 0,
+                    date_added timestamp DEFAULT CURRENT_TIMESTAMP);
+                ''')
+    cur.execute('''INSERT INTO embedding_models (column_name, model, dims, status)
+                   VALUES ('dvector', %s, %s, 'active') ON CONFLICT (column_name) DO NOTHING''',
+                (settings['openai_embeddings_model'], int(settings['embeddingssize'])))
+    for table in EMBEDDED_TABLES:
+        cur.execute("""SELECT attgenerated FROM pg_attribute
+                       WHERE attrelid = %s::regclass AND attname = 'dvector'""", (table,))
+        row = cur.fetchone()
+        if row and row[0] == 's':
+            cur.execute('ALTER TABLE ' + table + ' ALTER COLUMN dvector DROP EXPRESSION')
+    refresh_embedding_triggers(cur)
+    # Query embeddings always use the active model, so a model switch is atomic for readers
+    cur.execute("""CREATE OR REPLACE FUNCTION query_embedding(input text) RETURNS vector
+                   LANGUAGE sql STABLE AS $$
+                   SELECT azure_openai.create_embeddings(
+                       (SELECT model FROM embedding_models WHERE status = 'active'), input)::vector
+                   $$""")
+
+# Replace an unpartitioned table by one list-partitioned by tenant, moving its rows to DEFAULT_TENANT
+def partition_by_tenant(cur, table, definition, columns):
+    cur.execute('SELECT relkind FROM pg_class WHERE oid = %s::regclass', (table,))
+    if cur.fetchone()[0] == 'p':
+        return
+    # Free the names the new table's primary key and serial sequence take
+    cur.execute('ALTER TABLE ' + table + ' RENAME TO ' + table + '_unpartitioned')
+    cur.execute('ALTER INDEX IF EXISTS ' + table + '_pkey RENAME TO ' + table + '_unpartitioned_pkey')
+    cur.execute('ALTER SEQUENCE IF EXISTS ' + table + '_id_seq RENAME TO ' + table + '_unpartitioned_id_seq')
+    cur.execute('CREATE TABLE ' + table + ' (' + definition + ') PARTITION BY LIST (tenant)')
+    cur.execute('CREATE TABLE ' + table + '_t_' + DEFAULT_TENANT + ' PARTITION OF ' + table + ' FOR VALUES IN (%s)',
+                (DEFAULT_TENANT,))
+    # Embeddings are copied as they are, nothing is sent to the embedding model
+    cur.execute('INSERT INTO ' + table + ' (tenant, ' + columns + ') SELECT %s, ' + columns
+                + ' FROM ' + table + '_unpartitioned', (DEFAULT_TENANT,))
+    cur.execute("SELECT setval(pg_get_serial_sequence(%s, 'id'), coalesce(max(id), 0) + 1, false) FROM " + table, (table,))
+    cur.execute('DROP TABLE ' + table + '_unpartitioned')
+
+# Schema version 3: tenants, and the chunks and the cache list-partitioned by tenant
+def migration_003_tenant_partitions(cur, settings):
+    """Add the tenant registry and settings tables, then partition data and tablecahedoc.
+
+    Rows of a database created before tenants are kept in the DEFAULT_TENANT
+    partition and its users are assigned to that tenant. The single-table
+    indexes go with the old tables; ensure_tenant_partition builds each
+    partition's own indexes.
+    """
+    cur.execute('''CREATE TABLE IF NOT EXISTS tenants (
+                    tenant text PRIMARY KEY,
+                    corpus_version bigint NOT NULL DEFAULT 0,
+                    date_added date DEFAULT CURRENT_TIMESTAMP);
+                ''')
+
+    cur.execute('''CREATE TABLE IF NOT EXISTS vector_indexes (
+                    table_name text NOT NULL,
+                    tenant text NOT NULL,
+                    method text NOT NULL,
+                    build_params jsonb NOT NULL DEFAULT '{}',
+                    search_params jsonb NOT NULL DEFAULT '{}',
+                    built_at timestamp DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (table_name, tenant));
+                ''')
+
+    cur.execute('''CREATE TABLE IF NOT EXISTS user_settings (
+                    username text PRIMARY KEY,
+                    cache_threshold real NOT NULL DEFAULT ''' + str(DEFAULT_CACHE_THRESHOLD) + ''');
+                ''')
+
+    cur.execute('ALTER TABLE userapp ADD COLUMN IF NOT EXISTS tenant text')
+    cur.execute('UPDATE userapp SET tenant = %s WHERE tenant IS NULL', (DEFAULT_TENANT,))
+    cur.execute('INSERT INTO tenants (tenant) VALUES (%s) ON CONFLICT (tenant) DO NOTHING', (DEFAULT_TENANT,))
+
+    dims = str(int(settings['embeddingssize']))
+    partition_by_tenant(cur, 'tablecahedoc',
+                        'id serial,'
+                        'tenant text NOT NULL,'
+                        'prompt text  NOT NULL,'
+                        'completion text NOT NULL,'
+                        'completiontokens integer NOT NULL,'
+                        'promptTokens integer NOT NULL,'
+                        'totalTokens integer NOT NULL,'
+                        'model varchar(150) NOT NULL,'
+                        'usname text NOT NULL,'
+                        'searchtype text NOT NULL DEFAULT \'vector\','
+                        'prompt_id integer NOT NULL DEFAULT 0,'
+                        'chatmodel text NOT NULL DEFAULT \'\','
+                        'corpus_version bigint NOT NULL DEFAULT 0,'
+                        'sourcefiles text[] NOT NULL DEFAULT \'{}\','
+                        'date_added date DEFAULT CURRENT_TIMESTAMP,'
+                        'dvector vector(' + dims + '),'
+                        'PRIMARY KEY (tenant, id)',
+                        'id, prompt, completion, completiontokens, promptTokens, totalTokens, model, usname, date_added, dvector')
+    partition_by_tenant(cur, 'data',
+                        'id serial,'
+                        'tenant text NOT NULL,'
+                        'filename text NOT NULL,'
+                        'typefile text NOT NULL,'
+                        'chuncks text,'
+                        'language regconfig NOT NULL DEFAULT \'english\','
+                        'tsv tsvector GENERATED ALWAYS AS (to_tsvector(language, coalesce(chuncks, \'\'))) STORED,'
+                        'date_added date DEFAULT CURRENT_TIMESTAMP,'
+                        'dvector vector(' + dims + '),'
+                        'PRIMARY KEY (tenant, id)',
+                        'id, filename, typefile, chuncks, date_added, dvector')
+    # The embedding triggers of version 2 went with the old tables
+    refresh_embedding_triggers(cur)
+
+# Schema version 4: source ids and checkpoints for incremental Argus syncs
+def migration_004_argus_sync(cur, settings):
+    cur.execute('ALTER TABLE data ADD COLUMN IF NOT EXISTS source_id text')
+    cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS data_source_idx ON data (tenant, typefile, source_id)')
+    cur.execute('''CREATE TABLE IF NOT EXISTS argus_sync_state (
+                    tenant text NOT NULL,
+                    source text NOT NULL,
+                    last_ts bigint NOT NULL DEFAULT 0,
+                    runs bigint NOT NULL DEFAULT 0,
+                    last_run timestamp,
+                    last_counts jsonb,
+                    PRIMARY KEY (tenant, source));
+                ''')
+    # Rows loaded by the full re-imports are replaced on the first incremental sync,
+    # and the cached answers built from them stop matching
+    cur.execute("DELETE FROM data WHERE typefile = 'argus' AND source_id IS NULL RETURNING tenant")
+    for tenant in {row[0] for row in cur.fetchall()}:
+        bump_corpus_version(cur, tenant)
+
+# Schema version 5: quantized and reduced-dimension vector index layouts
+def migration_005_vector_layouts(cur, settings):
+    cur.execute("ALTER TABLE vector_indexes ADD COLUMN IF NOT EXISTS quantization text NOT NULL DEFAULT 'none'")
+    cur.execute('ALTER TABLE vector_indexes ADD COLUMN IF NOT EXISTS index_dims integer')
+
+# Schema version 6: snapshot parts already restored, so an interrupted import resumes
+def migration_006_snapshot_imports(cur, settings):
+    cur.execute('''CREATE TABLE IF NOT EXISTS snapshot_imports (
+                    snapshot_id text NOT NULL,
+                    part text NOT NULL,
+                    rows_copied bigint NOT NULL,
+                    rows_inserted bigint NOT NULL,
+                    imported_at timestamp DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (snapshot_id, part));
+                ''')
+
+# Schema version 7: questions asked in chat, mined by the cache warmer
+def migration_007_query_log(cur, settings):
+    cur.execute('''CREATE TABLE IF NOT EXISTS query_log (
+                    id bigserial PRIMARY KEY,
+                    tenant text NOT NULL,
+                    usname text NOT NULL,
+                    prompt text NOT NULL,
+                    searchtype text NOT NULL,
+                    chatmodel text NOT NULL DEFAULT '',
+                    cached boolean NOT NULL,
+                    asked_at timestamp DEFAULT CURRENT_TIMESTAMP);
+                ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS query_log_tenant_idx ON query_log (tenant, asked_at)')
+
+# Schema version 8: where each chunk comes from, and the chunks a cached answer cites
+def migration_008_provenance(cur, settings):
+    cur.execute("ALTER TABLE data ADD COLUMN IF NOT EXISTS locator jsonb NOT NULL DEFAULT '{}'")
+    cur.execute("ALTER TABLE tablecahedoc ADD COLUMN IF NOT EXISTS citations jsonb NOT NULL DEFAULT '[]'")
+
+# Schema version 9: the tenant name that owns each partition key
+def migration_009_tenant_names(cur, settings):
+    cur.execute('ALTER TABLE tenants ADD COLUMN IF NOT EXISTS name text UNIQUE')
+
+# Schema version 10: Argus checkpoints on (_ts, id) instead of _ts alone
+def migration_010_argus_checkpoint_ids(cur, settings):
+    cur.execute("ALTER TABLE argus_sync_state ADD COLUMN IF NOT EXISTS last_id text NOT NULL DEFAULT ''")
+
+# Schema version 11: exact-match cache probes that need no query embedding
+def migration_011_prompt_hashes(cur, settings):
+    cur.execute('CREATE INDEX IF NOT EXISTS tablecahedoc_prompt_md5_idx ON tablecahedoc (tenant, usname, md5(prompt))')
+
+# Ordered schema migrations: (version, description, function)
+MIGRATIONS = [
+    (1, 'base schema', migration_001_base_schema),
+    (2, 'embeddings maintained by triggers', migration_002_embedding_triggers),
+    (3, 'tenant partitions', migration_003_tenant_partitions),
+    (4, 'incremental argus sync', migration_004_argus_sync),
+    (5, 'vector index layouts', migration_005_vector_layouts),
+    (6, 'snapshot imports', migration_006_snapshot_imports),
+    (7, 'query log', migration_007_query_log),
+    (8, 'chunk provenance', migration_008_provenance),
+    (9, 'tenant names', migration_009_tenant_names),
+    (10, 'argus checkpoint ids', migration_010_argus_checkpoint_ids),
+    (11, 'cached prompt hashes', migration_011_prompt_hashes),
+]
+
+# Apply the pending schema migrations, safe to run again and from several processes
+def migrate(dbname, user, password, host, port, embeddingssize, openai_embeddings_model):
+    """Apply every migration newer than the database's version, one transaction each.
+
+    An advisory lock serializes concurrent callers. Returns the versions applied.
+    """
+    settings = {'embeddingssize': embeddingssize, 'openai_embeddings_model': openai_embeddings_model}
+    conn = get_db_connection(dbname, user, password, host, port)
+    cur = conn.cursor()
+    cur.execute("SELECT pg_advisory_lock(hashtext('schema_migrations'))")
+    applied = []
+    try:
+        cur.execute('''CREATE TABLE IF NOT EXISTS schema_migrations (
+                        version integer PRIMARY KEY,
+                        description text NOT NULL,
+                        applied_at timestamp DEFAULT CURRENT_TIMESTAMP);
+                    ''')
+        conn.commit()
+        cur.execute('SELECT version FROM schema_migrations')
+        done = {row[0] for row in cur.fetchall()}
+        for version, description, migration in MIGRATIONS:
+            if version in done:
+                continue
+            log_event(logging.INFO, 'applying migration', version=version, description=description)
+            migration(cur, settings)
+            cur.execute('INSERT INTO schema_migrations (version, description) VALUES (%s, %s)', (version, description))
+            conn.commit()
+            applied.append(version)
+    except:
+        conn.rollback()
+        raise
+    finally:
+        cur.execute("SELECT pg_advisory_unlock(hashtext('schema_migrations'))")
+        conn.commit()
+        cur.close()
+        conn.close()
+    return applied
+
+# Initialize the database with required tables and indexes (safe to call again)
+def intialize(dbname, user, password, host, port, embeddingssize, openai_embeddings_model, tenant=DEFAULT_TENANT,
+              quantization=None, index_dims=None):
+    applied = migrate(dbname, user, password, host, port, embeddingssize, openai_embeddings_model)
+
+    _ready_tenants.clear()
+    if applied:
+        retrieval_cache.clear()
+        chunk_cache.clear()
+    ensure_tenant_partition(tenant, dbname, user, password, host, port)
+    # A compact layout chosen here replaces the tenant's indexes
+    if quantization or index_dims:
+        method = DEFAULT_VECTOR_INDEX_METHOD
+        if method not in VECTOR_QUANTIZATIONS.get(quantization or 'none', {}).get('methods', []):
+            method = 'hnsw'
+        for table in VECTOR_INDEX_TABLES:
+            build_vector_index(table, tenant, dbname, user, password, host, port, method,
+                               quantization=quantization or 'none', index_dims=index_dims)
+    return applied
 
 # Clean all tables from the database
 def cleanall(dbname,user,password,host,port):
@@ -131,15 +1143,72 @@ def cleanall(dbname,user,password,host,port):
     conn.commit()
     cur.execute('DROP TABLE IF EXISTS userapp;')
     conn.commit()
+    cur.execute('DROP TABLE IF EXISTS tenants;')
+    conn.commit()
+    cur.execute('DROP TABLE IF EXISTS vector_indexes;')
+    conn.commit()
+    cur.execute('DROP TABLE IF EXISTS embedding_models;')
+    conn.commit()
+    cur.execute('DROP TABLE IF EXISTS schema_migrations;')
+    conn.commit()
+    cur.execute('DROP TABLE IF EXISTS argus_sync_state;')
+    conn.commit()
+    cur.execute('DROP TABLE IF EXISTS snapshot_imports;')
+    conn.commit()
+    cur.execute('DROP TABLE IF EXISTS query_log;')
+    conn.commit()
+    cur.execute('DROP TABLE IF EXISTS user_settings;')
+    conn.commit()
+    cur.execute('DROP FUNCTION IF EXISTS query_embedding(text);')
+    cur.execute('DROP FUNCTION IF EXISTS embed_data();')
+    cur.execute('DROP FUNCTION IF EXISTS embed_tablecahedoc();')
+    conn.commit()
     cur.close()
     conn.close()
 
+    _ready_tenants.clear()
+    retrieval_cache.clear()
+
+# Insert one chunk; its embedding is computed by the database through Azure OpenAI
+def insert_chunk(tenant, filename, typefile, chunk, language, dbname, user, password, host, port, source_id=None, locator=None):
+    def insert():
+        conn = get_db_connection(dbname,user,password,host,port)
+        cur = conn.cursor()
+        cur.execute('INSERT INTO data (tenant, filename, typefile,chuncks, language, source_id, locator)'
+                    'VALUES (%s, %s, %s,%s, %s, %s, %s::jsonb)',
+                    (tenant,filename,typefile,chunk, text_search_language(language), source_id, json.dumps(locator or {}))
+                    )
+        conn.commit()
+        cur.close()
+        conn.close()
+
+    # Ingestion yields to interactive chat when the Azure OpenAI budget is tight
+    openai_scheduler.submit(insert, PRIORITY_BULK, estimate_tokens(chunk))
+
+# Where a chunk comes from in its file (page, slide, sheet, row...), from the loader's metadata
+def chunk_locator(typefile, metadata=None, **position):
+    metadata = metadata or {}
+    locator = {}
+    if metadata.get('page') is not None:
+        # PyPDF numbers pages from 0
+        locator['page'] = int(metadata['page']) + 1
+    elif metadata.get('page_number') is not None:
+        locator['slide' if typefile == 'ppt' else 'page'] = metadata['page_number']
+    if metadata.get('page_name'):
+        locator['sheet'] = metadata['page_name']
+    locator.update(position)
+    return locator
+
 # Load a PowerPoint file into the database
-def loadpptfile(name,file,dbname,user,password,host,port, upload_id=None) :
+def loadpptfile(name,file,dbname,user,password,host,port, upload_id=None, tenant=DEFAULT_TENANT, language=DEFAULT_LANGUAGE) :
     
     if upload_id:
         upload_progress[upload_id] = {'status': 'processing', 'progress': 50, 'message': 'Loading PowerPoint...'}
     
+    with import_timer('upload'):
+        from langchain_community.document_loaders import UnstructuredPowerPointLoader
+        from langchain_text_splitters import RecursiveCharacterTextSplitter
+    
     loader = UnstructuredPowerPointLoader(file)
     data = loader.load()
     
@@ -154,31 +1223,29 @@ def loadpptfile(name,file,dbname,user,password,host,port, upload_id=None) :
    
     try:
         total_docs = len(docs)
-        for idx, d in enumerate(docs):
-            data = str(d)
+        with bulk_load(tenant, total_docs, dbname, user, password, host, port):
+            for idx, d in enumerate(docs):
+                data = str(d)
          
-            conn = get_db_connection(dbname,user,password,host,port)
-            cur = conn.cursor()
-            cur.execute('INSERT INTO data (filename, typefile,chuncks)'
-                        'VALUES (%s, %s,%s)',
-                        (name,"ppt",data)
-                        )
-            conn.commit()
-            cur.close()
-            conn.close()
+                insert_chunk(tenant, name, "ppt", data, language, dbname, user, password, host, port,
+                             locator=chunk_locator('ppt', d.metadata, chunk=idx + 1))
             
-            if upload_id and total_docs > 0:
-                progress = 70 + int((idx + 1) / total_docs * 25)
-                upload_progress[upload_id] = {'status': 'processing', 'progress': progress, 'message': f'Inserted {idx + 1}/{total_docs} chunks...'}
+                if upload_id and total_docs > 0:
+                    progress = 70 + int((idx + 1) / total_docs * 25)
+                    upload_progress[upload_id] = {'status': 'processing', 'progress': progress, 'message': f'Inserted {idx + 1}/{total_docs} chunks...'}
     except : 
      raise 
 
 # Load an Excel file into the database
-def loadxlsfile(name,file,dbname,user,password,host,port, upload_id=None) :
+def loadxlsfile(name,file,dbname,user,password,host,port, upload_id=None, tenant=DEFAULT_TENANT, language=DEFAULT_LANGUAGE) :
     
     if upload_id:
         upload_progress[upload_id] = {'status': 'processing', 'progress': 50, 'message': 'Loading Excel file...'}
     
+    with import_timer('upload'):
+        from langchain_community.document_loaders import UnstructuredExcelLoader
+        from langchain_text_splitters import RecursiveCharacterTextSplitter
+    
     loader = UnstructuredExcelLoader(file, mode="elements")
     data = loader.load()
 
@@ -193,32 +1260,25 @@ def loadxlsfile(name,file,dbname,user,password,host,port, upload_id=None) :
       
     try:
         total_docs = len(data)
-        for idx, d in enumerate(data):
-            dat = str(d)
+        with bulk_load(tenant, total_docs, dbname, user, password, host, port):
+            for idx, d in enumerate(data):
+                dat = str(d)
          
-            conn = get_db_connection(dbname,user,password,host,port)
-            cur = conn.cursor()
-            cur.execute('INSERT INTO data (filename, typefile,chuncks)'
-                        'VALUES (%s, %s,%s)',
-                        (name,"xls",dat)
-                        )
-            conn.commit()
-            cur.close()
-            conn.close()
+                insert_chunk(tenant, name, "xls", dat, language, dbname, user, password, host, port,
+                             locator=chunk_locator('xls', d.metadata, element=idx + 1))
             
-            if upload_id and total_docs > 0:
-                progress = 70 + int((idx + 1) / total_docs * 25)
-                upload_progress[upload_id] = {'status': 'processing', 'progress': progress, 'message': f'Inserted {idx + 1}/{total_docs} chunks...'}
+                if upload_id and total_docs > 0:
+                    progress = 70 + int((idx + 1) / total_docs * 25)
+                    upload_progress[upload_id] = {'status': 'processing', 'progress': progress, 'message': f'Inserted {idx + 1}/{total_docs} chunks...'}
     except : 
      raise 
 
 # Load a generic file using Azure Document Intelligence
 
 # Load a PDF file into the database
-def loadpdffile(name,file,dbname,user,password,host,port, upload_id=None) :
+def loadpdffile(name,file,dbname,user,password,host,port, upload_id=None, tenant=DEFAULT_TENANT, language=DEFAULT_LANGUAGE) :
     
-    print(f"Loading PDF file: {file}")
-    print(f"File exists: {os.path.exists(file)}")
+    log_event(logging.DEBUG, 'loading PDF file', file=file, exists=os.path.exists(file))
    
     # Verify file exists before attempting to load
     if not os.path.exists(file):
@@ -227,50 +1287,51 @@ def loadpdffile(name,file,dbname,user,password,host,port, upload_id=None) :
     if upload_id:
         upload_progress[upload_id] = {'status': 'processing', 'progress': 50, 'message': 'Loading PDF document...'}
     
+    with import_timer('upload'):
+        from langchain_community.document_loaders import PyPDFLoader
+        from langchain_text_splitters import RecursiveCharacterTextSplitter
+    
     try:
+        from pypdf import PdfReader
+        total_pages = len(PdfReader(file).pages)
         loader = PyPDFLoader(file)
-        data = loader.load()
     except Exception as e:
-        print(f"Error in PyPDFLoader: {str(e)}")
+        log_event(logging.ERROR, 'PyPDFLoader failed', file=file, error=str(e))
         raise Exception(f"Failed to load PDF document. Make sure it's a valid PDF file. Error: {str(e)}")
     
     if upload_id:
-        upload_progress[upload_id] = {'status': 'processing', 'progress': 60, 'message': 'Splitting document into chunks...'}
+        upload_progress[upload_id] = {'status': 'processing', 'progress': 60, 'message': f'Inserting {total_pages} pages into database...'}
     
     text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=150)
-    docs = text_splitter.split_documents(data)
-    
-    if upload_id:
-        upload_progress[upload_id] = {'status': 'processing', 'progress': 70, 'message': f'Inserting {len(docs)} chunks into database...'}
     
+    # Pages are read, split and inserted one at a time, so large PDFs load with bounded memory;
+    # a first pass counts the chunks for bulk loading
     try:
-        total_docs = len(docs)
-        for idx, d in enumerate(docs):
-            data = str(d)
-           
-            conn = get_db_connection(dbname,user,password,host,port)
-            cur = conn.cursor()
-            cur.execute('INSERT INTO data (filename, typefile,chuncks)'
-                        'VALUES (%s, %s,%s)',
-                        (name,"pdf",data)
-                        )
-            conn.commit()
-            cur.close()
-            conn.close()
+        total_chunks = sum(len(text_splitter.split_documents([page])) for page in loader.lazy_load())
+        idx = 0
+        with bulk_load(tenant, total_chunks, dbname, user, password, host, port):
+            for page_idx, page in enumerate(loader.lazy_load()):
+                for d in text_splitter.split_documents([page]):
+                    idx += 1
+                    data = str(d)
+               
+                    insert_chunk(tenant, name, "pdf", data, language, dbname, user, password, host, port,
+                                 locator=chunk_locator('pdf', d.metadata, chunk=idx))
             
-            if upload_id and total_docs > 0:
-                progress = 70 + int((idx + 1) / total_docs * 25)
-                upload_progress[upload_id] = {'status': 'processing', 'progress': progress, 'message': f'Inserted {idx + 1}/{total_docs} chunks...'}
+                if upload_id and total_pages > 0:
+                    progress = 60 + int((page_idx + 1) / total_pages * 35)
+                    upload_progress[upload_id] = {'status': 'processing', 'progress': progress, 'message': f'Inserted page {page_idx + 1}/{total_pages} ({idx} chunks)...'}
     except : 
      raise     
 
 # Load a Word file into the database
-def loadwordfile(name,file,dbname,user,password,host,port, upload_id=None) :
+def loadwordfile(name,file,dbname,user,password,host,port, upload_id=None, tenant=DEFAULT_TENANT, language=DEFAULT_LANGUAGE) :
     
-    print(f"Loading Word file: {file}")
-    print(f"File exists: {os.path.exists(file)}")
+    log_event(logging.DEBUG, 'loading Word file', file=file, exists=os.path.exists(file))
     
-    from langchain_community.document_loaders import Docx2txtLoader
+    with import_timer('upload'):
+        from langchain_community.document_loaders import Docx2txtLoader
+        from langchain_text_splitters import RecursiveCharacterTextSplitter
     
     # Verify file exists before attempting to load
     if not os.path.exists(file):
@@ -283,7 +1344,7 @@ def loadwordfile(name,file,dbname,user,password,host,port, upload_id=None) :
         loader = Docx2txtLoader(file)
         data = loader.load()    
     except Exception as e:
-        print(f"Error in Docx2txtLoader: {str(e)}")
+        log_event(logging.ERROR, 'Docx2txtLoader failed', file=file, error=str(e))
         raise Exception(f"Failed to load Word document. Make sure it's a valid .docx file. Error: {str(e)}")
   
     if upload_id:
@@ -297,122 +1358,450 @@ def loadwordfile(name,file,dbname,user,password,host,port, upload_id=None) :
     
     try:
         total_docs = len(docs)
-        for idx, d in enumerate(docs):
-            data = str(d)
-            conn = get_db_connection(dbname,user,password,host,port)
-            cur = conn.cursor()
-            cur.execute('INSERT INTO data (filename, typefile,chuncks)'
-                        'VALUES (%s, %s,%s)',
-                        (name,"word",data)
-                        )
-            conn.commit()
-            cur.close()
-            conn.close()
+        with bulk_load(tenant, total_docs, dbname, user, password, host, port):
+            for idx, d in enumerate(docs):
+                data = str(d)
+                insert_chunk(tenant, name, "word", data, language, dbname, user, password, host, port,
+                             locator=chunk_locator('word', d.metadata, chunk=idx + 1))
             
-            if upload_id and total_docs > 0:
-                progress = 70 + int((idx + 1) / total_docs * 25)
-                upload_progress[upload_id] = {'status': 'processing', 'progress': progress, 'message': f'Inserted {idx + 1}/{total_docs} chunks...'}
+                if upload_id and total_docs > 0:
+                    progress = 70 + int((idx + 1) / total_docs * 25)
+                    upload_progress[upload_id] = {'status': 'processing', 'progress': progress, 'message': f'Inserted {idx + 1}/{total_docs} chunks...'}
     except : 
      raise    
 
 # Load a JSON file into the database
-def loadjsonfile(name,file,dbname,user,password,host,port, upload_id=None): 
+def loadjsonfile(name,file,dbname,user,password,host,port, upload_id=None, tenant=DEFAULT_TENANT, language=DEFAULT_LANGUAGE): 
     
     if upload_id:
         upload_progress[upload_id] = {'status': 'processing', 'progress': 50, 'message': 'Reading JSON file...'}
     
+    # A top-level array is streamed record by record when ijson is installed (two passes: count, then insert)
+    try:
+        with import_timer('upload'):
+            import ijson
+    except ImportError:
+        ijson = None
+    with open(file, 'rb') as f:
+        streamed = ijson is not None and f.read(64).lstrip().startswith(b'[')
+    
     with open(file,encoding="utf8") as file:
-        docu = json.load(file)
-        total_rows = len(docu)
+        if streamed:
+            total_rows = sum(1 for _ in ijson.items(file.buffer, 'item'))
+            file.seek(0)
+            docu = ijson.items(file.buffer, 'item', use_float=True)
+        else:
+            docu = json.load(file)
+            total_rows = len(docu)
         
         if upload_id:
             upload_progress[upload_id] = {'status': 'processing', 'progress': 60, 'message': f'Inserting {total_rows} records...'}
         
-        for idx, row in enumerate(docu):
-            data = json.dumps(row)
-            conn = get_db_connection(dbname,user,password,host,port)
-            cur = conn.cursor()
-            cur.execute('INSERT INTO data (filename, typefile,chuncks)'
-                'VALUES (%s, %s,%s)',
-                (name,"json",data)
-               )
-            conn.commit()
-            cur.close()
-            conn.close()
+        with bulk_load(tenant, total_rows, dbname, user, password, host, port):
+            for idx, row in enumerate(docu):
+                data = json.dumps(row)
+                insert_chunk(tenant, name, "json", data, language, dbname, user, password, host, port,
+                             locator=chunk_locator('json', record=idx + 1))
             
-            if upload_id and total_rows > 0:
-                progress = 60 + int((idx + 1) / total_rows * 35)
-                upload_progress[upload_id] = {'status': 'processing', 'progress': progress, 'message': f'Inserted {idx + 1}/{total_rows} records...'}
+                if upload_id and total_rows > 0:
+                    progress = 60 + int((idx + 1) / total_rows * 35)
+                    upload_progress[upload_id] = {'status': 'processing', 'progress': progress, 'message': f'Inserted {idx + 1}/{total_rows} records...'}
 
 # Load a CSV file into the database
-def loadcsvfile(name,file,dbname,user,password,host,port, upload_id=None) :
+def loadcsvfile(name,file,dbname,user,password,host,port, upload_id=None, tenant=DEFAULT_TENANT, language=DEFAULT_LANGUAGE) :
     
  if upload_id:
      upload_progress[upload_id] = {'status': 'processing', 'progress': 50, 'message': 'Reading CSV file...'}
  
  with open(file, mode='r', encoding='utf-8-sig') as file:
+  # Rows are streamed; a first pass counts the lines for progress and bulk loading
+  total_rows = max(sum(1 for _ in file) - 1, 0)
+  file.seek(0)
   csv_reader = csv.DictReader(file)
-  rows = list(csv_reader)
-  total_rows = len(rows)
   
   if upload_id:
       upload_progress[upload_id] = {'status': 'processing', 'progress': 60, 'message': f'Inserting {total_rows} rows...'}
   
-  for idx, row in enumerate(rows):
-    data = json.dumps(row)
-    conn = get_db_connection(dbname,user,password,host,port)
-    cur = conn.cursor()
-    cur.execute('INSERT INTO data (filename, typefile,chuncks)'
-                'VALUES (%s, %s,%s)',
-                (name,"csv",data)
-               )
-    conn.commit()
-    cur.close()
-    conn.close()
+  with bulk_load(tenant, total_rows, dbname, user, password, host, port):
+      for idx, row in enumerate(csv_reader):
+        data = json.dumps(row)
+        insert_chunk(tenant, name, "csv", data, language, dbname, user, password, host, port,
+                     locator=chunk_locator('csv', row=idx + 1))
     
-    if upload_id and total_rows > 0:
-        progress = 60 + int((idx + 1) / total_rows * 35)
-        upload_progress[upload_id] = {'status': 'processing', 'progress': progress, 'message': f'Inserted {idx + 1}/{total_rows} rows...'}
+        if upload_id and total_rows > 0:
+            progress = 60 + int(min(idx + 1, total_rows) / total_rows * 35)
+            upload_progress[upload_id] = {'status': 'processing', 'progress': progress, 'message': f'Inserted {idx + 1}/{total_rows} rows...'}
   
 
+# Runs between two full id scans that detect documents deleted from Argus
+ARGUS_RECONCILE_EVERY = int(config.get('ARGUS_RECONCILE_EVERY', 12))
+
+# Documents read from Cosmos DB per page
+ARGUS_PAGE_SIZE = int(config.get('ARGUS_PAGE_SIZE', 200))
+
+# Scheduled Argus syncs by (tenant, source)
+_argus_jobs = {}
+
+# Incrementally sync an Argus container into the tenant's chunks
+def sync_argus_container(container, source, dbname, user, password, host, port, tenant=DEFAULT_TENANT, language=DEFAULT_LANGUAGE):
+    """Upsert the documents changed since the last checkpoint and delete removed ones.
+
+    container is anything with the azure-cosmos ContainerProxy.query_items
+    signature, so a local fake container can stand in for Cosmos DB. Documents
+    are paged on (_ts, id) from the checkpoint persisted in argus_sync_state,
+    which needs a composite index (_ts ASC, id ASC) on the container; only new
+    or changed summaries are written (and so embedded). Every
+    ARGUS_RECONCILE_EVERY runs the ids are listed to drop deleted documents.
+    A session advisory lock keeps one sync per tenant and source at a time;
+    RuntimeError is raised when another one holds it. Returns a dict of counts.
+    """
+    tenant = tenant_key(tenant)
+    conn = get_db_connection(dbname, user, password, host, port)
+    cur = conn.cursor()
+    cur.execute("SELECT pg_try_advisory_lock(hashtext('argus_sync'), hashtext(%s || '/' || %s))", (tenant, source))
+    if not cur.fetchone()[0]:
+        cur.close()
+        conn.close()
+        raise RuntimeError(f'An Argus sync of {source} is already running for this tenant')
+    try:
+        return _sync_argus_locked(container, source, conn, cur, dbname, user, password, host, port, tenant, language)
+    finally:
+        # Ending the session releases the advisory lock
+        cur.close()
+        conn.close()
+
+# Body of sync_argus_container, run while its advisory lock is held
+def _sync_argus_locked(container, source, conn, cur, dbname, user, password, host, port, tenant, language):
+    cur.execute('''INSERT INTO argus_sync_state (tenant, source) VALUES (%s, %s)
+                   ON CONFLICT (tenant, source) DO NOTHING''', (tenant, source))
+    cur.execute('''SELECT last_ts, last_id, runs FROM argus_sync_state
+                   WHERE tenant = %s AND source = %s''', (tenant, source))
+    checkpoint_ts, checkpoint_id, runs = cur.fetchone()
+    conn.commit()
+
+    counts = {'inserted': 0, 'updated': 0, 'deleted': 0, 'unchanged': 0}
+    while True:
+        # Keyset paging: documents sharing a _ts are ordered by id, so none is skipped or read twice
+        page = list(container.query_items(
+            query="SELECT TOP @n c.id, c._ts, c.extracted_data.gpt_summary_output FROM c "
+                  "WHERE c._ts > @ts OR (c._ts = @ts AND c.id > @id) ORDER BY c._ts, c.id",
+            parameters=[{'name': '@n', 'value': ARGUS_PAGE_SIZE}, {'name': '@ts', 'value': checkpoint_ts},
+                        {'name': '@id', 'value': checkpoint_id}],
+            enable_cross_partition_query=True))
+        if not page:
+            break
+
+        ids = [item.get('id') for item in page]
+        cur.execute('''SELECT source_id, md5(chuncks) FROM data
+                       WHERE tenant = %s AND typefile = 'argus' AND source_id = ANY(%s)''', (tenant, ids))
+        existing = dict(cur.fetchall())
+        changed_files = []
+        for item in page:
+            summary_output = item.get('gpt_summary_output') or ''
+            digest = hashlib.md5(summary_output.encode('utf-8')).hexdigest() if summary_output else None
+            if existing.get(item.get('id')) != digest:
+                changed_files.append(item.get('id'))
+        # The rows below are written in their own transactions: bump the corpus version first, so
+        # answers cached before a sync that fails half way through this page stop matching too
+        if changed_files:
+            version = bump_corpus_version(cur, tenant)
+        conn.commit()
+        if changed_files:
+            invalidate_local_caches(tenant, changed_files, version, dbname, user, password, host, port)
+
+        with bulk_load(tenant, len(page), dbname, user, password, host, port):
+            for item in page:
+                doc_id = item.get('id')
+                summary_output = item.get('gpt_summary_output') or ''
+                if not summary_output:
+                    if doc_id in existing:
+                        cur.execute('''DELETE FROM data WHERE tenant = %s AND typefile = 'argus' AND source_id = %s''', (tenant, doc_id))
+                        conn.commit()
+                        counts['deleted'] += 1
+                    continue
+                if doc_id not in existing:
+                    insert_chunk(tenant, doc_id, "argus", summary_output, language, dbname, user, password, host, port, source_id=doc_id)
+                    counts['inserted'] += 1
+                elif existing[doc_id] != hashlib.md5(summary_output.encode('utf-8')).hexdigest():
+                    # The embedding trigger recomputes the vectors because chuncks changed
+                    def update(doc_id=doc_id, summary_output=summary_output):
+                        # A rate-limited embedding aborts the transaction: roll back so the retry starts clean
+                        try:
+                            cur.execute('''UPDATE data SET chuncks = %s, date_added = CURRENT_TIMESTAMP
+                                           WHERE tenant = %s AND typefile = 'argus' AND source_id = %s''',
+                                        (summary_output, tenant, doc_id))
+                            conn.commit()
+                        except:
+                            conn.rollback()
+                            raise
+                    openai_scheduler.submit(update, PRIORITY_BULK, estimate_tokens(summary_output))
+                    counts['updated'] += 1
+                else:
+                    counts['unchanged'] += 1
+
+        # The checkpoint moves in the same transaction as a second bump, which also drops the
+        # answers cached while the page was being written
+        checkpoint_ts, checkpoint_id = page[-1].get('_ts', 0), page[-1].get('id')
+        if changed_files:
+            version = bump_corpus_version(cur, tenant)
+        cur.execute('''UPDATE argus_sync_state SET last_ts = %s, last_id = %s WHERE tenant = %s AND source = %s''',
+                    (checkpoint_ts, checkpoint_id, tenant, source))
+        conn.commit()
+        if changed_files:
+            invalidate_local_caches(tenant, changed_files, version, dbname, user, password, host, port)
+        if len(page) < ARGUS_PAGE_SIZE:
+            break
+
+    removed = []
+    if runs % ARGUS_RECONCILE_EVERY == 0:
+        live_ids = set(container.query_items(query="SELECT VALUE c.id FROM c", enable_cross_partition_query=True))
+        cur.execute('''SELECT source_id FROM data WHERE tenant = %s AND typefile = 'argus' AND source_id IS NOT NULL''', (tenant,))
+        removed = [row[0] for row in cur.fetchall() if row[0] not in live_ids]
+        if removed:
+            cur.execute('''DELETE FROM data WHERE tenant = %s AND typefile = 'argus' AND source_id = ANY(%s)''', (tenant, removed))
+            version = bump_corpus_version(cur, tenant)
+            counts['deleted'] += len(removed)
+
+    cur.execute('''UPDATE argus_sync_state SET runs = runs + 1, last_run = CURRENT_TIMESTAMP, last_counts = %s
+                   WHERE tenant = %s AND source = %s''', (json.dumps(counts), tenant, source))
+    conn.commit()
+    if removed:
+        invalidate_local_caches(tenant, removed, version, dbname, user, password, host, port)
+    return counts
+
 # Load data from Argus Accelerator into the database
-def loaddataargus( argusdb,arguscollection , argusurl,arguskey, dbname,user,password,host,port) :
+def loaddataargus( argusdb,arguscollection , argusurl,arguskey, dbname,user,password,host,port, tenant=DEFAULT_TENANT, language=DEFAULT_LANGUAGE) :
     
+    with import_timer('argus'):
+        from azure.cosmos import CosmosClient
+
     clientargus = CosmosClient(argusurl, {'masterKey': arguskey})
     mydbtsource = clientargus.get_database_client(argusdb)   
-     
+    source = mydbtsource.get_container_client(arguscollection)
+
+    counts = sync_argus_container(source, argusurl + '/' + argusdb + '/' + arguscollection,
+                                  dbname, user, password, host, port, tenant, language)
+    return counts['inserted'] + counts['updated']
 
+# Run loaddataargus in the background every interval seconds until stopped
+def schedule_argus_sync(interval, argusdb, arguscollection, argusurl, arguskey, dbname, user, password, host, port, tenant=DEFAULT_TENANT):
+    key = (tenant_key(tenant), argusurl + '/' + argusdb + '/' + arguscollection)
+    stop_argus_sync(key)
+    stopped = threading.Event()
+
+    def run():
+        while not stopped.is_set():
+            try:
+                loaddataargus(argusdb, arguscollection, argusurl, arguskey, dbname, user, password, host, port, tenant)
+            except Exception as e:
+                log_event(logging.ERROR, 'scheduled Argus sync failed', tenant=tenant, collection=arguscollection, error=str(e))
+            stopped.wait(interval)
+
+    _argus_jobs[key] = stopped
+    threading.Thread(target=run, daemon=True).start()
+    return key
+
+# Stop a scheduled Argus sync
+def stop_argus_sync(key):
+    stopped = _argus_jobs.pop(key, None)
+    if stopped:
+        stopped.set()
+    return stopped is not None
     
+# Scheduler priorities: lower runs first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 10
+
+# Raised when Azure OpenAI keeps rate limiting after all retries
+class RateLimitedError(Exception):
+    def __init__(self, message, retry_after=1.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+# Rough token count of a text or chat message list (about 4 characters per token)
+def estimate_tokens(payload):
+    if not isinstance(payload, str):
+        payload = json.dumps(payload)
+    return max(1, len(payload) // 4)
+
+# HTTP status of a failed Azure OpenAI call as azure_ai reports it in a PostgreSQL error
+_AZURE_AI_STATUS = re.compile(r'(?:status(?:[ _]?code)?|HTTP(?:/[\d.]+)?)\s*[:=]?\s*(\d{3})\b|\b(Too Many Requests)\b', re.IGNORECASE)
+
+# SQLSTATE classes raised by PostgreSQL itself (data, integrity, transaction state, syntax/access), never by a throttled call
+_NOT_RATE_LIMIT_SQLSTATES = ('22', '23', '25', '40', '42')
+
+# Whether an exception is an Azure OpenAI 429, raised by the SDK or by azure_ai in PostgreSQL
+def is_rate_limited(exc):
+    """Detect throttling from the error's type and HTTP status, never from stray digits.
+
+    The SDK raises openai.RateLimitError, whose status_code is 429. Errors of
+    azure_ai come back as psycopg2 errors; only those outside the SQLSTATE
+    classes PostgreSQL uses for its own failures are inspected, and only the
+    HTTP status they report counts.
+    """
+    if getattr(exc, 'status_code', None) == 429:
+        return True
+    if not isinstance(exc, psycopg2.Error) or (exc.pgcode or '')[:2] in _NOT_RATE_LIMIT_SQLSTATES:
+        return False
+    for status, reason in _AZURE_AI_STATUS.findall(getattr(exc, 'pgerror', None) or str(exc)):
+        if status == '429' or reason:
+            return True
+    return False
+
+# Seconds the service asked us to wait, if it said so
+def retry_after_seconds(exc):
+    response = getattr(exc, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
     try:
-        i = 0
-        query = "SELECT c.id,c.extracted_data.gpt_summary_output FROM c WHERE c.extracted_data.gpt_summary_output != ''"
-        source = mydbtsource.get_container_client(arguscollection)
-        result = list( source.query_items(
-            query=query,
-            enable_cross_partition_query=True))
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        if headers.get('retry-after'):
+            return float(headers['retry-after'])
+    except (TypeError, ValueError):
+        pass
+    match = re.search(r'retry after (\d+(?:\.\d+)?) second', str(exc), re.IGNORECASE)
+    return float(match.group(1)) if match else None
 
-        for item in result:
-            summary_output = item.get("gpt_summary_output")
-            file = item.get("id")
-            i = i+1
-     
-                     
-            conn = get_db_connection(dbname,user,password,host,port)
-            cur = conn.cursor()
-            cur.execute('INSERT INTO data (filename, typefile,chuncks)'
-                'VALUES (%s, %s,%s)',
-                (file,"argus",summary_output)
-               )
-       
-            conn.commit()
-            cur.close()
-            conn.close()
+# Client-side scheduler for chat and embedding calls to Azure OpenAI
+class OpenAIScheduler:
+    """Admit Azure OpenAI calls within request-per-minute and token-per-minute budgets.
+
+    Callers block in submit() until their turn: waiting calls are served by
+    priority, then arrival order, so interactive chat overtakes bulk
+    ingestion. Rate limited calls are retried with jittered exponential
+    backoff, honoring Retry-After. Calls submitted with the same key while
+    one is in flight share its result instead of hitting the service again.
+
+    A retried callable runs again from the start, so it must own its
+    transaction: open its own connection, or roll back before raising. A
+    statement that failed on a 429 leaves a shared transaction aborted and
+    every retry on it would fail with InFailedSqlTransaction.
+    """
+
+    def __init__(self, rpm, tpm, max_concurrency, max_retries):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.request_budget = float(rpm)
+        self.token_budget = float(tpm)
+        self.refilled_at = time.monotonic()
+        self.paused_until = 0.0
+        self.running = 0
+        self.waiting = []
+        self.sequence = 0
+        self.inflight = {}
+        self.condition = threading.Condition()
+        self.stats = {'calls': 0, 'coalesced': 0, 'retries': 0, 'rate_limited': 0}
+
+    def _refill(self, now):
+        elapsed = now - self.refilled_at
+        self.refilled_at = now
+        self.request_budget = min(self.rpm, self.request_budget + elapsed * self.rpm / 60.0)
+        self.token_budget = min(self.tpm, self.token_budget + elapsed * self.tpm / 60.0)
+
+    def _acquire(self, priority, tokens):
+        # A single call larger than the whole budget would otherwise wait forever
+        tokens = min(tokens, self.tpm)
+        with self.condition:
+            self.sequence += 1
+            ticket = (priority, self.sequence)
+            heapq.heappush(self.waiting, ticket)
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                wait = 0.5
+                if self.waiting[0] == ticket and self.running < self.max_concurrency:
+                    if now < self.paused_until:
+                        wait = self.paused_until - now
+                    elif self.request_budget >= 1 and self.token_budget >= tokens:
+                        heapq.heappop(self.waiting)
+                        self.request_budget -= 1
+                        self.token_budget -= tokens
+                        self.running += 1
+                        self.condition.notify_all()
+                        return
+                    else:
+                        missing_requests = max(0.0, 1 - self.request_budget) * 60.0 / self.rpm
+                        missing_tokens = max(0.0, tokens - self.token_budget) * 60.0 / self.tpm
+                        wait = max(missing_requests, missing_tokens, 0.01)
+                self.condition.wait(wait)
+
+    def _release(self):
+        with self.condition:
+            self.running -= 1
+            self.condition.notify_all()
+
+    def _run(self, fn, priority, tokens):
+        for attempt in range(self.max_retries + 1):
+            self._acquire(priority, tokens)
+            try:
+                self.stats['calls'] += 1
+                return fn()
+            except Exception as e:
+                if not is_rate_limited(e):
+                    raise
+                self.stats['rate_limited'] += 1
+                delay = retry_after_seconds(e)
+                if delay is None:
+                    delay = min(60.0, 2 ** attempt) * random.uniform(0.5, 1.5)
+                if attempt == self.max_retries:
+                    raise RateLimitedError('Azure OpenAI is rate limiting requests, please retry shortly', delay)
+                self.stats['retries'] += 1
+                # Everybody backs off, not only the caller that got the 429
+                with self.condition:
+                    self.paused_until = max(self.paused_until, time.monotonic() + delay)
+            finally:
+                self._release()
+
+    def submit(self, fn, priority=PRIORITY_INTERACTIVE, tokens=1, key=None):
+        if key is None:
+            return self._run(fn, priority, tokens)
+
+        with self.condition:
+            entry = self.inflight.get(key)
+            leader = entry is None
+            if leader:
+                entry = {'done': threading.Event(), 'result': None, 'error': None}
+                self.inflight[key] = entry
+            else:
+                self.stats['coalesced'] += 1
+
+        if not leader:
+            entry['done'].wait()
+            if entry['error'] is not None:
+                raise entry['error']
+            return entry['result']
+
+        try:
+            entry['result'] = self._run(fn, priority, tokens)
+            return entry['result']
+        except Exception as e:
+            entry['error'] = e
+            raise
+        finally:
+            with self.condition:
+                self.inflight.pop(key, None)
+            entry['done'].set()
+
+# Shared by every request of the process; budgets come from the .env file
+openai_scheduler = OpenAIScheduler(
+    rpm=int(config.get('AOAI_RPM', 300)),
+    tpm=int(config.get('AOAI_TPM', 150000)),
+    max_concurrency=int(config.get('AOAI_MAX_CONCURRENCY', 8)),
+    max_retries=int(config.get('AOAI_MAX_RETRIES', 5))
+)
+
+# Create an Azure OpenAI client, importing the SDK on first use
+def get_openai_client(openai_key, openai_version, openai_endpoint):
+    with import_timer('openai'):
+        from openai import AzureOpenAI
+    return AzureOpenAI(
+        api_key=openai_key,
+        api_version=openai_version,
+        azure_endpoint=openai_endpoint
+    )
 
-       
-    except : 
-        raise  
-    return i 
-    
 # Get a completion from OpenAI
 def get_completion(openai_client, model, prompt: str):    
    
@@ -425,15 +1814,185 @@ def get_completion(openai_client, model, prompt: str):
     
     return response.model_dump()
 
-# Get a database connection
-def get_db_connection(dbname,user,password,host,port):
-    conn = psycopg2.connect(
-        dbname=dbname,
-        user=user,
-        password=password,
-        host=host,
-        port=port)
-    return conn
+# Profiling mode (opt-in): slow retrieval query threshold, share of requests profiled and entries kept for /debug/slow
+PROFILE_ENABLED = str(config.get('PROFILE', '')).lower() in ('1', 'true', 'yes', 'on')
+SLOW_QUERY_MS = float(config.get('SLOW_QUERY_MS', 1000))
+PROFILE_SAMPLE_RATE = float(config.get('PROFILE_SAMPLE_RATE', 0.01))
+PROFILE_KEEP = int(config.get('PROFILE_KEEP', 50))
+
+# Slow retrieval queries with their plans, and sampled request profiles, newest first
+slow_queries = deque(maxlen=PROFILE_KEEP)
+request_profiles = deque(maxlen=PROFILE_KEEP)
+
+# The request being served by this thread, and its profiler when it was sampled
+_profile_local = threading.local()
+# cProfile cannot run in two threads at once
+_profiler_lock = threading.Lock()
+
+# Run a retrieval or cache lookup query; in profiling mode, capture the plan of slow ones
+def execute_profiled(cur, query, params, label):
+    """Execute query on cur; when it takes SLOW_QUERY_MS or more, record its EXPLAIN plan.
+
+    The plan is taken on a second cursor of the same transaction (same SET
+    LOCAL search parameters), inside a savepoint so a failing EXPLAIN leaves
+    the transaction usable. EXPLAIN without ANALYZE does not run the query, so
+    the question is not embedded a second time. Only the SQL text is kept, not
+    the bound parameters (questions, usernames, filenames).
+    """
+    if not PROFILE_ENABLED:
+        cur.execute(query, params)
+        return
+    start = time.perf_counter()
+    cur.execute(query, params)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    if elapsed_ms < SLOW_QUERY_MS:
+        return
+
+    entry = {'at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), 'label': label, 'ms': round(elapsed_ms, 1),
+             'sql': query, 'request': getattr(_profile_local, 'request', None)}
+    explain = cur.connection.cursor()
+    try:
+        explain.execute('SAVEPOINT slow_query_explain')
+        explain.execute('EXPLAIN ' + query, params)
+        entry['plan'] = '\n'.join(row[0] for row in explain.fetchall())
+        explain.execute('RELEASE SAVEPOINT slow_query_explain')
+    except psycopg2.Error as e:
+        explain.execute('ROLLBACK TO SAVEPOINT slow_query_explain')
+        entry['plan_error'] = str(e).strip()
+    finally:
+        explain.close()
+    slow_queries.appendleft(entry)
+    log_event(logging.WARNING, 'slow query', label=label, ms=entry['ms'], request=entry['request'])
+
+@app.before_request
+def start_request_profile():
+    if not PROFILE_ENABLED:
+        return
+    _profile_local.request = {'method': request.method, 'path': request.path, 'user': session.get('username'),
+                              'tenant': session.get('tenant')}
+    _profile_local.started = time.perf_counter()
+    _profile_local.profiler = None
+    if request.path.startswith(('/static', '/debug')) or random.random() >= PROFILE_SAMPLE_RATE:
+        return
+    if _profiler_lock.acquire(blocking=False):
+        with import_timer('profiling'):
+            import cProfile
+        _profile_local.profiler = cProfile.Profile()
+        _profile_local.profiler.enable()
+
+@app.teardown_request
+def finish_request_profile(exc):
+    profiler = getattr(_profile_local, 'profiler', None)
+    if profiler is None:
+        return
+    profiler.disable()
+    _profile_local.profiler = None
+    _profiler_lock.release()
+    with import_timer('profiling'):
+        import pstats
+    stream = io.StringIO()
+    pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(40)
+    request_profiles.appendleft({'at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                                 'request': _profile_local.request,
+                                 'ms': round((time.perf_counter() - _profile_local.started) * 1000, 1),
+                                 'error': str(exc) if exc else None, 'stats': stream.getvalue()})
+
+# Get a database connection
+def get_db_connection(dbname,user,password,host,port):
+    conn = psycopg2.connect(
+        dbname=dbname,
+        user=user,
+        password=password,
+        host=host,
+        port=port)
+    return conn
+
+# Read replicas as host[:port], comma separated; without any every query goes to the primary
+PG_REPLICAS = [replica.strip() for replica in str(config.get('PG_REPLICAS', '') or '').split(',') if replica.strip()]
+REPLICA_MAX_LAG_SECONDS = float(config.get('REPLICA_MAX_LAG_SECONDS', 5))
+REPLICA_CHECK_INTERVAL = float(config.get('REPLICA_CHECK_INTERVAL', 10))
+REPLICA_CONNECT_TIMEOUT = int(config.get('REPLICA_CONNECT_TIMEOUT', 2))
+
+# Last health check of each replica, and the round-robin position
+_replica_state = {}
+_replica_lock = threading.Lock()
+_replica_turn = [0]
+
+# Split a replica entry into host and port, defaulting to the primary's port
+def replica_address(replica, port):
+    host, _, replica_port = replica.partition(':')
+    return host, replica_port or port
+
+# Check (at most every REPLICA_CHECK_INTERVAL seconds) that a replica is up and not lagging
+def replica_health(replica, dbname, user, password, port):
+    """Return the replica's state, refreshing it when it is older than the check interval.
+
+    A replica is healthy when it is in recovery, its WAL receiver is streaming
+    and its lag is within REPLICA_MAX_LAG_SECONDS. The lag is the age of the
+    last replayed transaction, or 0 when a streaming replica has replayed all
+    it received (an idle primary does not look like lag); a disconnected
+    replica has nothing left to replay but is stale, so it is not healthy.
+    Without pg_read_all_stats the receiver status reads as NULL, and a running
+    receiver is then taken as streaming.
+    """
+    with _replica_lock:
+        state = _replica_state.setdefault(replica, {'healthy': False, 'lag': None, 'checked': 0.0, 'error': None, 'reads': 0})
+        if time.time() - state['checked'] < REPLICA_CHECK_INTERVAL:
+            return state
+        state['checked'] = time.time()
+
+    host, replica_port = replica_address(replica, port)
+    try:
+        conn = psycopg2.connect(dbname=dbname, user=user, password=password, host=host, port=replica_port,
+                                connect_timeout=REPLICA_CONNECT_TIMEOUT)
+        cur = conn.cursor()
+        cur.execute('''SELECT pg_is_in_recovery(), w.pid IS NOT NULL, w.status,
+                              pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn(),
+                              EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+                       FROM (SELECT 1) one LEFT JOIN pg_stat_wal_receiver w ON true''')
+        in_recovery, receiving, receiver_status, caught_up, replay_age = cur.fetchone()
+        cur.close()
+        conn.close()
+        streaming = receiver_status == 'streaming' or (receiver_status is None and receiving)
+        lag = 0.0 if streaming and caught_up else (float(replay_age) if replay_age is not None else None)
+        state.update({'healthy': bool(in_recovery) and streaming and lag is not None and lag <= REPLICA_MAX_LAG_SECONDS,
+                      'lag': None if lag is None else round(lag, 3), 'in_recovery': in_recovery,
+                      'receiver_status': receiver_status, 'error': None})
+    except psycopg2.Error as e:
+        state.update({'healthy': False, 'lag': None, 'error': str(e).strip()})
+    return state
+
+# Open a read-only connection on a healthy replica, or on the primary when none is available
+def get_read_connection(dbname,user,password,host,port):
+    """Connection for retrieval and cache probes, which can read slightly stale data.
+
+    Replicas are used in turn; unhealthy or lagging ones are skipped until
+    their next check. Writes must keep using get_db_connection.
+    """
+    if not PG_REPLICAS:
+        return get_db_connection(dbname, user, password, host, port)
+    with _replica_lock:
+        start = _replica_turn[0] % len(PG_REPLICAS)
+        _replica_turn[0] += 1
+    for replica in PG_REPLICAS[start:] + PG_REPLICAS[:start]:
+        state = replica_health(replica, dbname, user, password, port)
+        if not state['healthy']:
+            continue
+        replica_host, replica_port = replica_address(replica, port)
+        try:
+            conn = psycopg2.connect(dbname=dbname, user=user, password=password, host=replica_host, port=replica_port,
+                                    connect_timeout=REPLICA_CONNECT_TIMEOUT)
+        except psycopg2.OperationalError as e:
+            state.update({'healthy': False, 'error': str(e).strip()})
+            continue
+        conn.set_session(readonly=True)
+        state['reads'] += 1
+        return conn
+    return get_db_connection(dbname, user, password, host, port)
+
+# True when the logged-in user is listed in ADMIN_USERS
+def is_admin():
+    return bool(session.get('logged_in')) and session.get('username') in ADMIN_USERS
 
 # Authenticate a user
 def authenticate(username):
@@ -441,7 +2000,7 @@ def authenticate(username):
     return username 
     
 # Generate a completion with OpenAI and enrich with database data
-def generatecompletionede(openai_client,system_prompt,user_prompt ,username,dbname,user,password,host,port,openai_embeddings_model, openai_chat_model,typesearch) -> str:
+def generatecompletionede(openai_client,system_prompt,user_prompt ,username,dbname,user,password,host,port,openai_embeddings_model, openai_chat_model,typesearch, tenant=DEFAULT_TENANT, language=DEFAULT_LANGUAGE, search_params=None, filenames=None, corpus_version=None) -> str:
     
  
 
@@ -452,137 +2011,1002 @@ def generatecompletionede(openai_client,system_prompt,user_prompt ,username,dbna
     #user prompt
     messages.append({'role': 'user', 'content': user_prompt})
     
-    vector_search_results =  ask_dbvector(user_prompt,dbname,user,password,host,port,openai_embeddings_model,typesearch )
+    vector_search_results, sources, citations =  openai_scheduler.submit(
+        lambda: ask_dbvector(user_prompt,dbname,user,password,host,port,openai_embeddings_model,typesearch, tenant, language, search_params,
+                             filenames, corpus_version),
+        PRIORITY_INTERACTIVE, estimate_tokens(user_prompt))
     
     for result in vector_search_results:
      
         messages.append({'role': 'system', 'content': result})
     
-    response = get_completion(openai_client, openai_chat_model, messages)
+    # Identical prompts in flight at the same time share one upstream call. The key is the
+    # rendered messages, so it only holds the username when the system prompt uses {username}
+    completion_key = hashlib.sha256(json.dumps([openai_chat_model, messages]).encode('utf-8')).hexdigest()
+    response = dict(openai_scheduler.submit(
+        lambda: get_completion(openai_client, openai_chat_model, messages),
+        PRIORITY_INTERACTIVE, estimate_tokens(messages), key=completion_key))
+    # Files the answer was built from, so the cache entry can be invalidated per file
+    response['sources'] = sources
+    # Chunks (id, locator, score) the answer was built from, for the citation UI
+    response['citations'] = citations
 
     return response
 
 # Cache a response in the database
-def cacheresponse(user_prompt,  response , name,dbname,user,password,host,port):
+def cacheresponse(user_prompt,  response , name,dbname,user,password,host,port, tenant=DEFAULT_TENANT, typesearch='vector', chat_model='', cache_context=None, conn=None, prompt_vector=None):
 
+    cache_context = cache_context or {}
     
-        
-    conn = get_db_connection(dbname,user,password,host,port)
+    # A pooled connection is left open; a prompt_vector spares the trigger's embedding call
+    own_connection = conn is None
+    conn = conn or get_db_connection(dbname,user,password,host,port)
     cur = conn.cursor()
-    cur.execute('INSERT INTO tablecahedoc (prompt, completion, completiontokens, promptTokens,totalTokens, model,usname)'
-                    'VALUES (%s, %s, %s, %s ,%s, %s,%s)',
-                    (user_prompt, response['choices'][0]['message']['content'], response['usage']['completion_tokens'], response['usage']['prompt_tokens'],response['usage']['total_tokens'], response['model'] ,name))
+    embedding_sql, embedding = query_embedding_sql(user_prompt, prompt_vector)
+    cur.execute('INSERT INTO tablecahedoc (tenant, prompt, completion, completiontokens, promptTokens,totalTokens, model,usname,'
+                    ' searchtype, prompt_id, chatmodel, corpus_version, sourcefiles, citations, dvector)'
+                    'VALUES (%s, %s, %s, %s, %s ,%s, %s,%s, %s, %s, %s, %s, %s, %s::jsonb, ' + ('NULL' if prompt_vector is None else embedding_sql) + ')',
+                    (tenant, user_prompt, response['choices'][0]['message']['content'], response['usage']['completion_tokens'], response['usage']['prompt_tokens'],response['usage']['total_tokens'], response['model'] ,name,
+                     typesearch, cache_context.get('prompt_id', 0), chat_model, cache_context.get('corpus_version', 0), list(response.get('sources', [])),
+                     json.dumps(response.get('citations', [])))
+                    + (() if prompt_vector is None else (embedding,)))
     
 
 
   
     conn.commit()
     cur.close()
-    conn.close()
+    if own_connection:
+        conn.close()
 
-# Search the cache for a similar query
-def cachesearch(test,name,dbname,user,password,host,port,openai_embeddings_model):
-    conn = get_db_connection(dbname,user,password,host,port)
-    cur = conn.cursor()
-    
-    print('userprompt cherche cache')
-    print (test)
-   
-    query = """SELECT e.completion
-    FROM tablecahedoc e  
-    WHERE e.usname = %s 
-    AND e.dvector <=> azure_openai.create_embeddings(%s, %s)::vector < 0.07  
-    ORDER BY e.dvector <=> azure_openai.create_embeddings(%s, %s)::vector  
+# Find a cached completion for a similar question within the user's cache scope
+def cache_lookup(cur, test, name, tenant=DEFAULT_TENANT, typesearch='vector', chat_model='', cache_context=None, query_vector=None):
+    cache_context = cache_context or {}
+    threshold = cache_context.get('threshold', DEFAULT_CACHE_THRESHOLD)
+    cte, cte_params, embedding_sql = query_embedding_cte(test, query_vector)
+
+    scope = (name, typesearch, cache_context.get('prompt_id', 0), chat_model, cache_context.get('corpus_version', 0))
+    set_search_params(cur, 'tablecahedoc', tenant)
+    source, source_params = vector_source_sql(cur, 'tablecahedoc', tenant, None, 1,
+                                              ' AND usname = %s AND searchtype = %s AND prompt_id = %s AND chatmodel = %s AND corpus_version = %s',
+                                              scope, embedding_sql)
+    query = cte + """SELECT e.completion, e.citations
+    FROM """ + source + """ e
+    WHERE e.tenant = %s
+    AND e.usname = %s
+    AND e.searchtype = %s
+    AND e.prompt_id = %s
+    AND e.chatmodel = %s
+    AND e.corpus_version = %s
+    AND e.dvector <=> """ + embedding_sql + """ < %s
+    ORDER BY e.dvector <=> """ + embedding_sql + """
     LIMIT 1;"""
-   
-    cur.execute(query, (name, openai_embeddings_model, test, openai_embeddings_model, test))
-    resutls = cur.fetchall()
-   
 
-  
+    execute_profiled(cur, query, cte_params + source_params + [tenant] + list(scope) + [threshold], 'cache lookup')
+    return cur.fetchall()
+
+# Find a cached completion for the very same question, without embedding it
+def exact_cache_lookup(cur, test, name, tenant=DEFAULT_TENANT, typesearch='vector', chat_model='', cache_context=None):
+    cache_context = cache_context or {}
+    query = """SELECT e.completion, e.citations
+    FROM tablecahedoc e
+    WHERE e.tenant = %s
+    AND e.usname = %s
+    AND md5(e.prompt) = md5(%s)
+    AND e.prompt = %s
+    AND e.searchtype = %s
+    AND e.prompt_id = %s
+    AND e.chatmodel = %s
+    AND e.corpus_version = %s
+    ORDER BY e.id DESC
+    LIMIT 1;"""
+    execute_profiled(cur, query, (tenant, name, test, test, typesearch, cache_context.get('prompt_id', 0), chat_model,
+                                  cache_context.get('corpus_version', 0)), 'exact cache lookup')
+    return cur.fetchall()
+
+# Search the cache for a similar query, or (exact) for the same one without calling the embedding model
+def cachesearch(test,name,dbname,user,password,host,port,openai_embeddings_model, tenant=DEFAULT_TENANT, typesearch='vector', chat_model='', cache_context=None, exact=False):
+    conn = get_read_connection(dbname,user,password,host,port)
+    # Closed even when the lookup raises, e.g. a rate-limited embedding retried by the scheduler
+    try:
+        cur = conn.cursor()
+
+        log_event(logging.DEBUG, 'cache lookup', user=name, tenant=tenant, prompt=test, exact=exact)
+
+        if exact:
+            resutls = exact_cache_lookup(cur, test, name, tenant, typesearch, chat_model, cache_context)
+        else:
+            resutls = cache_lookup(cur, test, name, tenant, typesearch, chat_model, cache_context)
+        cur.close()
+    finally:
+        conn.close()
+
     return resutls
+
+# Reranking settings, read from the .env file (disabled unless RERANK is set)
+RERANK_ENABLED = str(config.get('RERANK', '')).lower() in ('1', 'true', 'yes', 'on')
+RERANK_MODE = config.get('RERANK_MODE', 'bm25')  # 'bm25' or 'cross-encoder'
+RERANK_MODEL = config.get('RERANK_MODEL', 'cross-encoder/ms-marco-MiniLM-L-6-v2')
+RERANK_CANDIDATES = int(config.get('RERANK_CANDIDATES', 50))
+RERANK_TOP_K = int(config.get('RERANK_TOP_K', 3))
+RERANK_BATCH_SIZE = int(config.get('RERANK_BATCH_SIZE', 16))
+RERANK_BUDGET_MS = float(config.get('RERANK_BUDGET_MS', 150))
+
+# Cross-encoder loaded on first use, shared by all requests of the process
+_cross_encoder = None
+
+# Format a retrieved (chunk, filename) row as a context message for the LLM, the filename kept as is
+def format_chunk(row):
+    chars = re.escape(string.punctuation)
+    return 'Source: ' + str(row[1]) + '\n' + re.sub('['+chars+']', '', str(row[0]))
+
+# Provenance of a retrieved (id, chunk, filename, distance, locator) row and its 1-based rank, returned with the answer
+def chunk_citation(row, rank):
+    """similarity is 1 - cosine distance whatever the search path, or None for a
+    chunk only matched by full-text search; rank is its position in the context."""
+    return {'id': row[0], 'filename': row[2], 'locator': row[4] or {},
+            'similarity': None if row[3] is None else round(1 - float(row[3]), 4), 'rank': rank}
+
+# Split text into lowercase word tokens for lexical scoring
+def tokenize(text):
+    return re.findall(r'\w+', str(text).lower())
+
+# Score candidates against the query with BM25, using the candidates as the corpus
+def bm25_scores(query, texts, k1=1.5, b=0.75):
+    docs = [tokenize(t) for t in texts]
+    if not docs:
+        return []
+    avgdl = sum(len(d) for d in docs) / len(docs) or 1
+    df = {}
+    for d in docs:
+        for term in set(d):
+            df[term] = df.get(term, 0) + 1
+    n = len(docs)
+    scores = []
+    for d in docs:
+        tf = {}
+        for term in d:
+            tf[term] = tf.get(term, 0) + 1
+        score = 0.0
+        for term in set(tokenize(query)):
+            if term not in tf:
+                continue
+            idf = math.log(1 + (n - df[term] + 0.5) / (df[term] + 0.5))
+            score += idf * tf[term] * (k1 + 1) / (tf[term] + k1 * (1 - b + b * len(d) / avgdl))
+        scores.append(score)
+    return scores
+
+# Load the local cross-encoder, or None when sentence-transformers is not installed
+def get_cross_encoder():
+    global _cross_encoder
+    if _cross_encoder is None:
+        try:
+            with import_timer('rerank'):
+                from sentence_transformers import CrossEncoder
+            _cross_encoder = CrossEncoder(RERANK_MODEL, device='cpu')
+        except Exception as e:
+            log_event(logging.WARNING, 'cross-encoder unavailable, falling back to BM25', error=str(e))
+            _cross_encoder = False
+    return _cross_encoder or None
+
+# Rerank candidate rows in batches, stopping when the latency budget is spent
+def rerank(query, rows, top_k=RERANK_TOP_K, budget_ms=RERANK_BUDGET_MS, batch_size=RERANK_BATCH_SIZE, mode=None):
+    """Return the top_k rows ordered by reranker score.
+
+    rows must already be in first-stage order: when the budget runs out the
+    rows that were not scored keep that order, after the scored ones.
+    """
+    start = time.perf_counter()
+    model = get_cross_encoder() if (mode or RERANK_MODE) == 'cross-encoder' else None
+    scored = []
+    for i in range(0, len(rows), batch_size):
+        batch = rows[i:i + batch_size]
+        if model is not None:
+            scores = model.predict([(query, row[1]) for row in batch])
+        else:
+            # BM25 is cheap enough to score all candidates at once
+            batch = rows[i:]
+            scores = bm25_scores(query, [row[1] for row in batch])
+        scored.extend(zip(scores, batch))
+        if (time.perf_counter() - start) * 1000 > budget_ms or model is None:
+            break
+    scored.sort(key=lambda item: item[0], reverse=True)
+    ranked = [row for _, row in scored] + rows[len(scored):]
+    return ranked[:top_k]
+
+# Map a requested language onto a supported text search configuration
+def text_search_language(language):
+    language = str(language or '').lower()
+    return language if language in SUPPORTED_LANGUAGES else DEFAULT_LANGUAGE
+
+# Build the tsquery expression for raw user text, never raising on punctuation
+def tsquery_sql(textuser, language=DEFAULT_LANGUAGE):
+    """Return an SQL tsquery expression and its parameters.
+
+    Questions using web search syntax (quotes, OR, -word) go through
+    websearch_to_tsquery. Plain questions are parsed with plainto_tsquery and
+    their terms OR-ed, so a chunk does not need every word to match; the
+    ranking still favours chunks matching more of them.
+    """
+    language = text_search_language(language)
+    if re.search(r'"|\bor\b|(^|\s)-\w', textuser, re.IGNORECASE):
+        return "websearch_to_tsquery(%s::regconfig, %s)", [language, textuser]
+    # The lexemes are already normalized, so re-parse them with the 'simple' configuration
+    return "to_tsquery('simple', replace(plainto_tsquery(%s::regconfig, %s)::text, ' & ', ' | '))", [language, textuser]
+
+# Retrieval results kept per process, and for how long
+RETRIEVAL_CACHE_SIZE = int(config.get('RETRIEVAL_CACHE_SIZE', 1000))
+RETRIEVAL_CACHE_TTL = float(config.get('RETRIEVAL_CACHE_TTL', 600))
+
+# Chunks returned by each search type when reranking is off
+RETRIEVAL_K = {'vector': 3, 'full text': 2, 'hybrid': 1}
+
+# Cosine distance above which a chunk is not considered related to the question
+VECTOR_MAX_DISTANCE = float(config.get('VECTOR_MAX_DISTANCE', 0.25))
+
+# LRU cache of retrieval results (chunk ids, scores and rows) with a time to live
+class RetrievalCache:
+    """Entries are keyed by the normalized query, search settings, filters and
+    corpus version. A corpus change makes every older key unreachable; the
+    entries restricted to files that did not change are carried over to the
+    new version, like the cached completions.
+    """
+    def __init__(self, max_entries=RETRIEVAL_CACHE_SIZE, ttl=RETRIEVAL_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or time.time() - entry[0] > self.ttl:
+                if entry is not None:
+                    del self.entries[key]
+                self.stats['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry[1]
+
+    def put(self, key, value):
+        if self.max_entries <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (time.time(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def invalidate(self, tenant, filenames, new_version):
+        """Drop the tenant's entries the changed files can affect and move the others to new_version."""
+        tenant = tenant_key(tenant)
+        changed = set(filenames)
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == tenant]:
+                stamp, value = self.entries.pop(key)
+                filters = key[5]
+                if filters is None or changed & set(filters):
+                    self.stats['invalidations'] += 1
+                    continue
+                self.entries[key[:-1] + (new_version,)] = (stamp, value)
+
+    def clear(self, tenant=None):
+        with self.lock:
+            for key in [key for key in self.entries if tenant is None or key[0] == tenant_key(tenant)]:
+                del self.entries[key]
+
+# Retrieval results shared by the requests of this process
+retrieval_cache = RetrievalCache()
+
+# Source snippets of recently retrieved chunks, served by /chunk/<id>
+CHUNK_CACHE_SIZE = int(config.get('CHUNK_CACHE_SIZE', 2000))
+CHUNK_CACHE_TTL = float(config.get('CHUNK_CACHE_TTL', 3600))
+chunk_cache = RetrievalCache(CHUNK_CACHE_SIZE, CHUNK_CACHE_TTL)
+
+# Keep the retrieved chunks in chunk_cache, so citations can be shown without querying PostgreSQL
+def remember_chunks(tenant, citations, rows):
+    for citation, row in zip(citations, rows):
+        chunk_cache.put((tenant_key(tenant), citation['id']), dict(citation, text=row[0]))
+
+# Key of a retrieval in retrieval_cache
+def retrieval_cache_key(textuser, typesearch, tenant, language, search_params, filenames, corpus_version):
+    normalized = ' '.join(str(textuser).lower().split())
+    k = RERANK_TOP_K if RERANK_ENABLED else RETRIEVAL_K.get(typesearch, 0)
+    return (tenant_key(tenant), normalized, typesearch, k, language,
+            tuple(sorted(filenames)) if filenames else None,
+            json.dumps(search_params, sort_keys=True) if search_params else None,
+            corpus_version)
+
+# SQL condition (and parameters) restricting a search to some files
+def filenames_sql(alias, filenames):
+    if not filenames:
+        return '', []
+    return ' AND ' + alias + '.filename = ANY(%s)', [list(filenames)]
+
+# SQL embedding the question in the database, or casting a vector computed beforehand
+def query_embedding_sql(textuser, query_vector=None):
+    if query_vector is None:
+        return 'query_embedding(%s)', textuser
+    return '%s::vector', '[' + ','.join(str(float(value)) for value in query_vector) + ']'
+
+# CTE embedding the question once per statement, and the expression reading it
+def query_embedding_cte(textuser, query_vector=None):
+    """Return (cte, params, expression) for a vector query.
+
+    MATERIALIZED keeps PostgreSQL from inlining the CTE at each reference,
+    which would call the embedding endpoint once per use. The expression is a
+    scalar subquery, evaluated once as an InitPlan, so the vector index can
+    still serve the ORDER BY.
+    """
+    embedding_sql, embedding = query_embedding_sql(textuser, query_vector)
+    return 'WITH qv AS MATERIALIZED (SELECT ' + embedding_sql + ' AS v) ', [embedding], '(SELECT v FROM qv)'
+
+# Over-fetch candidates from vector and full-text search and fuse their rankings
+def fetch_candidates(cur, textuser, openai_embeddings_model, typesearch, tenant, limit=RERANK_CANDIDATES, language=DEFAULT_LANGUAGE, search_params=None, filenames=None, max_distance=None, query_vector=None):
+    ranked_lists = []
+    if typesearch in ("vector", "hybrid"):
+        cte, cte_params, embedding_sql = query_embedding_cte(textuser, query_vector)
+        set_search_params(cur, 'data', tenant, search_params)
+        file_filter, file_params = filenames_sql('e', filenames)
+        source, source_params = vector_source_sql(cur, 'data', tenant, None, limit,
+                                                  file_filter.replace('e.', ''), file_params, embedding_sql)
+        execute_profiled(cur, cte + """SELECT e.id, e.chuncks, e.filename, e.dvector <=> """ + embedding_sql + """ AS distance, e.locator
+        FROM """ + source + """ e
+        WHERE e.tenant = %s""" + file_filter + """
+        AND e.dvector <=> """ + embedding_sql + """ < %s
+        ORDER BY distance
+        LIMIT %s""", cte_params + source_params + [tenant] + file_params
+                    + [VECTOR_MAX_DISTANCE if max_distance is None else max_distance, limit], 'vector candidates')
+        ranked_lists.append(cur.fetchall())
+    if typesearch in ("full text", "hybrid"):
+        tsquery, tsparams = tsquery_sql(textuser, language)
+        file_filter, file_params = filenames_sql('d', filenames)
+        execute_profiled(cur, """SELECT d.id, d.chuncks, d.filename, NULL::float8 AS distance, d.locator
+        FROM data d, """ + tsquery + """ AS q
+        WHERE d.tenant = %s""" + file_filter + """
+        AND d.tsv @@ q
+        ORDER BY ts_rank_cd(d.tsv, q) DESC
+        LIMIT %s""", tsparams + [tenant] + file_params + [limit], 'full text candidates')
+        ranked_lists.append(cur.fetchall())
+
+    # Reciprocal rank fusion gives the order used when the reranker runs out of budget;
+    # a chunk found by both searches keeps the vector row, which carries its distance
+    fused = {}
+    for ranked in ranked_lists:
+        for rank, row in enumerate(ranked):
+            score, _ = fused.get(row[0], (0.0, row))
+            fused[row[0]] = (score + 1.0 / (60 + rank), row)
+    return [row for _, row in sorted(fused.values(), key=lambda item: item[0], reverse=True)]
+
+# Current corpus version of a tenant
+def get_corpus_version(cur, tenant):
+    cur.execute('SELECT corpus_version FROM tenants WHERE tenant = %s', (tenant_key(tenant),))
+    row = cur.fetchone()
+    return row[0] if row else 0
+
+# Run one search and return its ranked (id, chunk, filename, distance, locator) rows
+def retrieve(cur, textuser, typesearch, tenant=DEFAULT_TENANT, language=DEFAULT_LANGUAGE, search_params=None, filenames=None,
+             k=None, max_distance=None, rerank_mode=None, query_vector=None):
+    """Search the tenant's chunks without going through retrieval_cache.
+
+    k, max_distance and rerank_mode ('off', 'bm25' or 'cross-encoder')
+    default to the configured values; the evaluation harness sweeps them.
+    query_vector is the question's embedding when it was computed beforehand.
+    distance is the cosine distance to the question, None for full-text matches.
+    """
+    cte, cte_params, embedding_sql = query_embedding_cte(textuser, query_vector)
+    k = k or (RERANK_TOP_K if RERANK_ENABLED else RETRIEVAL_K.get(typesearch, 0))
+    max_distance = VECTOR_MAX_DISTANCE if max_distance is None else max_distance
+    if rerank_mode is None:
+        rerank_mode = RERANK_MODE if RERANK_ENABLED else 'off'
+    rows = []
+    if rerank_mode != 'off':
+        candidates = fetch_candidates(cur, textuser, None, typesearch, tenant, language=language,
+                                      search_params=search_params, filenames=filenames, max_distance=max_distance,
+                                      query_vector=query_vector)
+        rows = rerank(textuser, candidates, top_k=k, mode=rerank_mode)
+        log_event(logging.DEBUG, 'reranked candidates', candidates=len(candidates), kept=len(rows), mode=rerank_mode)
+
+    elif  typesearch == "vector":
     
-# Query the database using vector or full-text search
-def  ask_dbvector(textuser,dbname,user,password,host,port,openai_embeddings_model,typesearch):
-    
-    conn = get_db_connection(dbname,user,password,host,port)
-    cur = conn.cursor()
-    print('userprompt')
-    print (textuser)
-    if  typesearch == "vector":
-    
-        query = """SELECT
-        e.chuncks , e.filename
-        FROM data e 
-        WHERE e.dvector <=> azure_openai.create_embeddings(%s, %s)::vector < 0.25  
-        ORDER BY e.dvector <=> azure_openai.create_embeddings(%s, %s)::vector  
-        LIMIT 3;"""
-        cur.execute(query, (openai_embeddings_model, textuser, openai_embeddings_model, textuser))
-        resutls = str(cur.fetchall())               
-        chars = re.escape(string.punctuation)
-        res = re.sub('['+chars+']', '',resutls)                        
+        set_search_params(cur, 'data', tenant, search_params)
+        file_filter, file_params = filenames_sql('e', filenames)
+        source, source_params = vector_source_sql(cur, 'data', tenant, None, k, file_filter.replace('e.', ''), file_params, embedding_sql)
+        query = cte + """SELECT
+        e.id, e.chuncks , e.filename, e.dvector <=> """ + embedding_sql + """ AS distance, e.locator
+        FROM """ + source + """ e 
+        WHERE e.tenant = %s""" + file_filter + """
+        AND e.dvector <=> """ + embedding_sql + """ < %s  
+        ORDER BY distance  
+        LIMIT %s;"""
+        execute_profiled(cur, query, cte_params + source_params + [tenant] + file_params + [max_distance, k], 'vector retrieval')
+        rows = cur.fetchall()
         
     elif  typesearch == "full text":
         
         
-        textuser_escaped = textuser.replace(" ","&").replace("'", "''")
-        print(textuser_escaped)
+        tsquery, tsparams = tsquery_sql(textuser, language)
+        file_filter, file_params = filenames_sql('d', filenames)
         
         query = """
-        SELECT chuncks , filename 
-        FROM data 
-        WHERE to_tsvector('english',chuncks ) @@ to_tsquery(%s)
-        ORDER BY ts_rank_cd(to_tsvector('english', chuncks), to_tsquery(%s)) DESC
-        LIMIT 2
+        SELECT d.id, d.chuncks , d.filename, NULL::float8 AS distance, d.locator
+        FROM data d, """ + tsquery + """ AS q
+        WHERE d.tenant = %s""" + file_filter + """
+        AND d.tsv @@ q
+        ORDER BY ts_rank_cd(d.tsv, q) DESC
+        LIMIT %s
         """
-        cur.execute(query, (textuser_escaped, textuser_escaped))
-        resutls = str(cur.fetchall())               
-        chars = re.escape(string.punctuation)
-        res = re.sub('['+chars+']', '',resutls)   
-        print("fulltext_query")
-        print(res)
+        execute_profiled(cur, query, tsparams + [tenant] + file_params + [k], 'full text retrieval')
+        rows = cur.fetchall()
+        if logger.isEnabledFor(logging.DEBUG):
+            log_event(logging.DEBUG, 'full text retrieval', ids=[row[0] for row in rows], chunks=[format_chunk(row[1:3]) for row in rows])
         
         
         
     elif  typesearch == "hybrid": 
         
-        textuser2 = textuser.replace(" ","&").replace("'", "''")
-        hybrid_query = """SELECT
-        e.chuncks , e.filename
-        FROM data e 
-        WHERE (e.dvector <=> azure_openai.create_embeddings(%s, %s)::vector < 0.25) 
-           OR (to_tsvector('english',chuncks ) @@ to_tsquery(%s))
-        ORDER BY e.dvector <=> azure_openai.create_embeddings(%s, %s)::vector  
-        LIMIT 1;
+        # Union of the nearest chunks (rescored like a vector search) and the full-text matches, ordered by distance
+        tsquery, tsparams = tsquery_sql(textuser, language)
+        vector_filter, vector_params = filenames_sql('x', filenames)
+        text_filter, text_params = filenames_sql('d', filenames)
+        set_search_params(cur, 'data', tenant, search_params)
+        text_limit = max(k, VECTOR_RESCORE_CANDIDATES)
+        source, source_params = vector_source_sql(cur, 'data', tenant, None, k, vector_filter.replace('x.', ''), vector_params, embedding_sql)
+        hybrid_query = cte + """SELECT
+        e.id, e.chuncks , e.filename, e.dvector <=> """ + embedding_sql + """ AS distance, e.locator
+        FROM data e
+        WHERE e.tenant = %s
+        AND e.id IN ((SELECT x.id FROM """ + source + """ x
+                      WHERE x.tenant = %s""" + vector_filter + """
+                      AND x.dvector <=> """ + embedding_sql + """ < %s
+                      ORDER BY x.dvector <=> """ + embedding_sql + """
+                      LIMIT %s)
+                     UNION
+                     (SELECT d.id FROM data d, """ + tsquery + """ AS t
+                      WHERE d.tenant = %s""" + text_filter + """
+                      AND d.tsv @@ t
+                      ORDER BY ts_rank_cd(d.tsv, t) DESC
+                      LIMIT %s))
+        ORDER BY distance
+        LIMIT %s;
         """
-               
-        cur.execute(hybrid_query, (openai_embeddings_model, textuser, textuser2, openai_embeddings_model, textuser))
-        resutls = str(cur.fetchall())               
-        chars = re.escape(string.punctuation)
-        res = re.sub('['+chars+']', '',resutls)   
-        print("hybrid_query")
-        print(res)
-        
-        
-        
-        
-    return res
+        execute_profiled(cur, hybrid_query, cte_params + [tenant] + source_params + [tenant] + vector_params + [max_distance, k]
+                         + tsparams + [tenant] + text_params + [text_limit, k], 'hybrid retrieval')
+        rows = cur.fetchall()
+        if logger.isEnabledFor(logging.DEBUG):
+            log_event(logging.DEBUG, 'hybrid retrieval', ids=[row[0] for row in rows], chunks=[format_chunk(row[1:3]) for row in rows])
+    
+    return rows
+
+# Query the database using vector or full-text search
+def  ask_dbvector(textuser,dbname,user,password,host,port,openai_embeddings_model,typesearch, tenant=DEFAULT_TENANT, language=DEFAULT_LANGUAGE, search_params=None, filenames=None, corpus_version=None):
+    """Return the context chunks for a question, the files they come from and their citations.
+
+    Results (chunk ids, distances and rows) are cached in retrieval_cache for the
+    tenant's corpus version; filenames restricts the search to those files.
+    """
+    conn = None
+    # Closed even when retrieval raises, e.g. a rate-limited embedding retried by the scheduler
+    try:
+        if corpus_version is None:
+            conn = get_read_connection(dbname,user,password,host,port)
+            corpus_version = get_corpus_version(conn.cursor(), tenant)
+        key = retrieval_cache_key(textuser, typesearch, tenant, language, search_params, filenames, corpus_version)
+        cached = retrieval_cache.get(key)
+        if cached is None:
+            conn = conn or get_read_connection(dbname,user,password,host,port)
+            cur = conn.cursor()
+            log_event(logging.DEBUG, 'retrieval', tenant=tenant, search_type=typesearch, prompt=textuser)
+            rows = retrieve(cur, textuser, typesearch, tenant, language, search_params, filenames)
+            cur.close()
+    finally:
+        if conn:
+            conn.close()
+    if cached is not None:
+        remember_chunks(tenant, cached['citations'], cached['rows'])
+        return [format_chunk(row) for row in cached['rows']], cached['sources'], cached['citations']
+    result = {'ids': [row[0] for row in rows], 'distances': [None if row[3] is None else float(row[3]) for row in rows],
+              'rows': [(row[1], row[2]) for row in rows], 'sources': sorted({row[2] for row in rows}),
+              'citations': [chunk_citation(row, rank) for rank, row in enumerate(rows, 1)]}
+    retrieval_cache.put(key, result)
+    remember_chunks(tenant, result['citations'], result['rows'])
+    res = [format_chunk(row) for row in result['rows']]
+    return res, result['sources'], result['citations']
 
 # Handle chat completion with caching and database integration
-def chat_completion(openai_client, system_prompt, user_input, username, dbname, user, password, host, port, openai_embeddings_model, openai_chat_model, typesearch):
+def chat_completion(openai_client, system_prompt, user_input, username, dbname, user, password, host, port, openai_embeddings_model, openai_chat_model, typesearch, tenant=DEFAULT_TENANT, cache_context=None, language=DEFAULT_LANGUAGE, search_params=None, filenames=None, mode='full'):
+    # mode comes from admission control: 'full-text' retrieves without embeddings and does not cache the
+    # degraded answer, 'cache-only' returns (None, False, []) when the cache has no answer
     # Query the chat history cache first to see if this question has been asked before
-    cache_results = cachesearch(user_input, username, dbname, user, password, host, port, openai_embeddings_model)
+    # (answers restricted to some files are not cached, their scope is not part of the cache key)
+    cache_results = []
+    if not filenames and mode != 'full':
+        # Degraded modes must not call the embedding model: only the same question can hit the cache
+        cache_results = cachesearch(user_input, username, dbname, user, password, host, port, openai_embeddings_model, tenant,
+                                    typesearch, openai_chat_model, cache_context, exact=True)
+    elif not filenames:
+        cache_results = openai_scheduler.submit(
+            lambda: cachesearch(user_input, username, dbname, user, password, host, port, openai_embeddings_model, tenant,
+                                typesearch, openai_chat_model, cache_context),
+            PRIORITY_INTERACTIVE, estimate_tokens(user_input))
 
+    if not filenames:
+        log_query(tenant, username, user_input, typesearch, openai_chat_model, len(cache_results) > 0,
+                  dbname, user, password, host, port)
     if len(cache_results) > 0:
-        return cache_results[0], True
+        return cache_results[0], True, cache_results[0][1]
+    elif mode == 'cache-only':
+        return None, False, []
     else:
         # Generate the completion
-        completions_results = generatecompletionede(openai_client, system_prompt, user_input, username, dbname, user, password, host, port, openai_embeddings_model, openai_chat_model, typesearch)
+        completions_results = generatecompletionede(openai_client, system_prompt, user_input, username, dbname, user, password, host, port, openai_embeddings_model, openai_chat_model,
+                                                    'full text' if mode == 'full-text' else typesearch, tenant, language, search_params,
+                                                    filenames, (cache_context or {}).get('corpus_version'))
 
         # Cache the response
-        cacheresponse(user_input, completions_results, username, dbname, user, password, host, port)
+        if not filenames and mode == 'full':
+            cacheresponse(user_input, completions_results, username, dbname, user, password, host, port, tenant,
+                          typesearch, openai_chat_model, cache_context)
+
+        return completions_results['choices'][0]['message']['content'], False, completions_results['citations']
+
+# Admission control for chat: concurrency caps, queue deadline and the load at which answers degrade
+ADMISSION_MAX_CONCURRENT = int(config.get('ADMISSION_MAX_CONCURRENT', 16))
+ADMISSION_MAX_PER_USER = int(config.get('ADMISSION_MAX_PER_USER', 2))
+ADMISSION_MAX_QUEUE = int(config.get('ADMISSION_MAX_QUEUE', 32))
+ADMISSION_QUEUE_TIMEOUT = float(config.get('ADMISSION_QUEUE_TIMEOUT', 5))
+ADMISSION_DEGRADE_AT = float(config.get('ADMISSION_DEGRADE_AT', 0.75))
+ADMISSION_CACHE_ONLY_MAX = int(config.get('ADMISSION_CACHE_ONLY_MAX', 8))
+
+# Raised when a chat request is shed; answered with 429 and Retry-After like Azure OpenAI throttling
+class OverloadedError(RateLimitedError):
+    pass
+
+class AdmissionController:
+    """Bound the chat requests in flight, globally and per user.
+
+    A request waits at most queue_timeout seconds for a slot, and is turned
+    away at once when max_queue requests are already waiting. Requests
+    admitted while the load (running and waiting over max_concurrent) is at
+    or above degrade_at are answered in 'full-text' mode. Requests that get
+    no slot are answered from the cache only ('cache-only', at most
+    cache_only_max at a time), or shed.
+    """
+
+    def __init__(self, max_concurrent, max_per_user, max_queue, queue_timeout, degrade_at, cache_only_max):
+        self.max_concurrent = max_concurrent
+        self.max_per_user = max_per_user
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.degrade_at = degrade_at
+        self.cache_only_max = cache_only_max
+        self.running = 0
+        self.waiting = 0
+        self.cache_only = 0
+        self.per_user = {}
+        self.service_seconds = 1.0
+        self.condition = threading.Condition()
+        self.recent = deque(maxlen=1000)
+        self.stats = {'requests': 0, 'full': 0, 'full-text': 0, 'cache-only': 0, 'shed': 0, 'queue_timeouts': 0}
+
+    def load(self):
+        return (self.running + self.waiting) / max(self.max_concurrent, 1)
+
+    def _record(self, outcome):
+        self.stats['requests'] += 1
+        self.stats[outcome] += 1
+        self.recent.append((time.monotonic(), outcome))
+
+    def acquire(self, username):
+        """Return the mode the request runs in ('full', 'full-text' or 'cache-only'), or None when it is shed."""
+        deadline = time.monotonic() + self.queue_timeout
+        with self.condition:
+            if self.waiting < self.max_queue:
+                self.waiting += 1
+                try:
+                    while self.running >= self.max_concurrent or self.per_user.get(username, 0) >= self.max_per_user:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self.stats['queue_timeouts'] += 1
+                            break
+                        self.condition.wait(remaining)
+                    else:
+                        # Load seen by this request: the others running or waiting
+                        busy = (self.running + self.waiting - 1) / max(self.max_concurrent, 1)
+                        mode = 'full-text' if busy >= self.degrade_at else 'full'
+                        self.running += 1
+                        self.per_user[username] = self.per_user.get(username, 0) + 1
+                        self._record(mode)
+                        return mode
+                finally:
+                    self.waiting -= 1
+            if self.cache_only < self.cache_only_max:
+                self.cache_only += 1
+                self._record('cache-only')
+                return 'cache-only'
+            self._record('shed')
+            return None
+
+    def release(self, username, mode, seconds):
+        with self.condition:
+            if mode == 'cache-only':
+                self.cache_only -= 1
+            else:
+                self.running -= 1
+                self.per_user[username] -= 1
+                if not self.per_user[username]:
+                    del self.per_user[username]
+                # Moving average of the time a slot is held, for Retry-After
+                self.service_seconds = 0.9 * self.service_seconds + 0.1 * seconds
+            self.condition.notify_all()
+
+    def retry_after(self):
+        """Seconds until the queue in front of a new request should have drained."""
+        with self.condition:
+            return max(1.0, self.service_seconds * (self.waiting + 1) / max(self.max_concurrent, 1))
+
+    def metrics(self, window=60.0):
+        with self.condition:
+            since = time.monotonic() - window
+            recent = [outcome for stamp, outcome in self.recent if stamp >= since]
+            return {'running': self.running, 'queue_depth': self.waiting, 'cache_only_running': self.cache_only,
+                    'users': len(self.per_user), 'load': round(self.load(), 2),
+                    'service_seconds': round(self.service_seconds, 2),
+                    'last_minute': {'requests': len(recent),
+                                    'shed_rate': round(recent.count('shed') / len(recent), 4) if recent else 0.0,
+                                    'degraded_rate': round((recent.count('full-text') + recent.count('cache-only')) / len(recent), 4)
+                                    if recent else 0.0},
+                    'stats': dict(self.stats)}
+
+# Shared by every chat request of the process; limits come from the .env file
+admission = AdmissionController(ADMISSION_MAX_CONCURRENT, ADMISSION_MAX_PER_USER, ADMISSION_MAX_QUEUE,
+                                ADMISSION_QUEUE_TIMEOUT, ADMISSION_DEGRADE_AT, ADMISSION_CACHE_ONLY_MAX)
+
+@contextmanager
+def admitted(username):
+    """Hold an admission slot for a chat request and yield its mode; raise OverloadedError when shed."""
+    mode = admission.acquire(username)
+    if mode is None:
+        raise OverloadedError('The service is overloaded, please retry shortly', admission.retry_after())
+    start = time.monotonic()
+    try:
+        yield mode
+    finally:
+        admission.release(username, mode, time.monotonic() - start)
+
+# Batch answering: questions embedded per call, retrievals in flight and connections kept open
+BATCH_EMBED_SIZE = int(config.get('BATCH_EMBED_SIZE', 64))
+BATCH_CONCURRENCY = int(config.get('BATCH_CONCURRENCY', 4))
+
+# Batches /batch runs at the same time, in total and per user
+BATCH_MAX_CONCURRENT = int(config.get('BATCH_MAX_CONCURRENT', 2))
+BATCH_MAX_PER_USER = int(config.get('BATCH_MAX_PER_USER', 1))
+
+# Admission for /batch, apart from chat: a batch is admitted at once or refused, never queued or degraded
+batch_admission = AdmissionController(BATCH_MAX_CONCURRENT, BATCH_MAX_PER_USER, BATCH_MAX_CONCURRENT, 0,
+                                      float('inf'), 0)
+
+# Run fn(cur) in its own transaction on conn, rolled back on failure so a scheduler retry starts clean
+def in_transaction(conn, fn):
+    cur = conn.cursor()
+    try:
+        result = fn(cur)
+        conn.commit()
+        return result
+    except:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+# Embed several questions with one call to the active embeddings model
+def embed_questions(cur, questions):
+    cur.execute("""SELECT e FROM azure_openai.create_embeddings(
+                       (SELECT model FROM embedding_models WHERE status = 'active'), %s::text[], batch_size => %s)
+                   WITH ORDINALITY AS t(e, n) ORDER BY n""", (list(questions), len(questions)))
+    return [row[0] for row in cur.fetchall()]
+
+# Answer one question of a batch with its precomputed embedding
+def answer_batch_item(pool, openai_client, item, username, tenant, typesearch, openai_chat_model, cache_context, language):
+    timings = {}
+    started = time.perf_counter()
+    question, vector = item['question'], item['vector']
+    conn = pool.getconn()
+    try:
+        cur = conn.cursor()
+        step = time.perf_counter()
+        cached = cache_lookup(cur, question, username, tenant, typesearch, openai_chat_model, cache_context, vector)
+        conn.commit()
+        timings['cache_ms'] = round((time.perf_counter() - step) * 1000, 2)
+        if cached:
+            timings['total_ms'] = round((time.perf_counter() - started) * 1000, 2)
+            return {'answer': cached[0][0], 'cached': True, 'sources': sorted({c['filename'] for c in cached[0][1]}),
+                    'citations': cached[0][1], 'timings': timings}
+
+        step = time.perf_counter()
+        rows = retrieve(cur, question, typesearch, tenant, text_search_language(item.get('language') or language),
+                        query_vector=vector)
+        conn.commit()
+        cur.close()
+        timings['retrieval_ms'] = round((time.perf_counter() - step) * 1000, 2)
+    finally:
+        pool.putconn(conn)
+
+    # The connection goes back to the pool while the completion is generated
+    messages = [{'role': 'system', 'content': cache_context['system_prompt'].replace('{username}', username)},
+                {'role': 'user', 'content': question}]
+    messages += [{'role': 'system', 'content': format_chunk(row[1:3])} for row in rows]
+    step = time.perf_counter()
+    response = dict(openai_scheduler.submit(
+        lambda: get_completion(openai_client, openai_chat_model, messages),
+        PRIORITY_BULK, estimate_tokens(messages)))
+    response['sources'] = sorted({row[2] for row in rows})
+    response['citations'] = [chunk_citation(row, rank) for rank, row in enumerate(rows, 1)]
+    timings['completion_ms'] = round((time.perf_counter() - step) * 1000, 2)
+
+    step = time.perf_counter()
+    conn = pool.getconn()
+    try:
+        cacheresponse(question, response, username, None, None, None, None, None, tenant, typesearch, openai_chat_model,
+                      cache_context, conn=conn, prompt_vector=vector)
+    finally:
+        pool.putconn(conn)
+    timings['cache_write_ms'] = round((time.perf_counter() - step) * 1000, 2)
+    timings['total_ms'] = round((time.perf_counter() - started) * 1000, 2)
+    return {'answer': response['choices'][0]['message']['content'], 'cached': False, 'sources': response['sources'],
+            'citations': response['citations'], 'timings': timings}
+
+# Answer many questions, yielding each result as soon as it is ready
+def answer_batch(questions, openai_client, username, tenant, typesearch, dbname, user, password, host, port, openai_chat_model,
+                 language=DEFAULT_LANGUAGE, concurrency=BATCH_CONCURRENCY, embed_size=BATCH_EMBED_SIZE):
+    """Run the /send-message path for an iterable of questions, at ingestion priority.
+
+    Questions are strings or {"question": ..., "language": ...} objects, with
+    an optional precomputed "vector". The others are embedded embed_size at a
+    time. They are answered by concurrency workers sharing a connection pool,
+    and each new answer is written to tablecahedoc. Results come in completion
+    order, carrying the question's index.
+    """
+    from psycopg2.pool import ThreadedConnectionPool
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    if typesearch not in RETRIEVAL_K:
+        raise ValueError(f"Unknown search type: {typesearch}")
+    cache_context = get_cache_context(username, tenant, dbname, user, password, host, port)
+    pool = ThreadedConnectionPool(1, concurrency + 1, dbname=dbname, user=user, password=password, host=host, port=port)
+    items = ({'index': index, **(question if isinstance(question, dict) else {'question': question})}
+             for index, question in enumerate(questions))
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            while True:
+                batch = list(itertools.islice(items, embed_size))
+                if not batch:
+                    break
+                for item in batch:
+                    if not str(item.get('question') or '').strip():
+                        yield {'index': item['index'], 'question': item.get('question'), 'answer': None, 'error': 'No question provided'}
+                batch = [item for item in batch if str(item.get('question') or '').strip()]
+                if not batch:
+                    continue
+                # Items may carry their embedding already (cache warming)
+                pending = [item for item in batch if item.get('vector') is None]
+                step = time.perf_counter()
+                vectors = []
+                if pending:
+                    conn = pool.getconn()
+                    try:
+                        questions_text = [item['question'] for item in pending]
+                        vectors = openai_scheduler.submit(
+                            lambda: in_transaction(conn, lambda cur: embed_questions(cur, questions_text)),
+                            PRIORITY_BULK, sum(estimate_tokens(question) for question in questions_text))
+                    except Exception as e:
+                        vectors = str(e)
+                    finally:
+                        pool.putconn(conn)
+                if isinstance(vectors, str):
+                    for item in pending:
+                        yield {'index': item['index'], 'question': item['question'], 'answer': None, 'error': vectors}
+                    batch = [item for item in batch if item.get('vector') is not None]
+                embed_ms = round((time.perf_counter() - step) * 1000 / max(len(pending), 1), 2)
+
+                for item, vector in zip(pending, vectors if isinstance(vectors, list) else []):
+                    item['vector'] = vector
+                futures = {}
+                for item in batch:
+                    futures[executor.submit(answer_batch_item, pool, openai_client, item, username, tenant, typesearch,
+                                            openai_chat_model, cache_context, language)] = item
+                for future in as_completed(futures):
+                    item = futures[future]
+                    result = {'index': item['index'], 'question': item['question']}
+                    try:
+                        result.update(future.result())
+                        result['timings']['embed_ms'] = embed_ms
+                    except Exception as e:
+                        result.update({'answer': None, 'error': str(e)})
+                    yield result
+    finally:
+        pool.closeall()
+
+# Questions of a batch file: JSONL ({"question": ...} or a JSON string per line) or one question per line
+def read_batch_questions(lines):
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            question = json.loads(line)
+        except ValueError:
+            question = line
+        yield question if isinstance(question, (dict, str)) else str(question)
+
+# Cache warming: prompts mined from the query log, recency half-life, near-duplicate distance and debounce delay
+CACHE_WARM_ENABLED = str(config.get('CACHE_WARM', '')).lower() in ('1', 'true', 'yes', 'on')
+CACHE_WARM_TOP = int(config.get('CACHE_WARM_TOP', 200))
+CACHE_WARM_DAYS = int(config.get('CACHE_WARM_DAYS', 30))
+CACHE_WARM_HALF_LIFE_DAYS = float(config.get('CACHE_WARM_HALF_LIFE_DAYS', 7))
+CACHE_WARM_CLUSTER_DISTANCE = float(config.get('CACHE_WARM_CLUSTER_DISTANCE', DEFAULT_CACHE_THRESHOLD))
+CACHE_WARM_DELAY = float(config.get('CACHE_WARM_DELAY', 60))
+
+# Pending warm-up timers and the last report, per tenant
+_cache_warm_timers = {}
+cache_warm_reports = {}
+_cache_warm_lock = threading.Lock()
+
+# Record a chat question and whether the answer cache served it
+def log_query(tenant, username, prompt, typesearch, chat_model, cached, dbname, user, password, host, port):
+    conn = get_db_connection(dbname, user, password, host, port)
+    cur = conn.cursor()
+    cur.execute('''INSERT INTO query_log (tenant, usname, prompt, searchtype, chatmodel, cached)
+                   VALUES (%s, %s, %s, %s, %s, %s)''', (tenant_key(tenant), username, prompt, typesearch, chat_model, cached))
+    conn.commit()
+    cur.close()
+    conn.close()
+
+# Cosine distance between two embeddings
+def cosine_distance(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return 1 - dot / norm if norm else 1.0
+
+# The tenant's most asked questions, weighted by frequency and recency
+def mine_frequent_prompts(cur, tenant, top=CACHE_WARM_TOP, days=CACHE_WARM_DAYS, half_life=CACHE_WARM_HALF_LIFE_DAYS):
+    """Return (username, search type, chat model, prompt, weight) rows, heaviest first.
+
+    Each time a question was asked counts 0.5 ** (age in days / half_life).
+    Cached answers whose question is not in query_log (asked before it
+    existed) count as asked once, on the day they were cached.
+    """
+    cur.execute('''SELECT usname, searchtype, chatmodel, prompt, sum(weight) AS weight
+                   FROM (SELECT usname, searchtype, chatmodel, prompt,
+                                power(0.5, extract(epoch FROM now() - asked_at) / 86400.0 / %s) AS weight
+                         FROM query_log
+                         WHERE tenant = %s AND asked_at > now() - make_interval(days => %s)
+                         UNION ALL
+                         SELECT c.usname, c.searchtype, c.chatmodel, c.prompt,
+                                power(0.5, (current_date - c.date_added) / %s)
+                         FROM tablecahedoc c
+                         WHERE c.tenant = %s AND c.date_added > current_date - %s
+                         AND NOT EXISTS (SELECT 1 FROM query_log q
+                                         WHERE q.tenant = c.tenant AND q.usname = c.usname AND q.prompt = c.prompt)) history
+                   GROUP BY usname, searchtype, chatmodel, prompt
+                   ORDER BY weight DESC
+                   LIMIT %s''', (half_life, tenant, days, half_life, tenant, days, top))
+    return cur.fetchall()
+
+# Group near-duplicate questions, the heaviest one of each group standing for the others
+def cluster_prompts(prompts, max_distance=CACHE_WARM_CLUSTER_DISTANCE):
+    clusters = []
+    for prompt in sorted(prompts, key=lambda p: -p['weight']):
+        for cluster in clusters:
+            if cosine_distance(cluster['vector'], prompt['vector']) < max_distance:
+                cluster['weight'] += prompt['weight']
+                cluster['members'] += 1
+                break
+        else:
+            clusters.append({'question': prompt['question'], 'vector': prompt['vector'], 'weight': prompt['weight'], 'members': 1})
+    return clusters
+
+# Share of the mined questions (by weight) the answer cache would serve right now
+def cache_coverage(cur, prompts, username, tenant, typesearch, chat_model, cache_context):
+    hit = sum(prompt['weight'] for prompt in prompts
+              if cache_lookup(cur, prompt['question'], username, tenant, typesearch, chat_model, cache_context, prompt['vector']))
+    cur.connection.commit()
+    return hit
+
+# Pre-compute the answers to the tenant's frequent questions, at ingestion priority
+def warm_cache(tenant, dbname, user, password, host, port, top=CACHE_WARM_TOP):
+    """Answer the heaviest question of each cluster of frequent questions.
+
+    Questions are mined per user, search type and chat model (the answer
+    cache is scoped by them) and answered through answer_batch, which skips
+    the ones already cached. The report compares the weighted share of mined
+    questions the cache serves before and after warming.
+    """
+    tenant = tenant_key(tenant)
+    started = time.perf_counter()
+    report = {'tenant': tenant, 'status': 'running', 'started_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+              'prompts': 0, 'clusters': 0, 'answered': 0, 'already_cached': 0, 'failed': 0}
+    cache_warm_reports[tenant] = report
+    conn = get_db_connection(dbname, user, password, host, port)
+    cur = conn.cursor()
+    scopes = {}
+    for username, typesearch, chat_model, prompt, weight in mine_frequent_prompts(cur, tenant, top):
+        chat_model = chat_model or config.get('AZURE_OPENAI_CHAT_MODEL', '')
+        scopes.setdefault((username, typesearch, chat_model), []).append({'question': prompt, 'weight': float(weight)})
+    cur.execute("DELETE FROM query_log WHERE tenant = %s AND asked_at < now() - make_interval(days => %s)", (tenant, CACHE_WARM_DAYS))
+    conn.commit()
+
+    openai_client = get_openai_client(config.get('openai_key', ''), config.get('openai_version', ''), config.get('openai_endpoint', ''))
+    total = before = after = 0.0
+    try:
+        for (username, typesearch, chat_model), prompts in scopes.items():
+            for start in range(0, len(prompts), BATCH_EMBED_SIZE):
+                batch = prompts[start:start + BATCH_EMBED_SIZE]
+                questions = [prompt['question'] for prompt in batch]
+                # Each attempt gets a clean transaction, so a rate-limited call backs off and is retried
+                vectors = openai_scheduler.submit(lambda: in_transaction(conn, lambda cur: embed_questions(cur, questions)),
+                                                  PRIORITY_BULK, sum(estimate_tokens(question) for question in questions))
+                for prompt, vector in zip(batch, vectors):
+                    prompt['vector'] = vector
+            cache_context = get_cache_context(username, tenant, dbname, user, password, host, port)
+            total += sum(prompt['weight'] for prompt in prompts)
+            before += cache_coverage(cur, prompts, username, tenant, typesearch, chat_model, cache_context)
+
+            clusters = cluster_prompts(prompts)
+            for result in answer_batch(clusters, openai_client, username, tenant, typesearch, dbname, user, password, host, port, chat_model):
+                if result.get('error'):
+                    report['failed'] += 1
+                elif result['cached']:
+                    report['already_cached'] += 1
+                else:
+                    report['answered'] += 1
+            after += cache_coverage(cur, prompts, username, tenant, typesearch, chat_model, cache_context)
+            report['prompts'] += len(prompts)
+            report['clusters'] += len(clusters)
+        report['status'] = 'done'
+    except Exception as e:
+        report.update({'status': 'error', 'error': str(e)})
+    finally:
+        cur.close()
+        conn.close()
+    report.update({'hit_rate_before': round(before / total, 4) if total else None,
+                   'hit_rate_after': round(after / total, 4) if total else None,
+                   'hit_rate_restored': round((after - before) / total, 4) if total else None,
+                   'seconds': round(time.perf_counter() - started, 2)})
+    log_event(logging.INFO, 'cache warming finished', **report)
+    return report
+
+# Warm a tenant's cache in the background once ingestion or clearing has been quiet for delay seconds
+def schedule_cache_warm(tenant, dbname, user, password, host, port, delay=CACHE_WARM_DELAY):
+    tenant = tenant_key(tenant)
+
+    def run():
+        _cache_warm_timers.pop(tenant, None)
+        # One warm-up at a time per process, they compete for the same budget
+        with _cache_warm_lock:
+            try:
+                warm_cache(tenant, dbname, user, password, host, port)
+            except Exception as e:
+                log_event(logging.ERROR, 'cache warming failed', tenant=tenant, error=str(e))
+
+    previous = _cache_warm_timers.pop(tenant, None)
+    if previous:
+        previous.cancel()
+    timer = threading.Timer(delay, run)
+    timer.daemon = True
+    _cache_warm_timers[tenant] = timer
+    cache_warm_reports.setdefault(tenant, {'tenant': tenant})['status'] = 'scheduled'
+    timer.start()
 
-        return completions_results['choices'][0]['message']['content'], False
+# Hit rate of the answer cache over the last hour, from query_log
+def recent_cache_hit_rate(cur, tenant):
+    cur.execute('''SELECT count(*), count(*) FILTER (WHERE cached) FROM query_log
+                   WHERE tenant = %s AND asked_at > now() - interval '1 hour' ''', (tenant_key(tenant),))
+    asked, hits = cur.fetchone()
+    return {'questions': asked, 'hit_rate': round(hits / asked, 4) if asked else None}
 
 # Save system prompt to database
 def save_system_prompt(username, prompt_name, prompt_text, dbname, user, password, host, port):
@@ -628,6 +3052,46 @@ def get_active_system_prompt(username, dbname, user, password, host, port):
         return result[0]
     return DEFAULT_SYSTEM_PROMPT
 
+# Get everything a cache lookup is scoped by, in a single round trip
+def get_cache_context(username, tenant, dbname, user, password, host, port):
+    """Return the active prompt, the user's cache threshold and the tenant's corpus version.
+
+    A prompt id of 0 means the built-in DEFAULT_SYSTEM_PROMPT is active.
+    """
+    conn = get_db_connection(dbname, user, password, host, port)
+    cur = conn.cursor()
+    
+    cur.execute('''SELECT (SELECT corpus_version FROM tenants WHERE tenant = %s),
+                          (SELECT cache_threshold FROM user_settings WHERE username = %s),
+                          sp.id, sp.prompt_text
+                   FROM (SELECT 1) AS one
+                   LEFT JOIN LATERAL (SELECT id, prompt_text FROM system_prompts
+                                      WHERE username = %s AND is_active = true
+                                      ORDER BY date_added DESC LIMIT 1) AS sp ON true''',
+                (tenant_key(tenant), username, username))
+    
+    result = cur.fetchone()
+    cur.close()
+    conn.close()
+    
+    return {
+        'corpus_version': result[0] or 0,
+        'threshold': result[1] if result[1] is not None else DEFAULT_CACHE_THRESHOLD,
+        'prompt_id': result[2] or 0,
+        'system_prompt': result[3] or DEFAULT_SYSTEM_PROMPT
+    }
+
+# Save the per-user cache distance threshold
+def save_cache_threshold(username, threshold, dbname, user, password, host, port):
+    conn = get_db_connection(dbname, user, password, host, port)
+    cur = conn.cursor()
+    cur.execute('''INSERT INTO user_settings (username, cache_threshold) VALUES (%s, %s)
+                   ON CONFLICT (username) DO UPDATE SET cache_threshold = EXCLUDED.cache_threshold''',
+                (username, threshold))
+    conn.commit()
+    cur.close()
+    conn.close()
+
 # Get all system prompts for user
 def get_all_system_prompts(username, dbname, user, password, host, port):
     """Retrieve all system prompts for a user with their details"""
@@ -726,18 +3190,23 @@ def login():
             session['openai_version'] = config.get('openai_version', '')
             session['openai_chat_model'] = config.get('AZURE_OPENAI_CHAT_MODEL', '')
             session['embeddingssize'] = config.get('embeddingsize', '')
-            session['openai_embeddings_model'] = 'text-embedding-ada-002'
+            session['openai_embeddings_model'] = DEFAULT_EMBEDDINGS_MODEL
+            # Until the database answers, the tenant is the one the configuration assigns
+            session['tenant'] = tenant_key(TENANT_ASSIGNMENTS.get(username, DEFAULT_TENANT))
             
             try:
-                conn = get_db_connection(dbname, user, password, host, port)
-                cur = conn.cursor()
-                cur.execute('INSERT INTO userapp (username, email, country) VALUES (%s, %s, %s)',
-                            (username, email, country))
-                conn.commit()
-                cur.close()
-                conn.close()
-            except:
-                pass  # User might already exist
+                tenant = resolve_tenant(username, email, country, dbname, user, password, host, port)
+                ensure_tenant_partition(tenant, dbname, user, password, host, port)
+                session['tenant'] = tenant
+            except ValueError as e:
+                session.clear()
+                log_event(logging.ERROR, 'tenant assignment rejected', username=username, error=str(e))
+                flash(f'Your tenant cannot be used: {str(e)}', 'error')
+                return render_template('login.html')
+            except psycopg2.Error as e:
+                # The database may not be initialized yet; /initialize creates the tenant's partitions
+                log_event(logging.WARNING, 'user not registered', username=username, error=str(e).strip())
+                flash('Could not register you in the database, initialize it from the Config page.', 'warning')
             
             flash(f'Welcome {username}!', 'success')
             return redirect(url_for('chat'))
@@ -757,6 +3226,22 @@ def config_page():
     if 'logged_in' not in session or not session['logged_in']:
         return redirect(url_for('login'))
     
+    if request.method == 'POST' and request.form.get('form') == 'cache':
+        try:
+            threshold = float(request.form.get('cache_threshold', DEFAULT_CACHE_THRESHOLD))
+            save_cache_threshold(session['username'], threshold,
+                                 session.get('dbname', config.get('pgdbname', '')),
+                                 session.get('pguser', config.get('pguser', '')),
+                                 session.get('pgpassword', config.get('pgpassword', '')),
+                                 session.get('pghost', config.get('pghost', '')),
+                                 session.get('pgport', config.get('pgport', '')))
+            session['cache_threshold'] = threshold
+            flash('Cache settings saved!', 'success')
+        except Exception as e:
+            flash(f'Error saving cache settings: {str(e)}', 'error')
+        return render_template('config.html', config=config, session=session,
+                               default_cache_threshold=DEFAULT_CACHE_THRESHOLD)
+
     if request.method == 'POST':
         # Save configuration to session
         session['dbname'] = request.form.get('dbname', config.get('pgdbname', ''))
@@ -769,11 +3254,12 @@ def config_page():
         session['openai_version'] = request.form.get('openai_version', config.get('openai_version', ''))
         session['openai_chat_model'] = request.form.get('openai_chat_model', config.get('AZURE_OPENAI_CHAT_MODEL', ''))
         session['embeddingssize'] = request.form.get('embeddingssize', config.get('embeddingsize', ''))
-        session['openai_embeddings_model'] = request.form.get('openai_embeddings_model', 'text-embedding-ada-002')
+        session['openai_embeddings_model'] = request.form.get('openai_embeddings_model', DEFAULT_EMBEDDINGS_MODEL)
         
         flash('Configuration saved!', 'success')
     
-    return render_template('config.html', config=config, session=session)
+    return render_template('config.html', config=config, session=session,
+                           default_cache_threshold=DEFAULT_CACHE_THRESHOLD)
 
 @app.route('/initialize', methods=['POST'])
 def initialize_db():
@@ -786,11 +3272,15 @@ def initialize_db():
     host = session.get('pghost', config.get('pghost', ''))
     port = session.get('pgport', config.get('pgport', ''))
     embeddingssize = session.get('embeddingssize', config.get('embeddingsize', ''))
-    openai_embeddings_model = session.get('openai_embeddings_model', 'text-embedding-ada-002')
+    openai_embeddings_model = session.get('openai_embeddings_model', DEFAULT_EMBEDDINGS_MODEL)
+    tenant = session.get('tenant', DEFAULT_TENANT)
+    data = request.get_json(silent=True) or {}
     
     try:
-        intialize(dbname, user, password, host, port, embeddingssize, openai_embeddings_model)
-        return jsonify({'success': True, 'message': 'Database initialized successfully!'})
+        applied = intialize(dbname, user, password, host, port, embeddingssize, openai_embeddings_model, tenant,
+                            data.get('quantization') or None, data.get('index_dims') or None)
+        message = f'Applied migrations {applied}.' if applied else 'Schema already up to date.'
+        return jsonify({'success': True, 'message': f'Database initialized successfully! {message}'})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -804,46 +3294,346 @@ def clear_cache():
     password = session.get('pgpassword', config.get('pgpassword', ''))
     host = session.get('pghost', config.get('pghost', ''))
     port = session.get('pgport', config.get('pgport', ''))
+    tenant = session.get('tenant', DEFAULT_TENANT)
     
     try:
-        clearcache(dbname, user, password, host, port)
+        clearcache(dbname, user, password, host, port, tenant)
         return jsonify({'success': True, 'message': 'Cache cleared successfully!'})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
-@app.route('/clear-chat', methods=['POST'])
-def clear_chat():
-    """Clear all chat history from the session"""
-    if 'logged_in' not in session or not session['logged_in']:
-        return jsonify({'error': 'Not logged in'}), 401
-    
-    try:
-        # Clear chat history from session
-        session['chat_history'] = []
-        session.modified = True
-        return jsonify({'success': True, 'message': 'Chat history cleared successfully!'})
-    except Exception as e:
-        return jsonify({'success': False, 'error': str(e)}), 500
+@app.route('/clear-chat', methods=['POST'])
+def clear_chat():
+    """Clear all chat history from the session"""
+    if 'logged_in' not in session or not session['logged_in']:
+        return jsonify({'error': 'Not logged in'}), 401
+    
+    try:
+        # Clear chat history from session
+        session['chat_history'] = []
+        session.modified = True
+        return jsonify({'success': True, 'message': 'Chat history cleared successfully!'})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/clean-all', methods=['POST'])
+def clean_all():
+    if 'logged_in' not in session or not session['logged_in']:
+        return jsonify({'error': 'Not logged in'}), 401
+    
+    dbname = session.get('dbname', config.get('pgdbname', ''))
+    user = session.get('pguser', config.get('pguser', ''))
+    password = session.get('pgpassword', config.get('pgpassword', ''))
+    host = session.get('pghost', config.get('pghost', ''))
+    port = session.get('pgport', config.get('pgport', ''))
+    
+    try:
+        cleanall(dbname, user, password, host, port)
+        return jsonify({'success': True, 'message': 'All tables deleted successfully!'})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+# Upload progress backend ('memory', 'postgres' or 'sqlite') and how long finished entries are kept
+PROGRESS_STORE = config.get('PROGRESS_STORE', 'memory')
+PROGRESS_TTL = int(config.get('PROGRESS_TTL', 3600))
+PROGRESS_SQLITE_PATH = config.get('PROGRESS_SQLITE_PATH', 'upload_progress.db')
+PROGRESS_POOL_SIZE = int(config.get('PROGRESS_POOL_SIZE', 4))
+
+# Seconds between SSE keep-alives, and the longest a progress stream stays open
+# (the browser reconnects after that, so a stream does not hold a worker for a whole upload)
+PROGRESS_KEEPALIVE = float(config.get('PROGRESS_KEEPALIVE', 15))
+PROGRESS_STREAM_MAX = float(config.get('PROGRESS_STREAM_MAX', 120))
+
+# Upload progress kept in this process only (single worker)
+class MemoryProgressStore:
+    def __init__(self, ttl=PROGRESS_TTL):
+        self.ttl = ttl
+        self.entries = {}
+        self.changed = threading.Condition()
+
+    def __setitem__(self, upload_id, value):
+        with self.changed:
+            now = time.time()
+            self.entries[upload_id] = (now, dict(value))
+            for key in [key for key, (updated, _) in self.entries.items() if now - updated > self.ttl]:
+                del self.entries[key]
+            self.changed.notify_all()
+
+    def get(self, upload_id, default=None):
+        entry = self.entries.get(upload_id)
+        if entry is None or time.time() - entry[0] > self.ttl:
+            return default
+        return entry[1]
+
+    def wait(self, upload_id, last, timeout):
+        """Block until the entry differs from last, or timeout; return the entry."""
+        with self.changed:
+            self.changed.wait_for(lambda: self.get(upload_id) != last, timeout)
+        return self.get(upload_id)
+
+# Upload progress in a SQLite file, shared by the workers of one host
+class SQLiteProgressStore:
+    def __init__(self, path=PROGRESS_SQLITE_PATH, ttl=PROGRESS_TTL):
+        self.path = path
+        self.ttl = ttl
+        conn = self.connect()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS upload_progress (upload_id TEXT PRIMARY KEY, value TEXT NOT NULL, updated REAL NOT NULL)')
+        conn.commit()
+        conn.close()
+
+    def connect(self):
+        import sqlite3
+        return sqlite3.connect(self.path, timeout=5)
+
+    def __setitem__(self, upload_id, value):
+        conn = self.connect()
+        now = time.time()
+        conn.execute('INSERT OR REPLACE INTO upload_progress VALUES (?, ?, ?)', (upload_id, json.dumps(value), now))
+        conn.execute('DELETE FROM upload_progress WHERE updated < ?', (now - self.ttl,))
+        conn.commit()
+        conn.close()
+
+    def get(self, upload_id, default=None):
+        conn = self.connect()
+        row = conn.execute('SELECT value FROM upload_progress WHERE upload_id = ? AND updated >= ?',
+                           (upload_id, time.time() - self.ttl)).fetchone()
+        conn.close()
+        return json.loads(row[0]) if row else default
+
+    def wait(self, upload_id, last, timeout):
+        """Poll the file (not the browser) until the entry changes, or timeout."""
+        deadline = time.time() + timeout
+        current = self.get(upload_id)
+        while current == last and time.time() < deadline:
+            time.sleep(0.25)
+            current = self.get(upload_id)
+        return current
+
+# Upload progress in PostgreSQL, pushed to waiting streams with LISTEN/NOTIFY
+class PostgresProgressStore:
+    """Shared by every worker and host using the database of the .env file.
+
+    The table is UNLOGGED: progress does not need to survive a crash. Updates
+    and reads borrow a connection from a pool of PROGRESS_POOL_SIZE per process.
+    """
+    def __init__(self, ttl=PROGRESS_TTL, pool_size=PROGRESS_POOL_SIZE):
+        self.ttl = ttl
+        self.pool_size = pool_size
+        self.pool = None
+        self.pool_pid = None
+        self.pool_lock = threading.Lock()
+        self.last_eviction = 0.0
+        conn = self.connect()
+        cur = conn.cursor()
+        cur.execute('''CREATE UNLOGGED TABLE IF NOT EXISTS upload_progress (
+                        upload_id text PRIMARY KEY,
+                        value jsonb NOT NULL,
+                        updated_at timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP);
+                    ''')
+        conn.commit()
+        cur.close()
+        conn.close()
+
+    def connect(self):
+        return get_db_connection(config.get('pgdbname', ''), config.get('pguser', ''), config.get('pgpassword', ''),
+                                 config.get('pghost', ''), config.get('pgport', ''))
+
+    @contextmanager
+    def cursor(self):
+        """Run one transaction on a pooled connection, or a direct one when the pool is exhausted."""
+        from psycopg2.pool import PoolError, ThreadedConnectionPool
+        with self.pool_lock:
+            # A forked worker must not share its parent's connections
+            if self.pool is None or self.pool_pid != os.getpid():
+                self.pool = ThreadedConnectionPool(0, self.pool_size, dbname=config.get('pgdbname', ''),
+                                                   user=config.get('pguser', ''), password=config.get('pgpassword', ''),
+                                                   host=config.get('pghost', ''), port=config.get('pgport', ''))
+                self.pool_pid = os.getpid()
+            pool = self.pool
+        try:
+            conn = pool.getconn()
+        except PoolError:
+            pool, conn = None, self.connect()
+        cur = conn.cursor()
+        try:
+            yield cur
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+            if pool is None:
+                conn.close()
+            else:
+                pool.putconn(conn, close=bool(conn.closed))
+
+    def __setitem__(self, upload_id, value):
+        with self.cursor() as cur:
+            cur.execute('''INSERT INTO upload_progress (upload_id, value) VALUES (%s, %s)
+                           ON CONFLICT (upload_id) DO UPDATE SET value = EXCLUDED.value, updated_at = CURRENT_TIMESTAMP''',
+                        (upload_id, json.dumps(value)))
+            cur.execute("SELECT pg_notify('upload_progress', %s)", (upload_id,))
+            if time.time() - self.last_eviction > 60:
+                self.last_eviction = time.time()
+                cur.execute("DELETE FROM upload_progress WHERE updated_at < CURRENT_TIMESTAMP - %s * interval '1 second'", (self.ttl,))
+
+    def get(self, upload_id, default=None):
+        with self.cursor() as cur:
+            cur.execute('''SELECT value FROM upload_progress
+                           WHERE upload_id = %s AND updated_at >= CURRENT_TIMESTAMP - %s * interval '1 second' ''',
+                        (upload_id, self.ttl))
+            row = cur.fetchone()
+        return row[0] if row else default
+
+    def wait(self, upload_id, last, timeout):
+        """LISTEN until this upload is notified, or timeout.
+
+        The listening connection is not pooled: it is left in autocommit with
+        pending notifications, and is closed when the wait ends.
+        """
+        import select
+        conn = self.connect()
+        conn.autocommit = True
+        cur = conn.cursor()
+        cur.execute('LISTEN upload_progress')
+        deadline = time.time() + timeout
+        try:
+            current = self.get(upload_id)
+            while current == last and time.time() < deadline:
+                if select.select([conn], [], [], max(0.0, deadline - time.time())) == ([], [], []):
+                    break
+                conn.poll()
+                if any(notify.payload == upload_id for notify in conn.notifies):
+                    current = self.get(upload_id)
+                conn.notifies.clear()
+        finally:
+            cur.close()
+            conn.close()
+        return current
+
+# Create the progress store selected by PROGRESS_STORE
+def create_progress_store(kind=PROGRESS_STORE):
+    if kind == 'postgres':
+        return PostgresProgressStore()
+    if kind == 'sqlite':
+        return SQLiteProgressStore()
+    return MemoryProgressStore()
+
+# Progress of every upload, written by the loaders and streamed by /upload-progress
+upload_progress = create_progress_store()
+
+# Resumable uploads: bytes per PATCH request, largest file accepted and lifetime of unfinished uploads
+UPLOAD_CHUNK_SIZE = int(config.get('UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024))
+# A larger PATCH body would be refused by the request size limit, so every chunk would fail
+if UPLOAD_CHUNK_SIZE > app.config['MAX_CONTENT_LENGTH']:
+    log_event(logging.WARNING, 'UPLOAD_CHUNK_SIZE is above the request size limit, clamped',
+              configured=UPLOAD_CHUNK_SIZE, limit=app.config['MAX_CONTENT_LENGTH'])
+    UPLOAD_CHUNK_SIZE = app.config['MAX_CONTENT_LENGTH']
+UPLOAD_MAX_SIZE = int(config.get('UPLOAD_MAX_SIZE', 2 * 1024 * 1024 * 1024))
+UPLOAD_RESUME_TTL = int(config.get('UPLOAD_RESUME_TTL', 24 * 3600))
+
+# Extensions with a loader in process_upload
+UPLOAD_EXTENSIONS = ('.pdf', '.doc', '.docx', '.ppt', '.pptx', '.xls', '.xlsx', '.csv', '.json')
+
+# Files of an unfinished upload: its metadata and the bytes received so far
+def resumable_paths(upload_id):
+    base = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(upload_id))
+    return base + '.upload.json', base + '.part'
+
+# Metadata of an unfinished upload, or None; the offset is the size of the part file
+def get_resumable_upload(upload_id):
+    meta_path, part_path = resumable_paths(upload_id)
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, encoding='utf-8') as f:
+        meta = json.load(f)
+    meta['offset'] = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    return meta
+
+# Delete the unfinished uploads nobody resumed within UPLOAD_RESUME_TTL
+def expire_resumable_uploads():
+    now = time.time()
+    for name in os.listdir(app.config['UPLOAD_FOLDER']):
+        if name.endswith('.upload.json'):
+            meta_path, part_path = resumable_paths(name[:-len('.upload.json')])
+            last_write = max(os.path.getmtime(path) for path in (meta_path, part_path) if os.path.exists(path))
+            if now - last_write > UPLOAD_RESUME_TTL:
+                for path in (meta_path, part_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+
+# Open an upload's part file under an exclusive lock; yields None when another request holds it
+@contextmanager
+def locked_part_file(part_path):
+    """Serialize the writers of one upload, across threads and worker processes.
+
+    The lock is taken without waiting (flock, or msvcrt on Windows), so a
+    concurrent PATCH is turned away instead of queued behind the upload.
+    Raises FileNotFoundError when the part file is gone.
+    """
+    with open(part_path, 'r+b') as f:
+        try:
+            if os.name == 'nt':
+                import msvcrt
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            yield None
+            return
+        try:
+            yield f
+        finally:
+            f.flush()
+            if os.name == 'nt':
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
 
-@app.route('/clean-all', methods=['POST'])
-def clean_all():
-    if 'logged_in' not in session or not session['logged_in']:
-        return jsonify({'error': 'Not logged in'}), 401
-    
-    dbname = session.get('dbname', config.get('pgdbname', ''))
-    user = session.get('pguser', config.get('pguser', ''))
-    password = session.get('pgpassword', config.get('pgpassword', ''))
-    host = session.get('pghost', config.get('pghost', ''))
-    port = session.get('pgport', config.get('pgport', ''))
-    
+# Append a request body to the part file in blocks, never holding more than one block in memory
+def append_upload_body(stream, f, limit):
+    written = 0
+    f.seek(0, os.SEEK_END)
+    while written < limit:
+        block = stream.read(min(1024 * 1024, limit - written))
+        if not block:
+            break
+        f.write(block)
+        written += len(block)
+    return written
+
+# Load a saved upload into the database, reporting to upload_progress (run in a background thread)
+def process_upload(upload_id, filename, filepath, dbname, user, password, host, port, tenant, language):
+    loaders = {'.pdf': loadpdffile, '.doc': loadwordfile, '.docx': loadwordfile, '.ppt': loadpptfile, '.pptx': loadpptfile,
+               '.xls': loadxlsfile, '.xlsx': loadxlsfile, '.csv': loadcsvfile, '.json': loadjsonfile}
+    name = os.path.splitext(filename)[0]
     try:
-        cleanall(dbname, user, password, host, port)
-        return jsonify({'success': True, 'message': 'All tables deleted successfully!'})
+        ensure_tenant_partition(tenant, dbname, user, password, host, port)
+        
+        # Verify file exists before processing
+        if not os.path.exists(filepath):
+            raise FileNotFoundError(f"File not found at: {filepath}")
+        
+        upload_progress[upload_id] = {'status': 'processing', 'progress': 40, 'message': 'Loading and splitting document...'}
+        loaders[os.path.splitext(filename)[1].lower()](name, filepath, dbname, user, password, host, port, upload_id, tenant, language)
+        
+        invalidate_cache_for_files(tenant, [name], dbname, user, password, host, port)
+        upload_progress[upload_id] = {'status': 'complete', 'progress': 100, 'message': f'File {filename} loaded successfully!'}
+    except FileNotFoundError as e:
+        upload_progress[upload_id] = {'status': 'error', 'progress': 0, 'message': f'File not found: {str(e)}'}
     except Exception as e:
-        return jsonify({'success': False, 'error': str(e)}), 500
-
-# Progress tracking dictionary
-upload_progress = {}
+        import traceback
+        error_msg = f'Error loading file: {str(e)}'
+        log_event(logging.ERROR, 'upload failed', upload_id=upload_id, filename=filename, error=str(e),
+                  traceback=traceback.format_exc())
+        upload_progress[upload_id] = {'status': 'error', 'progress': 0, 'message': error_msg}
+    finally:
+        if os.path.exists(filepath):
+            os.remove(filepath)
 
 @app.route('/upload', methods=['GET', 'POST'])
 def upload_file():
@@ -861,8 +3651,9 @@ def upload_file():
         
         if file:
             filename = secure_filename(file.filename)
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
             upload_id = str(uuid.uuid4())
+            # Keyed by the upload id, so two uploads of the same file name never share a path
+            filepath = os.path.join(app.config['UPLOAD_FOLDER'], upload_id + '_' + filename)
             
             # Initialize progress
             upload_progress[upload_id] = {'status': 'uploading', 'progress': 0, 'message': 'Uploading file...'}
@@ -873,62 +3664,106 @@ def upload_file():
             
             upload_progress[upload_id] = {'status': 'processing', 'progress': 20, 'message': 'File uploaded, processing...'}
             
-            # Debug: Verify file exists
-            print(f"File saved to: {filepath}")
-            print(f"File exists: {os.path.exists(filepath)}")
-            print(f"File size: {os.path.getsize(filepath)} bytes")
+            log_event(logging.DEBUG, 'file saved', path=filepath, exists=os.path.exists(filepath),
+                      bytes=os.path.getsize(filepath))
+            
+            if not filename.lower().endswith(UPLOAD_EXTENSIONS):
+                upload_progress[upload_id] = {'status': 'error', 'progress': 0, 'message': 'Unsupported file type'}
+                os.remove(filepath)
+                return jsonify({'error': 'Unsupported file type', 'upload_id': upload_id}), 400
             
             dbname = session.get('dbname', config.get('pgdbname', ''))
             user = session.get('pguser', config.get('pguser', ''))
             password = session.get('pgpassword', config.get('pgpassword', ''))
             host = session.get('pghost', config.get('pghost', ''))
             port = session.get('pgport', config.get('pgport', ''))
+            tenant = session.get('tenant', DEFAULT_TENANT)
+            language = text_search_language(request.form.get('language', DEFAULT_LANGUAGE))
             
-            try:
-                name = os.path.splitext(filename)[0]
-                
-                # Verify file exists before processing
-                if not os.path.exists(filepath):
-                    raise FileNotFoundError(f"File not found at: {filepath}")
-                
-                upload_progress[upload_id] = {'status': 'processing', 'progress': 40, 'message': 'Loading and splitting document...'}
-                
-                if filename.endswith('.pdf'):
-                    loadpdffile(name, filepath, dbname, user, password, host, port, upload_id)
-                elif filename.endswith(('.doc', '.docx')):
-                    loadwordfile(name, filepath, dbname, user, password, host, port, upload_id)
-                elif filename.endswith(('.ppt', '.pptx')):
-                    loadpptfile(name, filepath, dbname, user, password, host, port, upload_id)
-                elif filename.endswith(('.xls', '.xlsx')):
-                    loadxlsfile(name, filepath, dbname, user, password, host, port, upload_id)
-                elif filename.endswith('.csv'):
-                    loadcsvfile(name, filepath, dbname, user, password, host, port, upload_id)
-                elif filename.endswith('.json'):
-                    loadjsonfile(name, filepath, dbname, user, password, host, port, upload_id)
-                else:
-                    upload_progress[upload_id] = {'status': 'error', 'progress': 0, 'message': 'Unsupported file type'}
-                    os.remove(filepath)
-                    return jsonify({'error': 'Unsupported file type', 'upload_id': upload_id}), 400
-                
-                os.remove(filepath)
-                upload_progress[upload_id] = {'status': 'complete', 'progress': 100, 'message': f'File {filename} loaded successfully!'}
-                return jsonify({'success': True, 'upload_id': upload_id, 'message': f'File {filename} loaded successfully!'}), 200
-                
-            except FileNotFoundError as e:
-                upload_progress[upload_id] = {'status': 'error', 'progress': 0, 'message': f'File not found: {str(e)}'}
-                if os.path.exists(filepath):
-                    os.remove(filepath)
-                return jsonify({'error': f'File not found: {str(e)}', 'upload_id': upload_id}), 500
-            except Exception as e:
-                import traceback
-                error_msg = f'Error loading file: {str(e)}'
-                print(f"{error_msg}\n\nDetails: {traceback.format_exc()}")
-                upload_progress[upload_id] = {'status': 'error', 'progress': 0, 'message': error_msg}
-                if os.path.exists(filepath):
-                    os.remove(filepath)
-                return jsonify({'error': error_msg, 'upload_id': upload_id}), 500
+            # The document is loaded in the background; the browser follows /upload-progress/<id>/events
+            threading.Thread(target=process_upload, daemon=True,
+                             args=(upload_id, filename, filepath, dbname, user, password, host, port, tenant, language)).start()
+            return jsonify({'success': True, 'upload_id': upload_id, 'message': f'File {filename} is being processed'}), 202
     
-    return render_template('upload.html')
+    return render_template('upload.html', languages=SUPPORTED_LANGUAGES, default_language=DEFAULT_LANGUAGE)
+
+@app.route('/uploads', methods=['POST'])
+def create_resumable_upload():
+    """Start a resumable upload: {"filename", "size", "language"} gives an id to PATCH the bytes to"""
+    if 'logged_in' not in session or not session['logged_in']:
+        return jsonify({'error': 'Not logged in'}), 401
+
+    data = request.get_json() or {}
+    filename = secure_filename(data.get('filename', ''))
+    size = int(data.get('size', 0))
+    if not filename.lower().endswith(UPLOAD_EXTENSIONS):
+        return jsonify({'error': 'Unsupported file type'}), 400
+    if size <= 0 or size > UPLOAD_MAX_SIZE:
+        return jsonify({'error': f'File size must be between 1 and {UPLOAD_MAX_SIZE} bytes'}), 413
+
+    expire_resumable_uploads()
+    upload_id = str(uuid.uuid4())
+    meta_path, part_path = resumable_paths(upload_id)
+    with open(meta_path, 'w', encoding='utf-8') as f:
+        json.dump({'upload_id': upload_id, 'filename': filename, 'size': size, 'username': session['username'],
+                   'tenant': session.get('tenant', DEFAULT_TENANT),
+                   'language': text_search_language(data.get('language', DEFAULT_LANGUAGE))}, f)
+    open(part_path, 'wb').close()
+    upload_progress[upload_id] = {'status': 'uploading', 'progress': 0, 'message': 'Uploading file...'}
+    return jsonify({'success': True, 'upload_id': upload_id, 'offset': 0, 'chunk_size': UPLOAD_CHUNK_SIZE}), 201, \
+        {'Location': url_for('resumable_upload', upload_id=upload_id), 'Upload-Offset': '0', 'Upload-Length': str(size)}
+
+@app.route('/uploads/<upload_id>', methods=['HEAD', 'GET', 'PATCH'])
+def resumable_upload(upload_id):
+    """HEAD/GET: bytes received so far (Upload-Offset). PATCH: append the body at Upload-Offset."""
+    if 'logged_in' not in session or not session['logged_in']:
+        return jsonify({'error': 'Not logged in'}), 401
+
+    meta = get_resumable_upload(upload_id)
+    if meta is None or meta['username'] != session['username']:
+        return jsonify({'error': 'Unknown upload'}), 404
+    headers = {'Upload-Offset': str(meta['offset']), 'Upload-Length': str(meta['size']), 'Cache-Control': 'no-store'}
+    if request.method in ('HEAD', 'GET'):
+        return jsonify({'upload_id': upload_id, 'offset': meta['offset'], 'size': meta['size'],
+                        'chunk_size': UPLOAD_CHUNK_SIZE}), 200, headers
+
+    # Offset check, append and completion happen under the part file's lock: of two PATCHes
+    # sent at the same offset, one appends and the other gets 409
+    meta_path, part_path = resumable_paths(upload_id)
+    try:
+        with locked_part_file(part_path) as part:
+            if part is None:
+                return jsonify({'error': 'Another request is writing this upload', 'offset': meta['offset']}), 409, headers
+            meta = get_resumable_upload(upload_id)
+            if meta is None:
+                return jsonify({'error': 'Unknown upload'}), 404
+            headers['Upload-Offset'] = str(meta['offset'])
+            # A retried PATCH must start where the previous one actually stopped
+            if request.headers.get('Upload-Offset', type=int) != meta['offset']:
+                return jsonify({'error': 'Offset mismatch', 'offset': meta['offset']}), 409, headers
+            written = append_upload_body(request.stream, part, min(UPLOAD_CHUNK_SIZE, meta['size'] - meta['offset']))
+            offset = meta['offset'] + written
+            headers['Upload-Offset'] = str(offset)
+            upload_progress[upload_id] = {'status': 'uploading', 'progress': int(offset / meta['size'] * 20),
+                                          'message': f"Uploaded {offset // (1024 * 1024)}/{meta['size'] // (1024 * 1024)} MB..."}
+            if offset < meta['size']:
+                return '', 204, headers
+            # Once the metadata is gone, later PATCHes of this upload get 404
+            os.remove(meta_path)
+    except FileNotFoundError:
+        return jsonify({'error': 'Unknown upload'}), 404
+
+    # Complete: the file is loaded in the background like a single-request upload
+    filepath = os.path.abspath(os.path.join(app.config['UPLOAD_FOLDER'], upload_id + '_' + meta['filename']))
+    os.replace(part_path, filepath)
+    upload_progress[upload_id] = {'status': 'processing', 'progress': 20, 'message': 'File uploaded, processing...'}
+    threading.Thread(target=process_upload, daemon=True,
+                     args=(upload_id, meta['filename'], filepath,
+                           session.get('dbname', config.get('pgdbname', '')), session.get('pguser', config.get('pguser', '')),
+                           session.get('pgpassword', config.get('pgpassword', '')), session.get('pghost', config.get('pghost', '')),
+                           session.get('pgport', config.get('pgport', '')), meta['tenant'], meta['language'])).start()
+    return jsonify({'success': True, 'upload_id': upload_id, 'offset': offset,
+                    'message': f"File {meta['filename']} is being processed"}), 202, headers
 
 @app.route('/upload-progress/<upload_id>')
 def upload_progress_status(upload_id):
@@ -939,6 +3774,30 @@ def upload_progress_status(upload_id):
     progress = upload_progress.get(upload_id, {'status': 'unknown', 'progress': 0, 'message': 'Unknown upload'})
     return jsonify(progress)
 
+@app.route('/upload-progress/<upload_id>/events')
+def upload_progress_events(upload_id):
+    """Stream the progress of an upload as server-sent events until it ends"""
+    if 'logged_in' not in session or not session['logged_in']:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    def generate():
+        deadline = time.time() + PROGRESS_STREAM_MAX
+        last = None
+        while time.time() < deadline:
+            current = upload_progress.wait(upload_id, last, PROGRESS_KEEPALIVE)
+            if current is None:
+                current = {'status': 'unknown', 'progress': 0, 'message': 'Unknown upload'}
+            if current == last:
+                yield ': keep-alive\n\n'
+                continue
+            last = current
+            yield 'data: ' + json.dumps(current) + '\n\n'
+            if current['status'] in ('complete', 'error', 'unknown'):
+                break
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/chat', methods=['GET'])
 def chat():
     if 'logged_in' not in session or not session['logged_in']:
@@ -950,7 +3809,8 @@ def chat():
     if 'chat_history' not in session:
         session['chat_history'] = []
     
-    return render_template('chat.html', username=username, chat_history=session.get('chat_history', []))
+    return render_template('chat.html', username=username, chat_history=session.get('chat_history', []),
+                           languages=SUPPORTED_LANGUAGES, default_language=DEFAULT_LANGUAGE)
 
 @app.route('/send-message', methods=['POST'])
 def send_message():
@@ -960,6 +3820,9 @@ def send_message():
     data = request.get_json()
     user_input = data.get('message', '')
     typesearch = data.get('search_type', 'vector')
+    language = text_search_language(data.get('language', DEFAULT_LANGUAGE))
+    search_params = data.get('search_params')  # e.g. {"hnsw.ef_search": 100} for this query only
+    filenames = data.get('filenames') or None  # restrict retrieval to these files
     
     if not user_input:
         return jsonify({'error': 'No message provided'}), 400
@@ -976,26 +3839,29 @@ def send_message():
     openai_key = session.get('openai_key', config.get('openai_key', ''))
     openai_version = session.get('openai_version', config.get('openai_version', ''))
     openai_chat_model = session.get('openai_chat_model', config.get('AZURE_OPENAI_CHAT_MODEL', ''))
-    openai_embeddings_model = session.get('openai_embeddings_model', 'text-embedding-ada-002')
-    
-    # Get system prompt (from database or use default)
-    system_prompt = get_active_system_prompt(username, dbname, user, password, host, port)
-    system_prompt = system_prompt.replace("{username}", username)
-    
-    # Create OpenAI client
-    openai_client = AzureOpenAI(
-        api_key=openai_key,
-        api_version=openai_version,
-        azure_endpoint=openai_endpoint
-    )
+    openai_embeddings_model = session.get('openai_embeddings_model', DEFAULT_EMBEDDINGS_MODEL)
+    tenant = session.get('tenant', DEFAULT_TENANT)
     
     try:
         start_time = time.time()
-        response_payload, cached = chat_completion(
-            openai_client, system_prompt, user_input, username,
-            dbname, user, password, host, port,
-            openai_embeddings_model, openai_chat_model, typesearch
-        )
+        # Admission control runs first, before any connection or Azure OpenAI call
+        with admitted(username) as mode:
+            # Get system prompt (from database or use default) and the cache scope
+            cache_context = get_cache_context(username, tenant, dbname, user, password, host, port)
+            system_prompt = cache_context['system_prompt'].replace("{username}", username)
+            
+            # Create OpenAI client
+            openai_client = get_openai_client(openai_key, openai_version, openai_endpoint)
+            
+            response_payload, cached, citations = chat_completion(
+                openai_client, system_prompt, user_input, username,
+                dbname, user, password, host, port,
+                openai_embeddings_model, openai_chat_model, typesearch, tenant, cache_context, language, search_params, filenames,
+                mode
+            )
+        if response_payload is None:
+            raise OverloadedError('The service is overloaded and has no cached answer, please retry shortly',
+                                  admission.retry_after())
         end_time = time.time()
         elapsed_time = round((end_time - start_time) * 1000, 2)
         
@@ -1012,7 +3878,8 @@ def send_message():
             'user': user_input,
             'assistant': response,
             'time': elapsed_time,
-            'cached': cached
+            'cached': cached,
+            'citations': citations
         })
         session.modified = True
         
@@ -1020,12 +3887,93 @@ def send_message():
             'success': True,
             'response': response,
             'time': elapsed_time,
-            'cached': cached
+            'cached': cached,
+            'citations': citations,
+            'mode': mode
         })
         
+    except RateLimitedError as e:
+        retry_after = max(1, int(math.ceil(e.retry_after)))
+        return jsonify({'success': False, 'error': str(e)}), 429, {'Retry-After': str(retry_after)}
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/batch', methods=['POST'])
+def batch_answer():
+    """Answer a file of questions (multipart "file") or a JSON list, streamed back as JSON lines."""
+    if 'logged_in' not in session or not session['logged_in']:
+        return jsonify({'error': 'Not logged in'}), 401
+
+    if 'file' in request.files:
+        lines = request.files['file'].read().decode('utf-8').splitlines()
+        options = request.form
+    else:
+        options = request.get_json() or {}
+        lines = [json.dumps(question) for question in options.get('questions', [])]
+    questions = list(read_batch_questions(lines))
+    if not questions:
+        return jsonify({'error': 'No questions provided'}), 400
+
+    username = session['username']
+    dbname = session.get('dbname', config.get('pgdbname', ''))
+    user = session.get('pguser', config.get('pguser', ''))
+    password = session.get('pgpassword', config.get('pgpassword', ''))
+    host = session.get('pghost', config.get('pghost', ''))
+    port = session.get('pgport', config.get('pgport', ''))
+    openai_client = get_openai_client(session.get('openai_key', config.get('openai_key', '')),
+                                      session.get('openai_version', config.get('openai_version', '')),
+                                      session.get('openai_endpoint', config.get('openai_endpoint', '')))
+    openai_chat_model = session.get('openai_chat_model', config.get('AZURE_OPENAI_CHAT_MODEL', ''))
+    tenant = session.get('tenant', DEFAULT_TENANT)
+    typesearch = options.get('search_type', 'vector')
+    if typesearch not in RETRIEVAL_K:
+        return jsonify({'error': f'Unknown search type: {typesearch}'}), 400
+    try:
+        concurrency = max(1, min(int(options.get('concurrency', BATCH_CONCURRENCY)), BATCH_CONCURRENCY))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'concurrency must be an integer'}), 400
+
+    # The slot is held until the stream is closed, not only while this function runs
+    mode = batch_admission.acquire(username)
+    if mode is None:
+        return jsonify({'error': 'Too many batches running, please retry later'}), 429, \
+            {'Retry-After': str(max(1, int(math.ceil(batch_admission.retry_after()))))}
+    started = time.monotonic()
+    results = answer_batch(questions, openai_client, username, tenant, typesearch,
+                           dbname, user, password, host, port, openai_chat_model,
+                           text_search_language(options.get('language', DEFAULT_LANGUAGE)), concurrency)
+    response = Response(stream_with_context(json.dumps(result) + '\n' for result in results), mimetype='application/x-ndjson')
+    response.call_on_close(lambda: batch_admission.release(username, mode, time.monotonic() - started))
+    return response
+
+@app.route('/chunk/<int:chunk_id>')
+def get_chunk(chunk_id):
+    """Source snippet of a cited chunk of the current tenant, from chunk_cache when it was retrieved recently"""
+    if 'logged_in' not in session or not session['logged_in']:
+        return jsonify({'error': 'Not logged in'}), 401
+    
+    tenant = session.get('tenant', DEFAULT_TENANT)
+    chunk = chunk_cache.get((tenant_key(tenant), chunk_id))
+    if chunk is None:
+        dbname = session.get('dbname', config.get('pgdbname', ''))
+        user = session.get('pguser', config.get('pguser', ''))
+        password = session.get('pgpassword', config.get('pgpassword', ''))
+        host = session.get('pghost', config.get('pghost', ''))
+        port = session.get('pgport', config.get('pgport', ''))
+        conn = get_read_connection(dbname, user, password, host, port)
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT chuncks, filename, locator FROM data WHERE tenant = %s AND id = %s', (tenant_key(tenant), chunk_id))
+            row = cur.fetchone()
+            cur.close()
+        finally:
+            conn.close()
+        if row is None:
+            return jsonify({'error': 'Chunk not found'}), 404
+        chunk = {'id': chunk_id, 'filename': row[1], 'locator': row[2] or {}, 'text': row[0]}
+        chunk_cache.put((tenant_key(tenant), chunk_id), chunk)
+    return jsonify(chunk)
+
 @app.route('/system-prompt', methods=['GET', 'POST'])
 def system_prompt():
     if 'logged_in' not in session or not session['logged_in']:
@@ -1101,14 +4049,17 @@ def list_files():
     password = session.get('pgpassword', config.get('pgpassword', ''))
     host = session.get('pghost', config.get('pghost', ''))
     port = session.get('pgport', config.get('pgport', ''))
+    tenant = session.get('tenant', DEFAULT_TENANT)
     
     try:
-        conn = get_db_connection(dbname, user, password, host, port)
-        cur = conn.cursor()
-        cur.execute("SELECT DISTINCT filename FROM data ORDER BY filename")
-        results = cur.fetchall()
-        cur.close()
-        conn.close()
+        conn = get_read_connection(dbname, user, password, host, port)
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT DISTINCT filename FROM data WHERE tenant = %s ORDER BY filename", (tenant,))
+            results = cur.fetchall()
+            cur.close()
+        finally:
+            conn.close()
         
         files = [row[0] for row in results]
         
@@ -1138,15 +4089,676 @@ def argus():
         password = session.get('pgpassword', config.get('pgpassword', ''))
         host = session.get('pghost', config.get('pghost', ''))
         port = session.get('pgport', config.get('pgport', ''))
+        tenant = session.get('tenant', DEFAULT_TENANT)
+        
+        action = request.form.get('action', 'sync')
         
         try:
-            total = loaddataargus(argusdb, arguscollection, argusurl, arguskey, 
-                                 dbname, user, password, host, port)
-            flash(f'Successfully loaded {total} records from Argus Accelerator!', 'success')
+            ensure_tenant_partition(tenant, dbname, user, password, host, port)
+            if action == 'schedule':
+                interval = max(60, int(request.form.get('interval', 900)))
+                schedule_argus_sync(interval, argusdb, arguscollection, argusurl, arguskey,
+                                    dbname, user, password, host, port, tenant)
+                flash(f'Argus sync scheduled every {interval} seconds.', 'success')
+            elif action == 'stop':
+                if stop_argus_sync((tenant_key(tenant), argusurl + '/' + argusdb + '/' + arguscollection)):
+                    flash('Scheduled Argus sync stopped.', 'success')
+                else:
+                    flash('No scheduled Argus sync for this collection.', 'info')
+            else:
+                total = loaddataargus(argusdb, arguscollection, argusurl, arguskey, 
+                                     dbname, user, password, host, port, tenant)
+                flash(f'Successfully synced {total} new or changed records from Argus Accelerator!', 'success')
         except Exception as e:
             flash(f'Error loading from Argus: {str(e)}', 'error')
     
-    return render_template('argus.html')
+    tenant = tenant_key(session.get('tenant', DEFAULT_TENANT))
+    scheduled = [source for job_tenant, source in _argus_jobs if job_tenant == tenant]
+    return render_template('argus.html', scheduled=scheduled)
+
+@app.route('/indexes', methods=['GET', 'POST'])
+def manage_indexes():
+    """List, drop or rebuild the vector indexes of the current tenant"""
+    if 'logged_in' not in session or not session['logged_in']:
+        return jsonify({'error': 'Not logged in'}), 401
+    
+    dbname = session.get('dbname', config.get('pgdbname', ''))
+    user = session.get('pguser', config.get('pguser', ''))
+    password = session.get('pgpassword', config.get('pgpassword', ''))
+    host = session.get('pghost', config.get('pghost', ''))
+    port = session.get('pgport', config.get('pgport', ''))
+    tenant = session.get('tenant', DEFAULT_TENANT)
+    
+    try:
+        if request.method == 'GET':
+            conn = get_db_connection(dbname, user, password, host, port)
+            cur = conn.cursor()
+            indexes = []
+            for table in VECTOR_INDEX_TABLES:
+                method, build_params, search_params = get_vector_index_settings(cur, table, tenant)
+                indexes.append({'table': table, 'name': vector_index_name(table, tenant), 'method': method,
+                                'build_params': build_params, 'search_params': search_params,
+                                'layout': get_vector_layout(cur, table, tenant, method)})
+            cur.close()
+            conn.close()
+            return jsonify({'success': True, 'tenant': tenant, 'indexes': indexes, 'methods': VECTOR_INDEX_METHODS,
+                            'quantizations': VECTOR_QUANTIZATIONS})
+        
+        data = request.get_json() or {}
+        action = data.get('action', 'rebuild')
+        table = data.get('table', 'data')
+        if table not in VECTOR_INDEX_TABLES:
+            return jsonify({'success': False, 'error': f'Unknown table: {table}'}), 400
+        
+        if action == 'drop':
+            report = drop_vector_index(table, tenant, dbname, user, password, host, port, bool(data.get('concurrently')))
+        elif action == 'recall':
+            report = measure_index_recall(table, tenant, dbname, user, password, host, port,
+                                          int(data.get('sample_size', 20)), int(data.get('k', 10)), data.get('search_params'))
+        elif action == 'compare':
+            report = compare_vector_layouts(table, tenant, dbname, user, password, host, port, data.get('layouts', []),
+                                            int(data.get('sample_size', 20)), int(data.get('k', 10)))
+        else:
+            report = build_vector_index(table, tenant, dbname, user, password, host, port,
+                                        data.get('method'), data.get('build_params'), data.get('search_params'),
+                                        bool(data.get('concurrently')), data.get('quantization') or None,
+                                        data.get('index_dims') or None)
+        return jsonify({'success': True, 'report': report})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/embeddings', methods=['GET', 'POST'])
+def manage_embeddings():
+    """Show the schema version and embedding columns, or start/switch/cancel an embedding model (admins only)"""
+    if 'logged_in' not in session or not session['logged_in']:
+        return jsonify({'error': 'Not logged in'}), 401
+    if request.method == 'POST' and not is_admin():
+        return jsonify({'success': False, 'error': 'Changing the embedding model is reserved to ADMIN_USERS'}), 403
+    
+    dbname = session.get('dbname', config.get('pgdbname', ''))
+    user = session.get('pguser', config.get('pguser', ''))
+    password = session.get('pgpassword', config.get('pgpassword', ''))
+    host = session.get('pghost', config.get('pghost', ''))
+    port = session.get('pgport', config.get('pgport', ''))
+    
+    try:
+        if request.method == 'POST':
+            data = request.get_json() or {}
+            if data.get('action') == 'switch':
+                switch_embedding_model(data.get('column', ''), dbname, user, password, host, port)
+            elif data.get('action') == 'cancel':
+                cancel_embedding_migration(data.get('column', ''), dbname, user, password, host, port)
+            else:
+                column = start_embedding_migration(data.get('model', ''), int(data.get('dims', 0)),
+                                                   dbname, user, password, host, port,
+                                                   bool(data.get('auto_switch', True)))
+                return jsonify({'success': True, 'column': column})
+        
+        conn = get_db_connection(dbname, user, password, host, port)
+        cur = conn.cursor()
+        cur.execute('SELECT COALESCE(MAX(version), 0) FROM schema_migrations')
+        version = cur.fetchone()[0]
+        cur.execute('SELECT column_name, model, dims, status, backfilled FROM embedding_models ORDER BY date_added')
+        models = [{'column': row[0], 'model': row[1], 'dims': row[2], 'status': row[3], 'backfilled': row[4]}
+                  for row in cur.fetchall()]
+        cur.close()
+        conn.close()
+        return jsonify({'success': True, 'schema_version': version,
+                        'latest_version': MIGRATIONS[-1][0], 'embedding_models': models})
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/openai-scheduler')
+def openai_scheduler_status():
+    """Return the Azure OpenAI scheduler budgets, queue and counters"""
+    if 'logged_in' not in session or not session['logged_in']:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    with openai_scheduler.condition:
+        return jsonify({
+            'running': openai_scheduler.running,
+            'waiting': len(openai_scheduler.waiting),
+            'request_budget': round(openai_scheduler.request_budget, 1),
+            'token_budget': round(openai_scheduler.token_budget),
+            'stats': dict(openai_scheduler.stats)
+        })
+
+@app.route('/admission')
+def admission_status():
+    """Return the chat admission limits, queue depth and shed and degraded rates"""
+    if 'logged_in' not in session or not session['logged_in']:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    return jsonify(dict(admission.metrics(), max_concurrent=admission.max_concurrent, max_per_user=admission.max_per_user,
+                        max_queue=admission.max_queue, queue_timeout=admission.queue_timeout, degrade_at=admission.degrade_at,
+                        batch=dict(batch_admission.metrics(), max_concurrent=batch_admission.max_concurrent,
+                                   max_per_user=batch_admission.max_per_user)))
+
+@app.route('/retrieval-cache', methods=['GET', 'POST'])
+def retrieval_cache_status():
+    """Retrieval cache counters (GET) or clear the current tenant's entries (POST)"""
+    if 'logged_in' not in session or not session['logged_in']:
+        return jsonify({'error': 'Not logged in'}), 401
+    
+    if request.method == 'POST':
+        retrieval_cache.clear(session.get('tenant', DEFAULT_TENANT))
+    return jsonify({'success': True, 'entries': len(retrieval_cache.entries), 'max_entries': retrieval_cache.max_entries,
+                    'ttl': retrieval_cache.ttl, 'stats': retrieval_cache.stats})
+
+@app.route('/cache-warmer', methods=['GET', 'POST'])
+def cache_warmer_status():
+    """Last cache warming report and recent hit rate (GET), or warm the tenant's cache now (POST)"""
+    if 'logged_in' not in session or not session['logged_in']:
+        return jsonify({'error': 'Not logged in'}), 401
+    
+    dbname = session.get('dbname', config.get('pgdbname', ''))
+    user = session.get('pguser', config.get('pguser', ''))
+    password = session.get('pgpassword', config.get('pgpassword', ''))
+    host = session.get('pghost', config.get('pghost', ''))
+    port = session.get('pgport', config.get('pgport', ''))
+    tenant = session.get('tenant', DEFAULT_TENANT)
+    
+    try:
+        if request.method == 'POST':
+            schedule_cache_warm(tenant, dbname, user, password, host, port, delay=0)
+        conn = get_read_connection(dbname, user, password, host, port)
+        try:
+            cur = conn.cursor()
+            recent = recent_cache_hit_rate(cur, tenant)
+            cur.close()
+        finally:
+            conn.close()
+        return jsonify({'success': True, 'enabled': CACHE_WARM_ENABLED, 'report': cache_warm_reports.get(tenant_key(tenant)),
+                        'last_hour': recent})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/replicas')
+def replicas_status():
+    """Health, lag and read counts of the configured read replicas"""
+    if 'logged_in' not in session or not session['logged_in']:
+        return jsonify({'error': 'Not logged in'}), 401
+    
+    dbname = session.get('dbname', config.get('pgdbname', ''))
+    user = session.get('pguser', config.get('pguser', ''))
+    password = session.get('pgpassword', config.get('pgpassword', ''))
+    port = session.get('pgport', config.get('pgport', ''))
+    
+    replicas = {replica: dict(replica_health(replica, dbname, user, password, port)) for replica in PG_REPLICAS}
+    return jsonify({'success': True, 'primary': session.get('pghost', config.get('pghost', '')),
+                    'max_lag_seconds': REPLICA_MAX_LAG_SECONDS, 'replicas': replicas})
+
+@app.route('/debug/slow')
+def debug_slow():
+    """Slow retrieval queries with their plans and sampled request profiles (?format=json for JSON, admins only)"""
+    if 'logged_in' not in session or not session['logged_in']:
+        return redirect(url_for('login'))
+    if not is_admin():
+        return jsonify({'error': 'Reserved to ADMIN_USERS'}), 403
+    
+    if request.args.get('format') == 'json':
+        return jsonify({'enabled': PROFILE_ENABLED, 'slow_query_ms': SLOW_QUERY_MS, 'sample_rate': PROFILE_SAMPLE_RATE,
+                        'slow_queries': list(slow_queries), 'profiles': list(request_profiles)})
+    return render_template('debug_slow.html', enabled=PROFILE_ENABLED, slow_query_ms=SLOW_QUERY_MS,
+                           sample_rate=PROFILE_SAMPLE_RATE, slow_queries=list(slow_queries), profiles=list(request_profiles))
+
+@app.route('/startup-report')
+def startup_report():
+    """Return the import cost per subsystem and how long the app took to become ready"""
+    return jsonify({
+        'ready_seconds': round(APP_READY_SECONDS, 4),
+        'imports_seconds': {name: round(seconds, 4) for name, seconds in IMPORT_TIMINGS.items()},
+        'lazy_subsystems_pending': [name for name in ('openai', 'upload', 'argus', 'rerank') if name not in IMPORT_TIMINGS]
+    })
+
+# Create azure_openai.create_embeddings as a deterministic SQL function, for a local PostgreSQL
+def install_stub_embedder(dbname, user, password, host, port, dims):
+    """Hashed bag-of-words embeddings of the given size, computed in SQL.
+
+    Lets the schema, triggers and searches run without Azure OpenAI (CI,
+    evaluation). Refuses to run where the azure_ai extension is installed.
+    """
+    dims = int(dims)
+    conn = get_db_connection(dbname, user, password, host, port)
+    cur = conn.cursor()
+    cur.execute("SELECT 1 FROM pg_extension WHERE extname = 'azure_ai'")
+    if cur.fetchone():
+        cur.close()
+        conn.close()
+        raise RuntimeError('azure_ai is installed on this server, the stub embedder would replace it')
+    cur.execute('CREATE EXTENSION IF NOT EXISTS vector')
+    cur.execute('CREATE SCHEMA IF NOT EXISTS azure_openai')
+    cur.execute("""CREATE OR REPLACE FUNCTION azure_openai.create_embeddings(deployment_name text, input text,
+                       timeout_ms integer DEFAULT 3600000, throw_on_error boolean DEFAULT true,
+                       max_attempts integer DEFAULT 1, retry_delay_ms integer DEFAULT 1000)
+                   RETURNS real[] LANGUAGE sql IMMUTABLE AS $$
+                   WITH counts AS (
+                       SELECT ((hashtext(token)::bigint % DIMS) + DIMS) % DIMS AS i, count(*)::real AS w
+                       FROM regexp_split_to_table(lower(input), '\\W+') AS token
+                       WHERE token <> ''
+                       GROUP BY 1),
+                   norm AS (SELECT GREATEST(sqrt(sum(w * w)), 1e-6) AS n FROM counts)
+                   SELECT array_agg(COALESCE(c.w, 0) / norm.n ORDER BY g.i)::real[]
+                   FROM generate_series(0, DIMS - 1) AS g(i)
+                   LEFT JOIN counts c ON c.i = g.i
+                   CROSS JOIN norm
+                   $$""".replace('DIMS', str(dims)))
+    # Batched form used by answer_batch, one row per input in order
+    cur.execute("""CREATE OR REPLACE FUNCTION azure_openai.create_embeddings(deployment_name text, input text[],
+                       batch_size integer DEFAULT 100, timeout_ms integer DEFAULT 3600000, throw_on_error boolean DEFAULT true,
+                       max_attempts integer DEFAULT 1, retry_delay_ms integer DEFAULT 1000)
+                   RETURNS SETOF real[] LANGUAGE sql IMMUTABLE AS $$
+                   SELECT azure_openai.create_embeddings(deployment_name, q) FROM unnest(input) WITH ORDINALITY AS t(q, n) ORDER BY n
+                   $$""")
+    conn.commit()
+    cur.close()
+    conn.close()
+
+# Replace a tenant's evaluation chunks with the ones of a JSONL corpus ({"filename", "text"} per line)
+def load_eval_corpus(path, tenant, dbname, user, password, host, port, language=DEFAULT_LANGUAGE):
+    ensure_tenant_partition(tenant, dbname, user, password, host, port)
+    conn = get_db_connection(dbname, user, password, host, port)
+    cur = conn.cursor()
+    cur.execute("DELETE FROM data WHERE tenant = %s AND typefile = 'eval'", (tenant_key(tenant),))
+    conn.commit()
+    cur.close()
+    conn.close()
+    count = 0
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                item = json.loads(line)
+                insert_chunk(tenant_key(tenant), item['filename'], 'eval', item['text'], item.get('language', language),
+                             dbname, user, password, host, port)
+                count += 1
+    invalidate_cache_for_files(tenant, [], dbname, user, password, host, port)
+    return count
+
+# Recall@k, reciprocal rank and nDCG@k of a ranking against a set of relevant keys
+def ranking_metrics(ranked, relevant, k):
+    ranked = list(dict.fromkeys(ranked))[:k]
+    hits = [1 if key in relevant else 0 for key in ranked]
+    recall = sum(hits) / len(relevant) if relevant else 0.0
+    reciprocal_rank = next((1.0 / (rank + 1) for rank, hit in enumerate(hits) if hit), 0.0)
+    dcg = sum(hit / math.log2(rank + 2) for rank, hit in enumerate(hits))
+    idcg = sum(1.0 / math.log2(rank + 2) for rank in range(min(len(relevant), k)))
+    return recall, reciprocal_rank, dcg / idcg if idcg else 0.0
+
+# Nearest-rank percentile of a list of numbers
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, int(math.ceil(p / 100.0 * len(ordered))) - 1)]
+
+# Run labelled questions through retrieve for each configuration and aggregate the metrics
+def evaluate_retrieval(questions, configurations, tenant, dbname, user, password, host, port, repeat=1):
+    """questions: dicts with 'question' and 'expected_files' or 'expected_chunks' (ids).
+
+    configurations: dicts with 'search_type' and optional 'k', 'max_distance',
+    'rerank' and 'search_params'. Returns one report per configuration.
+    """
+    conn = get_db_connection(dbname, user, password, host, port)
+    cur = conn.cursor()
+    reports = []
+    for configuration in configurations:
+        typesearch = configuration['search_type']
+        rerank_mode = configuration.get('rerank') or (RERANK_MODE if RERANK_ENABLED else 'off')
+        k = configuration.get('k') or (RERANK_TOP_K if rerank_mode != 'off' else RETRIEVAL_K.get(typesearch, 0))
+        recalls, reciprocal_ranks, ndcgs, latencies = [], [], [], []
+        for question in questions:
+            by_chunk = 'expected_chunks' in question
+            relevant = set(question['expected_chunks'] if by_chunk else question.get('expected_files', []))
+            for _ in range(max(1, repeat)):
+                start = time.perf_counter()
+                rows = retrieve(cur, question['question'], typesearch, tenant, question.get('language', DEFAULT_LANGUAGE),
+                                configuration.get('search_params'), None, k, configuration.get('max_distance'), rerank_mode)
+                latencies.append((time.perf_counter() - start) * 1000)
+                conn.commit()
+            recall, reciprocal_rank, ndcg = ranking_metrics([row[0] if by_chunk else row[2] for row in rows], relevant, k)
+            recalls.append(recall)
+            reciprocal_ranks.append(reciprocal_rank)
+            ndcgs.append(ndcg)
+        count = len(questions) or 1
+        reports.append(dict(configuration, rerank=rerank_mode, k=k, questions=len(questions),
+                            recall_at_k=round(sum(recalls) / count, 4), mrr=round(sum(reciprocal_ranks) / count, 4),
+                            ndcg_at_k=round(sum(ndcgs) / count, 4),
+                            p50_ms=round(percentile(latencies, 50) or 0, 2), p95_ms=round(percentile(latencies, 95) or 0, 2),
+                            p99_ms=round(percentile(latencies, 99) or 0, 2)))
+    cur.close()
+    conn.close()
+    return reports
+
+@app.cli.command('evaluate')
+@click.argument('questions_file', type=click.Path(exists=True, dir_okay=False))
+@click.option('--search-type', 'search_types', multiple=True, default=('vector', 'full text', 'hybrid'), show_default=True,
+              help='Search type to evaluate; repeat to compare several.')
+@click.option('--k', 'ks', multiple=True, type=int, help='Chunks retrieved per question; repeat to sweep.')
+@click.option('--max-distance', 'max_distances', multiple=True, type=float, help='Vector distance cut-off; repeat to sweep.')
+@click.option('--rerank', 'rerank_modes', multiple=True, type=click.Choice(['off', 'bm25', 'cross-encoder']),
+              help='Rerank stage; repeat to sweep.')
+@click.option('--search-params', 'search_params_list', multiple=True, help='JSON index search parameters; repeat to sweep.')
+@click.option('--tenant', default='eval', show_default=True)
+@click.option('--corpus', type=click.Path(exists=True, dir_okay=False), help='JSONL corpus loaded into the tenant first.')
+@click.option('--stub-embedder', is_flag=True, help='Install the deterministic SQL embedder (local PostgreSQL only).')
+@click.option('--repeat', default=1, show_default=True, help='Runs per question, for latency percentiles.')
+@click.option('--output', type=click.Path(dir_okay=False), help='Also write the report as JSON.')
+@click.option('--min-recall', type=float, help='Exit with status 1 if any configuration has a lower recall@k.')
+def evaluate_command(questions_file, search_types, ks, max_distances, rerank_modes, search_params_list, tenant, corpus,
+                     stub_embedder, repeat, output, min_recall):
+    """Report recall@k, MRR, nDCG@k and latency percentiles of retrieval on labelled questions."""
+    dbname = config.get('pgdbname', '')
+    user = config.get('pguser', '')
+    password = config.get('pgpassword', '')
+    host = config.get('pghost', '')
+    port = config.get('pgport', '')
+    if stub_embedder:
+        install_stub_embedder(dbname, user, password, host, port, config.get('embeddingsize', 1536))
+    if stub_embedder or corpus:
+        intialize(dbname, user, password, host, port, config.get('embeddingsize', 1536),
+                  DEFAULT_EMBEDDINGS_MODEL, tenant)
+    if corpus:
+        click.echo(f"Loaded {load_eval_corpus(corpus, tenant, dbname, user, password, host, port)} chunks into {tenant_key(tenant)}")
+
+    with open(questions_file, encoding='utf-8') as f:
+        questions = [json.loads(line) for line in f if line.strip()]
+    configurations = [{'search_type': typesearch, 'k': k, 'max_distance': max_distance, 'rerank': rerank_mode,
+                       'search_params': json.loads(search_params) if search_params else None}
+                      for typesearch, k, max_distance, rerank_mode, search_params in itertools.product(
+                          search_types, ks or [None], max_distances or [None], rerank_modes or [None], search_params_list or [None])]
+    reports = evaluate_retrieval(questions, configurations, tenant_key(tenant), dbname, user, password, host, port, repeat)
+
+    click.echo(f"{'search type':<12} {'k':>3} {'dist':>5} {'rerank':<13} {'recall':>7} {'mrr':>6} {'ndcg':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for report in reports:
+        click.echo(f"{report['search_type']:<12} {report['k']:>3} {report['max_distance'] or VECTOR_MAX_DISTANCE:>5} {report['rerank']:<13} "
+                   f"{report['recall_at_k']:>7} {report['mrr']:>6} {report['ndcg_at_k']:>6} "
+                   f"{report['p50_ms']:>8} {report['p95_ms']:>8} {report['p99_ms']:>8}"
+                   + (f"  {json.dumps(report['search_params'])}" if report['search_params'] else ''))
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(reports, f, indent=2)
+    if min_recall is not None and any(report['recall_at_k'] < min_recall for report in reports):
+        raise SystemExit(1)
+
+# Tables in a snapshot, in restore order
+SNAPSHOT_TABLES = ['system_prompts', 'data', 'tablecahedoc']
+
+# Rows per snapshot part file
+SNAPSHOT_PART_ROWS = int(config.get('SNAPSHOT_PART_ROWS', 5000))
+
+# Columns a snapshot carries: generated ones are recomputed, extra embedding columns are left out
+def snapshot_columns(cur, table):
+    cur.execute("""SELECT column_name FROM information_schema.columns
+                   WHERE table_schema = 'public' AND table_name = %s AND is_generated = 'NEVER'
+                   ORDER BY ordinal_position""", (table,))
+    return [row[0] for row in cur.fetchall() if not row[0].startswith('dvector_')]
+
+# SHA-256 of a file, read in blocks
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Replace the manifest atomically, so an interrupted export never leaves it half written
+def write_manifest(path, manifest):
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+# Export data, tablecahedoc and system_prompts with their vectors as binary COPY parts
+def export_snapshot(directory, dbname, user, password, host, port, tenant=None, part_rows=SNAPSHOT_PART_ROWS):
+    """Write <table>.<n>.bin parts and a manifest.json to directory, resuming a previous export.
+
+    Each part is a keyset page (by id) in PostgreSQL binary COPY format, so
+    vectors are copied as-is. The manifest is rewritten after every part;
+    running the export again continues after the last complete part.
+    """
+    os.makedirs(directory, exist_ok=True)
+    manifest_path = os.path.join(directory, 'manifest.json')
+    conn = get_db_connection(dbname, user, password, host, port)
+    cur = conn.cursor()
+    if os.path.exists(manifest_path):
+        with open(manifest_path, encoding='utf-8') as f:
+            manifest = json.load(f)
+    else:
+        cur.execute("SELECT model, dims FROM embedding_models WHERE column_name = 'dvector'")
+        model, dims = cur.fetchone()
+        cur.execute('SELECT max(version) FROM schema_migrations')
+        manifest = {'snapshot_id': str(uuid.uuid4()), 'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                    'schema_version': cur.fetchone()[0], 'embedding_model': model, 'embedding_dims': dims,
+                    'tenant': tenant_key(tenant) if tenant else None, 'complete': False,
+                    'tables': {table: {'columns': snapshot_columns(cur, table), 'parts': [], 'done': False}
+                               for table in SNAPSHOT_TABLES}}
+    conn.commit()
+    tenant = manifest['tenant']
+
+    # One snapshot of the database for every part written by this run
+    cur.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+    for table in SNAPSHOT_TABLES:
+        state = manifest['tables'][table]
+        if state['done']:
+            continue
+        columns = ', '.join(state['columns'])
+        if tenant is None:
+            condition = ''
+        elif table == 'system_prompts':
+            condition = cur.mogrify(' AND username IN (SELECT username FROM userapp WHERE tenant = %s)', (tenant,)).decode()
+        else:
+            condition = cur.mogrify(' AND tenant = %s', (tenant,)).decode()
+        last_id = state['parts'][-1]['last_id'] if state['parts'] else 0
+        while True:
+            where = ' FROM ' + table + ' WHERE id > ' + str(int(last_id)) + condition + ' ORDER BY id LIMIT ' + str(int(part_rows))
+            cur.execute('SELECT count(*), max(id) FROM (SELECT id' + where + ') p')
+            rows, page_last_id = cur.fetchone()
+            if not rows:
+                break
+            name = f"{table}.{len(state['parts']):05d}.bin"
+            path = os.path.join(directory, name)
+            with open(path + '.tmp', 'wb') as f:
+                cur.copy_expert('COPY (SELECT ' + columns + where + ') TO STDOUT (FORMAT binary)', f)
+            os.replace(path + '.tmp', path)
+            state['parts'].append({'file': name, 'rows': rows, 'last_id': page_last_id, 'sha256': file_sha256(path)})
+            if table in VECTOR_INDEX_TABLES:
+                cur.execute('SELECT tenant, count(*) FROM (SELECT tenant' + where + ') p GROUP BY tenant')
+                counts = state.setdefault('tenants', {})
+                for part_tenant, count in cur.fetchall():
+                    counts[part_tenant] = counts.get(part_tenant, 0) + count
+            write_manifest(manifest_path, manifest)
+            log_event(logging.INFO, 'snapshot part exported', part=name, rows=rows)
+            last_id = page_last_id
+        state['done'] = True
+        write_manifest(manifest_path, manifest)
+    conn.commit()
+    cur.close()
+    conn.close()
+
+    manifest['complete'] = True
+    write_manifest(manifest_path, manifest)
+    return manifest
+
+# Restore a snapshot written by export_snapshot without calling the embedding model
+def import_snapshot(directory, dbname, user, password, host, port):
+    """Load every part not yet recorded in snapshot_imports, one transaction per part.
+
+    Parts are copied into a staging table and inserted together with their
+    snapshot_imports row, so a part interrupted half way was rolled back and is
+    simply loaded again. Chunks and answers keep their ids (cached answers cite
+    chunk ids) and their vectors; the embedding triggers only fill missing ones.
+    A new import is refused for tenants that already hold chunks or answers, and
+    a part whose row count differs from the manifest or whose ids are taken
+    fails the import. Prompts, which nothing refers to, get new ids and are
+    skipped when the user already has a prompt of that name.
+    """
+    with open(os.path.join(directory, 'manifest.json'), encoding='utf-8') as f:
+        manifest = json.load(f)
+    if not manifest.get('complete'):
+        raise ValueError('The snapshot export is not complete, run the export again to finish it')
+
+    conn = get_db_connection(dbname, user, password, host, port)
+    cur = conn.cursor()
+    cur.execute("SELECT model, dims FROM embedding_models WHERE column_name = 'dvector'")
+    model, dims = cur.fetchone()
+    if (model, dims) != (manifest['embedding_model'], manifest['embedding_dims']):
+        cur.close()
+        conn.close()
+        raise ValueError(f"Snapshot vectors come from {manifest['embedding_model']} ({manifest['embedding_dims']}), "
+                         f"this database uses {model} ({dims})")
+    cur.execute('SELECT part FROM snapshot_imports WHERE snapshot_id = %s', (manifest['snapshot_id'],))
+    done = {row[0] for row in cur.fetchall()}
+    if not done:
+        occupied = set()
+        for table in VECTOR_INDEX_TABLES:
+            cur.execute('SELECT DISTINCT tenant FROM ' + table + ' WHERE tenant = ANY(%s)',
+                        (list(manifest['tables'][table].get('tenants', {})),))
+            occupied.update(row[0] for row in cur.fetchall())
+        if occupied:
+            cur.close()
+            conn.close()
+            raise ValueError('Tenants ' + ', '.join(sorted(occupied)) + ' already have chunks or cached answers, '
+                             'delete them before importing this snapshot')
+    conn.commit()
+
+    report = {'snapshot_id': manifest['snapshot_id'], 'parts': 0, 'rows_copied': 0, 'rows_inserted': 0, 'skipped_parts': len(done)}
+    for table in SNAPSHOT_TABLES:
+        state = manifest['tables'][table]
+        columns = ', '.join(state['columns'])
+        tenants = state.get('tenants', {})
+        for tenant in tenants:
+            ensure_tenant_partition(tenant, dbname, user, password, host, port)
+        with ExitStack() as stack:
+            # Large restores rebuild each tenant's chunk index once instead of row by row
+            if table == 'data':
+                for tenant, count in tenants.items():
+                    stack.enter_context(bulk_load(tenant, count, dbname, user, password, host, port))
+            for part in state['parts']:
+                if part['file'] in done:
+                    continue
+                path = os.path.join(directory, part['file'])
+                if file_sha256(path) != part['sha256']:
+                    raise ValueError(f"{part['file']} does not match its checksum")
+                cur.execute('CREATE TEMP TABLE snapshot_stage (LIKE ' + table + ') ON COMMIT DROP')
+                with open(path, 'rb') as f:
+                    cur.copy_expert('COPY snapshot_stage (' + columns + ') FROM STDIN (FORMAT binary)', f)
+                cur.execute('SELECT count(*) FROM snapshot_stage')
+                copied = cur.fetchone()[0]
+                if copied != part['rows']:
+                    conn.rollback()
+                    raise ValueError(f"{part['file']} holds {copied} rows, the manifest expects {part['rows']}")
+                if table == 'system_prompts':
+                    # Imported prompts only become active for users without an active prompt here
+                    prompt_columns = [column for column in state['columns'] if column != 'id']
+                    values = {'is_active': 's.is_active AND NOT EXISTS (SELECT 1 FROM system_prompts a '
+                                           'WHERE a.username = s.username AND a.is_active)'}
+                    cur.execute('INSERT INTO system_prompts (' + ', '.join(prompt_columns) + ') SELECT '
+                                + ', '.join(values.get(column, 's.' + column) for column in prompt_columns)
+                                + ''' FROM snapshot_stage s WHERE NOT EXISTS (SELECT 1 FROM system_prompts p
+                                      WHERE p.username = s.username AND p.prompt_name = s.prompt_name)''')
+                else:
+                    cur.execute('SELECT count(*) FROM snapshot_stage JOIN ' + table + ' USING (tenant, id)')
+                    taken = cur.fetchone()[0]
+                    if taken:
+                        conn.rollback()
+                        raise ValueError(f"{taken} rows of {part['file']} have ids already used in {table}")
+                    cur.execute('INSERT INTO ' + table + ' (' + columns + ') SELECT ' + columns + ' FROM snapshot_stage')
+                inserted = cur.rowcount
+                cur.execute('''INSERT INTO snapshot_imports (snapshot_id, part, rows_copied, rows_inserted)
+                               VALUES (%s, %s, %s, %s)''', (manifest['snapshot_id'], part['file'], part['rows'], inserted))
+                conn.commit()
+                report['parts'] += 1
+                report['rows_copied'] += part['rows']
+                report['rows_inserted'] += inserted
+                log_event(logging.INFO, 'snapshot part imported', part=part['file'], rows=part['rows'], inserted=inserted)
+        # Chunks and answers kept their ids, so new rows must be numbered after them
+        if table in VECTOR_INDEX_TABLES:
+            cur.execute("SELECT setval(pg_get_serial_sequence(%s, 'id'), GREATEST((SELECT max(id) FROM " + table + "), 1))", (table,))
+            conn.commit()
+
+    # Every chunk and answer of the manifest must have been inserted, including by earlier runs
+    parts = [part for table in VECTOR_INDEX_TABLES for part in manifest['tables'][table]['parts']]
+    cur.execute('SELECT coalesce(sum(rows_inserted), 0) FROM snapshot_imports WHERE snapshot_id = %s AND part = ANY(%s)',
+                (manifest['snapshot_id'], [part['file'] for part in parts]))
+    inserted = cur.fetchone()[0]
+    conn.commit()
+    cur.close()
+    conn.close()
+    expected = sum(part['rows'] for part in parts)
+    if inserted != expected:
+        raise ValueError(f"Snapshot {manifest['snapshot_id']} has {expected} rows, {inserted} were inserted")
+
+    # Restored chunks change the corpus; restored answers are carried over to the new version
+    for tenant in set(manifest['tables']['data'].get('tenants', {})) | set(manifest['tables']['tablecahedoc'].get('tenants', {})):
+        invalidate_cache_for_files(tenant, [], dbname, user, password, host, port)
+    return report
+
+@app.cli.command('export-snapshot')
+@click.argument('directory', type=click.Path(file_okay=False))
+@click.option('--tenant', help='Only export this tenant (and the prompts of its users).')
+@click.option('--part-rows', default=SNAPSHOT_PART_ROWS, show_default=True, help='Rows per part file.')
+def export_snapshot_command(directory, tenant, part_rows):
+    """Export chunks, cached answers and prompts with their vectors (resumes an interrupted export)."""
+    manifest = export_snapshot(directory, config.get('pgdbname', ''), config.get('pguser', ''), config.get('pgpassword', ''),
+                               config.get('pghost', ''), config.get('pgport', ''), tenant, part_rows)
+    parts = sum(len(state['parts']) for state in manifest['tables'].values())
+    click.echo(f"Snapshot {manifest['snapshot_id']}: {parts} parts in {directory}")
+
+@app.cli.command('import-snapshot')
+@click.argument('directory', type=click.Path(exists=True, file_okay=False))
+def import_snapshot_command(directory):
+    """Restore a snapshot without re-embedding (resumes an interrupted import)."""
+    dbname = config.get('pgdbname', '')
+    user = config.get('pguser', '')
+    password = config.get('pgpassword', '')
+    host = config.get('pghost', '')
+    port = config.get('pgport', '')
+    migrate(dbname, user, password, host, port, config.get('embeddingsize', 1536),
+            DEFAULT_EMBEDDINGS_MODEL)
+    report = import_snapshot(directory, dbname, user, password, host, port)
+    click.echo(json.dumps(report, indent=2))
+
+@app.cli.command('batch-answer')
+@click.argument('questions_file', type=click.File('r', encoding='utf-8'))
+@click.option('--username', required=True, help='User whose system prompt and answer cache are used.')
+@click.option('--tenant', default=DEFAULT_TENANT, show_default=True)
+@click.option('--search-type', 'typesearch', default='vector', show_default=True,
+              type=click.Choice(['vector', 'full text', 'hybrid']))
+@click.option('--language', default=DEFAULT_LANGUAGE, show_default=True)
+@click.option('--concurrency', default=BATCH_CONCURRENCY, show_default=True, help='Questions answered at the same time.')
+@click.option('--embed-size', default=BATCH_EMBED_SIZE, show_default=True, help='Questions embedded per call.')
+@click.option('--output', type=click.File('w', encoding='utf-8'), default='-', help='JSONL results (default: stdout).')
+def batch_answer_command(questions_file, username, tenant, typesearch, language, concurrency, embed_size, output):
+    """Answer a file of questions (JSONL or one per line) and warm the answer cache."""
+    openai_client = get_openai_client(config.get('openai_key', ''), config.get('openai_version', ''),
+                                      config.get('openai_endpoint', ''))
+    failed = 0
+    for result in answer_batch(read_batch_questions(questions_file), openai_client, username, tenant_key(tenant), typesearch,
+                               config.get('pgdbname', ''), config.get('pguser', ''), config.get('pgpassword', ''),
+                               config.get('pghost', ''), config.get('pgport', ''), config.get('AZURE_OPENAI_CHAT_MODEL', ''),
+                               text_search_language(language), concurrency, embed_size):
+        failed += 'error' in result
+        output.write(json.dumps(result) + '\n')
+        output.flush()
+    if failed:
+        click.echo(f'{failed} questions failed', err=True)
+        raise SystemExit(1)
+
+@app.cli.command('warm-cache')
+@click.option('--tenant', default=DEFAULT_TENANT, show_default=True)
+@click.option('--top', default=CACHE_WARM_TOP, show_default=True, help='Frequent questions mined from the history.')
+def warm_cache_command(tenant, top):
+    """Pre-compute the answers to the tenant's frequent questions and report the hit rate restored."""
+    report = warm_cache(tenant, config.get('pgdbname', ''), config.get('pguser', ''), config.get('pgpassword', ''),
+                        config.get('pghost', ''), config.get('pgport', ''), top)
+    click.echo(json.dumps(report, indent=2))
+    if report['status'] == 'error':
+        raise SystemExit(1)
+
+# Time from the first import to the app being able to serve requests
+APP_READY_SECONDS = time.perf_counter() - _process_start
+log_event(logging.INFO, 'app ready', ms=round(APP_READY_SECONDS * 1000), core_imports_ms=round(IMPORT_TIMINGS['core'] * 1000))
 
 if __name__ == "__main__":
     app.run(debug=True, host='0.0.0.0', port=5000)
@@ -0,0 +1,38 @@
+import os
+import sys
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pgtest
+
+
+# Connection settings of a disposable database, given by PGTEST_DATABASE and the usual PG* variables
+@pytest.fixture
+def database():
+    """Skip unless PGTEST_DATABASE names a database the tests may write to.
+
+    The server needs pgvector and pg_diskann. Without azure_ai the stub
+    embedder is installed; with it, the configured deployment is used.
+    """
+    dbname = os.environ.get('PGTEST_DATABASE')
+    if not dbname:
+        pytest.skip('PGTEST_DATABASE is not set')
+    settings = (dbname, os.environ.get('PGUSER', 'postgres'), os.environ.get('PGPASSWORD', ''),
+                os.environ.get('PGHOST', 'localhost'), os.environ.get('PGPORT', '5432'))
+    try:
+        pgtest.install_stub_embedder(*settings, pgtest.config.get('embeddingsize', 1536))
+    except RuntimeError:
+        pass
+    return settings
+
+
+# A fresh tenant with its partitions, so tests never see each other's rows
+@pytest.fixture
+def tenant(database):
+    name = 'test-' + uuid.uuid4().hex[:8]
+    pgtest.intialize(*database, pgtest.config.get('embeddingsize', 1536),
+                     pgtest.DEFAULT_EMBEDDINGS_MODEL, name)
+    return pgtest.tenant_key(name)
@@ -0,0 +1,79 @@
+import threading
+import time
+
+import pytest
+
+import pgtest
+
+
+def controller(max_concurrent=2, max_per_user=2, max_queue=10, queue_timeout=0.05, degrade_at=0.5, cache_only_max=1):
+    return pgtest.AdmissionController(max_concurrent, max_per_user, max_queue, queue_timeout, degrade_at, cache_only_max)
+
+
+def test_full_then_degraded_as_the_load_rises():
+    admission = controller()
+    assert admission.acquire('alice') == 'full'
+    assert admission.acquire('bob') == 'full-text'
+    assert admission.metrics()['running'] == 2
+
+
+def test_cache_only_then_shed_when_no_slot_frees_up():
+    admission = controller(max_concurrent=1)
+    assert admission.acquire('alice') == 'full'
+    assert admission.acquire('bob') == 'cache-only'
+    assert admission.acquire('carol') is None
+    stats = admission.metrics()['stats']
+    assert stats['queue_timeouts'] == 2 and stats['shed'] == 1
+
+    admission.release('bob', 'cache-only', 0.1)
+    assert admission.acquire('carol') == 'cache-only'
+
+
+def test_a_full_queue_is_not_joined():
+    admission = controller(max_concurrent=1, max_queue=0, queue_timeout=5)
+    assert admission.acquire('alice') == 'cache-only'
+    assert admission.metrics()['stats']['queue_timeouts'] == 0
+
+
+def test_per_user_limit_leaves_room_for_others():
+    admission = controller(max_concurrent=4, max_per_user=1, degrade_at=10)
+    assert admission.acquire('alice') == 'full'
+    assert admission.acquire('alice') == 'cache-only'
+    assert admission.acquire('bob') == 'full'
+
+
+def test_release_wakes_a_waiting_request():
+    admission = controller(max_concurrent=1, queue_timeout=5, degrade_at=10)
+    assert admission.acquire('alice') == 'full'
+    outcome = {}
+    thread = threading.Thread(target=lambda: outcome.update(mode=admission.acquire('bob')))
+    thread.start()
+    deadline = time.monotonic() + 5
+    while admission.metrics()['queue_depth'] == 0:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    admission.release('alice', 'full', 2.0)
+    thread.join()
+    assert outcome['mode'] == 'full'
+    assert admission.metrics()['users'] == 1
+
+
+def test_retry_after_follows_the_service_time():
+    admission = controller(max_concurrent=1)
+    assert admission.retry_after() == 1.0
+    for _ in range(50):
+        mode = admission.acquire('alice')
+        admission.release('alice', mode, 10.0)
+    assert admission.retry_after() > 5.0
+
+
+def test_admitted_raises_overloaded_when_shed(monkeypatch):
+    admission = controller(max_concurrent=1, cache_only_max=0)
+    monkeypatch.setattr(pgtest, 'admission', admission)
+    with pgtest.admitted('alice') as mode:
+        assert mode == 'full'
+        with pytest.raises(pgtest.OverloadedError) as raised:
+            with pgtest.admitted('bob'):
+                pass
+        assert raised.value.retry_after >= 1.0
+    assert admission.metrics()['running'] == 0
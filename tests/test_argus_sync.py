@@ -0,0 +1,104 @@
+import pytest
+
+import pgtest
+
+
+# In-memory stand-in for an azure-cosmos ContainerProxy, answering the two queries the sync sends
+class FakeContainer:
+    def __init__(self, documents, fail_on_page=None):
+        self.documents = {doc['id']: doc for doc in documents}
+        self.fail_on_page = fail_on_page
+        self.pages = 0
+
+    def query_items(self, query, parameters=None, enable_cross_partition_query=False):
+        if query == "SELECT VALUE c.id FROM c":
+            return iter(list(self.documents))
+        self.pages += 1
+        if self.pages == self.fail_on_page:
+            raise RuntimeError('Cosmos DB unavailable')
+        params = {param['name']: param['value'] for param in parameters}
+        keys = sorted((doc['_ts'], doc['id']) for doc in self.documents.values())
+        keys = [key for key in keys if key > (params['@ts'], params['@id'])][:params['@n']]
+        return iter([{'id': doc_id, '_ts': ts,
+                      'gpt_summary_output': self.documents[doc_id].get('extracted_data', {}).get('gpt_summary_output')}
+                     for ts, doc_id in keys])
+
+
+def document(doc_id, ts, summary):
+    return {'id': doc_id, '_ts': ts, 'extracted_data': {'gpt_summary_output': summary}}
+
+
+def stored(database, tenant):
+    conn = pgtest.get_db_connection(*database)
+    cur = conn.cursor()
+    cur.execute('''SELECT source_id, chuncks FROM data WHERE tenant = %s AND typefile = 'argus' ORDER BY source_id''', (tenant,))
+    rows = cur.fetchall()
+    cur.execute('SELECT last_ts, last_id FROM argus_sync_state WHERE tenant = %s', (tenant,))
+    checkpoint = cur.fetchone()
+    version = pgtest.get_corpus_version(cur, tenant)
+    cur.close()
+    conn.close()
+    return rows, checkpoint, version
+
+
+def sync(container, database, tenant):
+    return pgtest.sync_argus_container(container, 'fake', *database, tenant=tenant)
+
+
+@pytest.fixture(autouse=True)
+def small_pages(monkeypatch):
+    monkeypatch.setattr(pgtest, 'ARGUS_PAGE_SIZE', 2)
+
+
+def test_documents_sharing_a_timestamp_span_pages(database, tenant):
+    docs = [document('doc-%d' % i, 100, 'summary number %d' % i) for i in range(5)] + [document('doc-9', 101, 'later')]
+    counts = sync(FakeContainer(docs), database, tenant)
+
+    rows, checkpoint, _ = stored(database, tenant)
+    assert counts['inserted'] == 6
+    assert [row[0] for row in rows] == ['doc-0', 'doc-1', 'doc-2', 'doc-3', 'doc-4', 'doc-9']
+    assert checkpoint == (101, 'doc-9')
+
+    counts = sync(FakeContainer(docs), database, tenant)
+    assert counts['inserted'] == 0 and counts['updated'] == 0
+
+
+def test_failure_mid_sync_keeps_the_last_checkpoint_and_invalidates(database, tenant):
+    docs = [document('doc-%d' % i, 100 + i, 'summary number %d' % i) for i in range(5)]
+    _, _, before = stored(database, tenant)
+
+    with pytest.raises(RuntimeError):
+        sync(FakeContainer(docs, fail_on_page=2), database, tenant)
+    rows, checkpoint, version = stored(database, tenant)
+    assert [row[0] for row in rows] == ['doc-0', 'doc-1']
+    assert checkpoint == (101, 'doc-1')
+    assert version > before
+
+    counts = sync(FakeContainer(docs), database, tenant)
+    rows, checkpoint, _ = stored(database, tenant)
+    assert counts['inserted'] == 3
+    assert [row[0] for row in rows] == ['doc-0', 'doc-1', 'doc-2', 'doc-3', 'doc-4']
+    assert checkpoint == (104, 'doc-4')
+
+
+def test_reconcile_deletes_removed_documents(database, tenant, monkeypatch):
+    monkeypatch.setattr(pgtest, 'ARGUS_RECONCILE_EVERY', 1)
+    docs = [document('doc-%d' % i, 100 + i, 'summary number %d' % i) for i in range(3)]
+    sync(FakeContainer(docs), database, tenant)
+    _, _, before = stored(database, tenant)
+
+    counts = sync(FakeContainer(docs[:1] + docs[2:]), database, tenant)
+    rows, _, version = stored(database, tenant)
+    assert counts['deleted'] == 1
+    assert [row[0] for row in rows] == ['doc-0', 'doc-2']
+    assert version > before
+
+
+def test_changed_and_emptied_summaries(database, tenant):
+    docs = [document('doc-0', 100, 'first text'), document('doc-1', 101, 'second text')]
+    sync(FakeContainer(docs), database, tenant)
+
+    counts = sync(FakeContainer([document('doc-0', 102, 'first text, edited'), document('doc-1', 103, '')]), database, tenant)
+    rows, _, _ = stored(database, tenant)
+    assert counts['updated'] == 1 and counts['deleted'] == 1
+    assert rows == [('doc-0', 'first text, edited')]
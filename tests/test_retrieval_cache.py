@@ -0,0 +1,51 @@
+import pgtest
+
+
+def key(question, tenant='acme', filenames=None, version=1):
+    return pgtest.retrieval_cache_key(question, 'vector', tenant, 'english', None, filenames, version)
+
+
+def test_key_normalizes_the_question_and_sorts_filters():
+    assert key('What  is PostgreSQL?') == key('what is postgresql?')
+    assert key('q', filenames=['b.pdf', 'a.pdf']) == key('q', filenames=['a.pdf', 'b.pdf'])
+    assert key('q', version=1) != key('q', version=2)
+
+
+def test_invalidate_carries_over_entries_of_unchanged_files():
+    cache = pgtest.RetrievalCache(max_entries=10, ttl=60)
+    cache.put(key('whole corpus'), 'all')
+    cache.put(key('unchanged', filenames=['a.pdf']), 'a')
+    cache.put(key('changed', filenames=['a.pdf', 'b.pdf']), 'ab')
+    cache.put(key('other tenant', tenant='globex'), 'other')
+
+    cache.invalidate('acme', ['b.pdf'], 2)
+
+    assert cache.get(key('unchanged', filenames=['a.pdf'], version=2)) == 'a'
+    assert cache.get(key('unchanged', filenames=['a.pdf'], version=1)) is None
+    assert cache.get(key('whole corpus', version=2)) is None
+    assert cache.get(key('changed', filenames=['a.pdf', 'b.pdf'], version=2)) is None
+    assert cache.get(key('other tenant', tenant='globex')) == 'other'
+    assert cache.stats['invalidations'] == 2
+
+
+def test_entries_expire_and_the_least_recent_is_evicted():
+    cache = pgtest.RetrievalCache(max_entries=2, ttl=60)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.get('a')
+    cache.put('c', 3)
+    assert cache.get('b') is None and cache.get('a') == 1 and cache.get('c') == 3
+    assert cache.stats['evictions'] == 1
+
+    expired = pgtest.RetrievalCache(max_entries=2, ttl=0)
+    expired.put('a', 1)
+    assert expired.get('a') is None
+
+
+def test_clear_only_drops_the_tenant():
+    cache = pgtest.RetrievalCache(max_entries=10, ttl=60)
+    cache.put(key('q', tenant='acme'), 1)
+    cache.put(key('q', tenant='globex'), 2)
+    cache.clear('acme')
+    assert cache.get(key('q', tenant='acme')) is None
+    assert cache.get(key('q', tenant='globex')) == 2
@@ -0,0 +1,162 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import pgtest
+
+
+# Shaped like openai.RateLimitError: status_code 429 and the response headers
+class Throttled(Exception):
+    status_code = 429
+
+    def __init__(self, headers=None):
+        super().__init__('Too Many Requests')
+        self.response = SimpleNamespace(headers=headers or {})
+
+
+def scheduler(max_concurrency=4, max_retries=3):
+    return pgtest.OpenAIScheduler(rpm=6000, tpm=1000000, max_concurrency=max_concurrency, max_retries=max_retries)
+
+
+# Run fn in a thread, keeping what it returned or raised
+def in_thread(fn):
+    outcome = {}
+
+    def run():
+        try:
+            outcome['result'] = fn()
+        except Exception as e:
+            outcome['error'] = e
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread, outcome
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.01)
+
+
+def test_retry_after_header_delays_the_retry():
+    calls = []
+
+    def fn():
+        calls.append(time.monotonic())
+        if len(calls) == 1:
+            raise Throttled({'retry-after': '0.3'})
+        return 'ok'
+
+    s = scheduler()
+    assert s.submit(fn) == 'ok'
+    assert calls[1] - calls[0] >= 0.3
+    assert s.stats['retries'] == 1 and s.stats['rate_limited'] == 1
+
+
+def test_retry_after_ms_is_preferred():
+    assert pgtest.retry_after_seconds(Throttled({'retry-after-ms': '250', 'retry-after': '9'})) == 0.25
+    assert pgtest.retry_after_seconds(Exception('Rate limit reached, retry after 7 seconds')) == 7.0
+    assert pgtest.retry_after_seconds(Exception('no hint')) is None
+
+
+def test_a_429_pauses_every_caller():
+    s = scheduler()
+
+    def fn():
+        if s.stats['rate_limited'] == 0:
+            raise Throttled({'retry-after': '0.3'})
+        return 'ok'
+
+    thread, outcome = in_thread(lambda: s.submit(fn))
+    wait_until(lambda: s.paused_until > 0)
+    start = time.monotonic()
+    assert s.submit(lambda: 'other') == 'other'
+    assert time.monotonic() - start >= 0.2
+    thread.join()
+    assert outcome['result'] == 'ok'
+
+
+def test_gives_up_with_the_service_delay():
+    s = scheduler(max_retries=1)
+
+    def fn():
+        raise Throttled({'retry-after': '0.05'})
+
+    with pytest.raises(pgtest.RateLimitedError) as raised:
+        s.submit(fn)
+    assert raised.value.retry_after == 0.05
+    assert s.stats['calls'] == 2
+
+
+def test_other_errors_are_not_retried():
+    s = scheduler()
+    calls = []
+
+    def fn():
+        calls.append(1)
+        raise ValueError('bad input')
+
+    with pytest.raises(ValueError):
+        s.submit(fn)
+    assert len(calls) == 1 and s.stats['retries'] == 0
+
+
+def test_calls_with_the_same_key_share_one_result():
+    s = scheduler()
+    release = threading.Event()
+    calls = []
+
+    def fn():
+        calls.append(1)
+        release.wait(5)
+        return {'answer': 42}
+
+    leader, first = in_thread(lambda: s.submit(fn, key='same question'))
+    wait_until(lambda: calls)
+    follower, second = in_thread(lambda: s.submit(fn, key='same question'))
+    wait_until(lambda: s.stats['coalesced'] == 1)
+    release.set()
+    leader.join()
+    follower.join()
+    assert len(calls) == 1
+    assert first['result'] is second['result']
+    # The key is forgotten once the call finished: a later call runs again
+    assert s.submit(lambda: 'again', key='same question') == 'again'
+
+
+def test_coalesced_callers_get_the_leader_error():
+    s = scheduler()
+    release = threading.Event()
+
+    def fn():
+        release.wait(5)
+        raise ValueError('failed once for everybody')
+
+    leader, first = in_thread(lambda: s.submit(fn, key='k'))
+    wait_until(lambda: 'k' in s.inflight)
+    follower, second = in_thread(lambda: s.submit(fn, key='k'))
+    wait_until(lambda: s.stats['coalesced'] == 1)
+    release.set()
+    leader.join()
+    follower.join()
+    assert isinstance(first['error'], ValueError) and second['error'] is first['error']
+
+
+def test_interactive_calls_overtake_bulk_ones():
+    s = scheduler(max_concurrency=1)
+    release = threading.Event()
+    order = []
+
+    blocker, _ = in_thread(lambda: s.submit(lambda: release.wait(5)))
+    wait_until(lambda: s.running == 1)
+    bulk, _ = in_thread(lambda: s.submit(lambda: order.append('bulk'), pgtest.PRIORITY_BULK))
+    wait_until(lambda: len(s.waiting) == 1)
+    interactive, _ = in_thread(lambda: s.submit(lambda: order.append('interactive'), pgtest.PRIORITY_INTERACTIVE))
+    wait_until(lambda: len(s.waiting) == 2)
+    release.set()
+    for thread in (blocker, bulk, interactive):
+        thread.join()
+    assert order == ['interactive', 'bulk']
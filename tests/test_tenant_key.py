@@ -0,0 +1,28 @@
+import re
+
+import pgtest
+
+NAMES = ['acme', 'Acme', 'ACME', 'acme!', 'acme?', 'ac me', 'ac_me', 'ac-me', 'Société', 'societe', 'Societe',
+         '42', '_acme', 'a' * 32, 'a' * 33, 'a' * 40 + 'x', 'a' * 40 + 'y', 'x' * 19 + '_0123456789ab', '', None]
+
+
+def test_plain_identifiers_are_their_own_key():
+    for name in ['acme', 'tenant_42', 'a' * 32]:
+        assert pgtest.tenant_key(name) == name
+
+
+def test_distinct_names_get_distinct_keys():
+    names = {str(name or pgtest.DEFAULT_TENANT) for name in NAMES}
+    assert len({pgtest.tenant_key(name) for name in names}) == len(names)
+
+
+def test_keys_are_valid_partition_suffixes_and_stable():
+    for name in NAMES:
+        key = pgtest.tenant_key(name)
+        assert re.fullmatch(r'[a-z][a-z0-9_]{0,31}', key), key
+        assert pgtest.tenant_key(key) == key
+        assert len(pgtest.vector_index_name('tablecahedoc', key) + '_next') <= 63
+
+
+def test_empty_names_are_the_default_tenant():
+    assert pgtest.tenant_key(None) == pgtest.tenant_key('') == pgtest.DEFAULT_TENANT
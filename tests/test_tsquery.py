@@ -0,0 +1,39 @@
+import pgtest
+
+
+def test_plain_questions_or_their_terms():
+    sql, params = pgtest.tsquery_sql('How do I tune autovacuum?', 'english')
+    assert sql.startswith("to_tsquery('simple', replace(plainto_tsquery(")
+    assert "' | '" in sql
+    assert params == ['english', 'How do I tune autovacuum?']
+
+
+def test_web_search_syntax_is_kept():
+    for question in ['"read replica" lag', 'vacuum or analyze', 'index -btree', '-btree index']:
+        sql, params = pgtest.tsquery_sql(question, 'english')
+        assert sql == "websearch_to_tsquery(%s::regconfig, %s)"
+        assert params == ['english', question]
+
+
+def test_words_merely_containing_or_or_dashes_are_plain():
+    for question in ['order of columns', 'write-ahead log', 'error handling']:
+        sql, _ = pgtest.tsquery_sql(question, 'english')
+        assert 'websearch' not in sql
+
+
+def test_unknown_languages_fall_back_to_the_default():
+    _, params = pgtest.tsquery_sql('question', 'klingon')
+    assert params[0] == pgtest.DEFAULT_LANGUAGE
+    _, params = pgtest.tsquery_sql('question', 'French')
+    assert params[0] == 'french'
+
+
+def test_punctuation_never_breaks_the_query(database):
+    conn = pgtest.get_db_connection(*database)
+    cur = conn.cursor()
+    for question in ["what's C++ & (x|y)!?", '"unbalanced quote', 'a:*b <-> !c', '', '-', 'or']:
+        sql, params = pgtest.tsquery_sql(question, 'english')
+        cur.execute('SELECT ' + sql + '::text', params)
+        cur.fetchone()
+    cur.close()
+    conn.close()